@@ -0,0 +1,117 @@
+import type * as niivue from "@niivue/niivue";
+import * as lib from "./lib.ts";
+import type { ColormapModel, ColormapRegistryModel, Model } from "./types.ts";
+
+type ColorMap = Parameters<niivue.Niivue["addColormap"]>[1];
+
+/**
+ * Colormaps converted from the models sent from Python, by model id.
+ *
+ * The colormap models are shared by all the widgets on the page, so each
+ * colormap is only received and converted once.
+ */
+const converted = new Map<string, ColorMap>();
+
+/** Label lookup tables by name, for volumes. */
+const label_luts = new Map<string, ColorMap>();
+
+/** Called with the name of a label lookup table when it is (re)registered. */
+const label_lut_listeners = new Set<(name: string) => void>();
+
+function to_colormap(cmodel: ColormapModel): ColorMap {
+	const rgba = lib.typed_array(cmodel.get("rgba"));
+	const indices = cmodel.get("indices");
+	const idx = indices ? lib.typed_array(indices) : null;
+	const n = rgba.length / 4;
+	const cmap: ColorMap = { R: [], G: [], B: [], A: [], I: [] };
+	for (let i = 0; i < n; i++) {
+		cmap.R.push(rgba[4 * i]);
+		cmap.G.push(rgba[4 * i + 1]);
+		cmap.B.push(rgba[4 * i + 2]);
+		cmap.A.push(rgba[4 * i + 3]);
+		if (idx) {
+			cmap.I.push(idx[i]);
+		} else if (cmodel.get("is_label")) {
+			cmap.I.push(i);
+		} else {
+			// spread the colors evenly over the 256 entries of the colormap
+			cmap.I.push(Math.round((i * 255) / (n - 1)));
+		}
+	}
+	if (cmodel.get("labels").length > 0) {
+		cmap.labels = cmodel.get("labels");
+	}
+	return cmap;
+}
+
+/**
+ * Look up a label lookup table registered from Python.
+ */
+export function label_lut(name: string | null | undefined): ColorMap | null {
+	return (name && label_luts.get(name)) || null;
+}
+
+/**
+ * Call `callback` with the name of a label lookup table when it is registered
+ * or replaced, so the volumes that use it (even before it was registered)
+ * can apply it.
+ * Returns a function that removes the callback.
+ */
+export function on_label_lut_changed(
+	callback: (name: string) => void,
+): () => void {
+	label_lut_listeners.add(callback);
+	return () => label_lut_listeners.delete(callback);
+}
+
+/**
+ * Add the colormaps registered from Python to Niivue, and keep them up to date.
+ * Returns a cleanup function that removes the event listener.
+ */
+export async function render_colormaps(
+	nv: niivue.Niivue,
+	model: Model,
+): Promise<() => void> {
+	const [registry] = await lib.gather_models<ColormapRegistryModel>(model, [
+		model.get("_colormaps"),
+	]);
+	async function colormaps_changed() {
+		const cmodels = await lib.gather_models<ColormapModel>(
+			model,
+			registry.get("colormaps"),
+		);
+		// replaced colormaps are closed in Python, forget them
+		const ids = new Set(cmodels.map((cmodel) => cmodel.model_id));
+		for (const id of converted.keys()) {
+			if (!ids.has(id)) {
+				converted.delete(id);
+			}
+		}
+		const changed: Array<string> = [];
+		for (const cmodel of cmodels) {
+			let cmap = converted.get(cmodel.model_id);
+			if (!cmap) {
+				cmap = to_colormap(cmodel);
+				converted.set(cmodel.model_id, cmap);
+			}
+			const name = cmodel.get("name");
+			if (cmodel.get("is_label")) {
+				if (label_luts.get(name) !== cmap) {
+					label_luts.set(name, cmap);
+					changed.push(name);
+				}
+			} else {
+				nv.addColormap(name, cmap);
+			}
+		}
+		for (const name of changed) {
+			for (const listener of label_lut_listeners) {
+				listener(name);
+			}
+		}
+		nv.updateGLVolume();
+	}
+	await colormaps_changed();
+	registry.on("change:colormaps", colormaps_changed);
+	return () => registry.off("change:colormaps", colormaps_changed);
+}
@@ -1,6 +1,13 @@
 import type { AnyModel } from "@anywidget/types";
 import * as nv from "@niivue/niivue";
-import type { Model } from "./types.ts";
+import type {
+	File,
+	MemoryUsage,
+	MeshModel,
+	Model,
+	NDArray,
+	VolumeModel,
+} from "./types.ts";
 
 /**
  * Generates a unique file name for a volume (using the model id and the volume path)
@@ -11,12 +18,239 @@ import type { Model } from "./types.ts";
  */
 export function unique_id(model: {
 	model_id: string;
-	get(name: "path"): { name: string };
+	get(name: "path"): { name: string } | null;
 }): string {
-	const path = model.get("path");
+	// meshes created from arrays have no path
+	const name = model.get("path")?.name ?? "mesh";
 	// take the first 6 characters of the model_id, it should be unique enough
 	const id = model.model_id.slice(0, 6);
-	return `${id}:${path.name}`;
+	return `${id}:${name}`;
+}
+
+const TYPED_ARRAYS = {
+	uint8: Uint8Array,
+	int8: Int8Array,
+	uint16: Uint16Array,
+	int16: Int16Array,
+	uint32: Uint32Array,
+	int32: Int32Array,
+	float32: Float32Array,
+	float64: Float64Array,
+};
+
+type TypedArray = InstanceType<
+	(typeof TYPED_ARRAYS)[keyof typeof TYPED_ARRAYS]
+>;
+
+/**
+ * Wrap the bytes of an array sent from Python in a typed array.
+ *
+ * The buffer is used as-is (no copy), unless its offset is not
+ * aligned for the element type.
+ */
+export function typed_array(arr: NDArray): TypedArray {
+	const ArrayType: {
+		new (
+			buffer: ArrayBufferLike,
+			byteOffset: number,
+			length: number,
+		): TypedArray;
+		BYTES_PER_ELEMENT: number;
+	} = TYPED_ARRAYS[arr.dtype];
+	if (!arr.data) {
+		throw new Error(`Array ${arr.digest} was sent without its data`);
+	}
+	let { buffer, byteOffset, byteLength } = arr.data;
+	if (byteOffset % ArrayType.BYTES_PER_ELEMENT !== 0) {
+		buffer = buffer.slice(byteOffset, byteOffset + byteLength);
+		byteOffset = 0;
+	}
+	return new ArrayType(
+		buffer,
+		byteOffset,
+		byteLength / ArrayType.BYTES_PER_ELEMENT,
+	);
+}
+
+/**
+ * Payloads received from Python, by digest.
+ *
+ * We only keep weak references, so a payload can be reused for as long as
+ * something else (e.g. a model) holds it, without keeping another copy.
+ */
+const payloads = new Map<string, WeakRef<ArrayBuffer>>();
+
+/**
+ * The digests of the payloads that can still be reused.
+ */
+export function held_digests(): Array<string> {
+	const digests = [];
+	for (const [digest, ref] of payloads) {
+		if (ref.deref()) {
+			digests.push(digest);
+		} else {
+			payloads.delete(digest);
+		}
+	}
+	return digests;
+}
+
+function to_array_buffer(view: DataView): ArrayBuffer {
+	const { buffer, byteOffset, byteLength } = view;
+	if (byteOffset === 0 && byteLength === buffer.byteLength) {
+		return buffer as ArrayBuffer;
+	}
+	return buffer.slice(byteOffset, byteOffset + byteLength) as ArrayBuffer;
+}
+
+function request_payload(
+	model: AnyModel,
+	digest: string,
+): Promise<ArrayBuffer> {
+	return new Promise((resolve, reject) => {
+		function on_msg(
+			msg: { type: string; digest: string; found: boolean },
+			buffers: Array<DataView>,
+		) {
+			if (msg.type !== "payload" || msg.digest !== digest) {
+				return;
+			}
+			model.off("msg:custom", on_msg);
+			if (!msg.found) {
+				reject(new Error(`Payload ${digest} is not available anymore`));
+				return;
+			}
+			const buffer = to_array_buffer(buffers[0]);
+			payloads.set(digest, new WeakRef(buffer));
+			resolve(buffer);
+		}
+		model.on("msg:custom", on_msg);
+		model.send({ type: "request_payload", digest });
+	});
+}
+
+function embedded_script(digest: string): HTMLScriptElement | null {
+	return document.querySelector<HTMLScriptElement>(
+		`script[data-niivue-payload="${CSS.escape(digest)}"]`,
+	);
+}
+
+/**
+ * Whether the page is a static export with embedded payloads
+ * (see `export_html` in Python).
+ */
+export function has_embedded_payloads(): boolean {
+	return document.querySelector("script[data-niivue-payload]") !== null;
+}
+
+/**
+ * Decode a payload embedded in the page by `export_html`, if there is one.
+ *
+ * Each payload is in its own script tag, so it is only decoded when a
+ * volume or mesh that uses it is rendered.
+ */
+async function embedded_payload(digest: string): Promise<ArrayBuffer | null> {
+	const script = embedded_script(digest);
+	const data = script?.textContent?.trim();
+	if (!script || !data) {
+		return null;
+	}
+	// let the browser decode the base64, it is much faster than `atob`
+	const response = await fetch(
+		`data:application/octet-stream;base64,${data}`,
+	);
+	let buffer: ArrayBuffer;
+	if (script.dataset.encoding === "gzip" && response.body) {
+		const stream = response.body.pipeThrough(new DecompressionStream("gzip"));
+		buffer = await new Response(stream).arrayBuffer();
+	} else {
+		buffer = await response.arrayBuffer();
+	}
+	payloads.set(digest, new WeakRef(buffer));
+	return buffer;
+}
+
+/**
+ * Get the bytes of a file sent from Python.
+ *
+ * If the file was sent without its data, we look it up by digest (in the
+ * payloads we hold, then in the page), and only request it from Python
+ * again if it is not found.
+ */
+export async function payload_buffer(
+	model: AnyModel,
+	file: File,
+): Promise<ArrayBuffer> {
+	if (file.data) {
+		const buffer = to_array_buffer(file.data);
+		payloads.set(file.digest, new WeakRef(buffer));
+		return buffer;
+	}
+	return (
+		payloads.get(file.digest)?.deref() ??
+		(await embedded_payload(file.digest)) ??
+		(await request_payload(model, file.digest))
+	);
+}
+
+/**
+ * Wrap an array sent from Python in a typed array.
+ *
+ * In a static export, the data of the array is taken out of the state by
+ * `embed_state`, and decoded from the page by digest.
+ */
+export async function array_payload(arr: NDArray): Promise<TypedArray> {
+	if (arr.data || !arr.digest) {
+		return typed_array(arr);
+	}
+	const buffer =
+		payloads.get(arr.digest)?.deref() ??
+		(await embedded_payload(arr.digest));
+	if (!buffer) {
+		throw new Error(`Array ${arr.digest} is not available`);
+	}
+	return typed_array({ ...arr, data: new DataView(buffer) });
+}
+
+/**
+ * Resolve once an element is (about to be) scrolled into view.
+ */
+export function in_view(el: HTMLElement): Promise<void> {
+	return new Promise((resolve) => {
+		const observer = new IntersectionObserver(
+			(entries) => {
+				if (entries.some((entry) => entry.isIntersecting)) {
+					observer.disconnect();
+					resolve();
+				}
+			},
+			{ rootMargin: "200px" },
+		);
+		observer.observe(el);
+	});
+}
+
+let released_bytes = 0;
+
+/**
+ * Drop the bytes of a file from the model state once they have been parsed.
+ *
+ * The model is usually the only owner of the buffer received from Python,
+ * so this lets the browser free it instead of keeping it next to the parsed
+ * image or mesh. `payload_buffer` gets the bytes back (from the payload cache,
+ * or from Python) if the file has to be parsed again.
+ */
+export function release_payload(file: File | null | undefined): void {
+	if (!file?.data) {
+		return;
+	}
+	released_bytes += file.data.byteLength;
+	file.data = null;
+}
+
+/** The total number of bytes dropped by `release_payload`. */
+export function released(): number {
+	return released_bytes;
 }
 
 export function gather_models<T extends AnyModel>(
@@ -57,9 +291,17 @@ export function determine_update_type<T>(
  */
 export class Disposer {
 	#disposers = new Map<string, () => void>();
-	register(obj: nv.NVMesh | nv.NVImage, disposer: () => void): void {
+	#key(obj: nv.NVMesh | nv.NVImage): string {
 		const prefix = obj instanceof nv.NVMesh ? "mesh" : "image";
-		this.#disposers.set(`${prefix}:${obj.name}`, disposer);
+		return `${prefix}:${obj.name}`;
+	}
+	register(obj: nv.NVMesh | nv.NVImage, disposer: () => void): void {
+		this.#disposers.set(this.#key(obj), disposer);
+	}
+	dispose(obj: nv.NVMesh | nv.NVImage): void {
+		const key = this.#key(obj);
+		this.#disposers.get(key)?.();
+		this.#disposers.delete(key);
 	}
 	disposeAll(kind?: "mesh" | "image"): void {
 		for (const [name, dispose] of this.#disposers) {
@@ -70,3 +312,207 @@ export class Disposer {
 		}
 	}
 }
+
+/** The estimated memory used by a layer, in bytes. */
+export interface Footprint {
+	cpu: number;
+	gpu: number;
+}
+
+/**
+ * A volume or mesh that the `Residency` manager can evict and load again.
+ */
+export interface ResidentLayer {
+	kind: "volume" | "mesh";
+	model: VolumeModel | MeshModel;
+	/** Whether the layer is currently not visible in the scene. */
+	hidden(): boolean;
+	/**
+	 * Build the layer and add it to the scene at `index` (among the resident
+	 * layers of the same kind), replacing it if it is already there.
+	 */
+	load(index: number): Promise<Footprint>;
+	/** Remove the layer from the scene, so that its memory can be freed. */
+	unload(): void;
+}
+
+interface Residence {
+	// null while the layer is evicted
+	footprint: Footprint | null;
+	last_viewed: number;
+	loading?: Promise<void>;
+	viewed: () => void;
+}
+
+/**
+ * Keeps the memory used by the volumes and meshes under a budget.
+ *
+ * When the budget is exceeded, the hidden layers are evicted, the least
+ * recently viewed first. An evicted layer keeps its model (and so all its
+ * metadata), and is loaded again through `payload_buffer` as soon as it is
+ * changed while visible. Visible layers are never evicted: when they alone
+ * exceed the budget, the usage that is reported says so.
+ */
+export class Residency {
+	#layers = new Map<ResidentLayer, Residence>();
+	#budget: number | null = null;
+	#clock = 0;
+	#report: (usage: MemoryUsage) => void;
+
+	constructor(report: (usage: MemoryUsage) => void) {
+		this.#report = report;
+	}
+
+	set budget(bytes: number | null) {
+		this.#budget = bytes;
+		this.#enforce();
+	}
+
+	/** The names of the layers of a kind, including the evicted ones. */
+	names(kind: ResidentLayer["kind"]): Array<string> {
+		return [...this.#layers.keys()]
+			.filter((layer) => layer.kind === kind)
+			.map((layer) => unique_id(layer.model));
+	}
+
+	async add(layer: ResidentLayer): Promise<void> {
+		const residence: Residence = {
+			footprint: null,
+			last_viewed: ++this.#clock,
+			viewed: () => this.#viewed(layer, residence),
+		};
+		this.#layers.set(layer, residence);
+		layer.model.on("change", residence.viewed);
+		await this.#load(layer, residence);
+		this.#enforce();
+	}
+
+	/**
+	 * Build a layer again, e.g. because its data changed. Evicted layers
+	 * are built with their current data when they are restored.
+	 */
+	async reload(layer: ResidentLayer): Promise<void> {
+		const residence = this.#layers.get(layer);
+		await residence?.loading;
+		if (!residence?.footprint) {
+			return;
+		}
+		await this.#load(layer, residence);
+		this.#enforce();
+	}
+
+	/** Remove all the layers (of a kind) from the scene. */
+	clear(kind?: ResidentLayer["kind"]): void {
+		for (const [layer, residence] of this.#layers) {
+			if (kind && layer.kind !== kind) {
+				continue;
+			}
+			layer.model.off("change", residence.viewed);
+			if (residence.footprint) {
+				layer.unload();
+			}
+			this.#layers.delete(layer);
+		}
+		this.#report(this.usage());
+	}
+
+	usage(): MemoryUsage {
+		const layers = [...this.#layers].map(([layer, residence]) => ({
+			model_id: layer.model.model_id,
+			kind: layer.kind,
+			cpu: residence.footprint?.cpu ?? 0,
+			gpu: residence.footprint?.gpu ?? 0,
+			resident: residence.footprint !== null,
+		}));
+		const cpu = layers.reduce((n, layer) => n + layer.cpu, 0);
+		const gpu = layers.reduce((n, layer) => n + layer.gpu, 0);
+		return {
+			budget: this.#budget,
+			cpu,
+			gpu,
+			// the visible layers alone use more than the budget
+			exceeded: this.#budget !== null && cpu + gpu > this.#budget,
+			layers,
+		};
+	}
+
+	#total(): number {
+		let total = 0;
+		for (const { footprint } of this.#layers.values()) {
+			total += (footprint?.cpu ?? 0) + (footprint?.gpu ?? 0);
+		}
+		return total;
+	}
+
+	#index(layer: ResidentLayer): number {
+		let index = 0;
+		for (const [other, residence] of this.#layers) {
+			if (other === layer) {
+				break;
+			}
+			if (other.kind === layer.kind && residence.footprint) {
+				index++;
+			}
+		}
+		return index;
+	}
+
+	#load(layer: ResidentLayer, residence: Residence): Promise<void> {
+		// loading changes the model (e.g. its id), don't load it twice
+		residence.loading ??= (async () => {
+			try {
+				residence.footprint = await layer.load(this.#index(layer));
+				residence.last_viewed = ++this.#clock;
+			} finally {
+				residence.loading = undefined;
+			}
+		})();
+		return residence.loading;
+	}
+
+	#viewed(layer: ResidentLayer, residence: Residence) {
+		residence.last_viewed = ++this.#clock;
+		if (residence.loading) {
+			return;
+		}
+		if (residence.footprint) {
+			// a layer that was hidden can make room for the visible ones
+			if (layer.hidden()) {
+				this.#enforce();
+			}
+			return;
+		}
+		if (layer.hidden()) {
+			return;
+		}
+		// the evicted layer was changed or became visible again
+		this.#load(layer, residence).then(() => this.#enforce());
+	}
+
+	#enforce() {
+		const budget = this.#budget;
+		if (budget !== null) {
+			let total = this.#total();
+			// only hidden layers are evicted, the least recently viewed first,
+			// as they are loaded again once they are changed to be visible
+			const hidden = [...this.#layers]
+				.filter(
+					([layer, residence]) =>
+						layer.hidden() && residence.footprint && !residence.loading,
+				)
+				.sort(([, ra], [, rb]) => ra.last_viewed - rb.last_viewed);
+			for (const [layer, residence] of hidden) {
+				if (total <= budget) {
+					break;
+				}
+				if (!residence.footprint) {
+					continue;
+				}
+				total -= residence.footprint.cpu + residence.footprint.gpu;
+				layer.unload();
+				residence.footprint = null;
+			}
+		}
+		this.#report(this.usage());
+	}
+}
@@ -1,28 +1,112 @@
 import * as niivue from "@niivue/niivue";
 import * as lib from "./lib.ts";
-import type { MeshModel, Model } from "./types.ts";
+import type { MeshLayer, MeshModel, Model, NDArray } from "./types.ts";
 
 /**
- * Create a new NVMesh and attach the necessary event listeners
- * Returns the NVMesh and a cleanup function that removes the event listeners.
+ * Build the NVMesh from either the mesh file or the vertex/face arrays.
+ *
+ * Arrays are used as typed arrays directly, so no mesh format is parsed.
  */
-function create_mesh(
+async function read_mesh(
 	nv: niivue.Niivue,
 	mmodel: MeshModel,
-): [niivue.NVMesh, () => void] {
-	const mesh = niivue.NVMesh.readMesh(
-		mmodel.get("path").data.buffer, // buffer
-		mmodel.get("path").name, // name (used to identify the mesh)
-		nv.gl, // gl
+): Promise<niivue.NVMesh> {
+	const path = mmodel.get("path");
+	if (path) {
+		return niivue.NVMesh.readMesh(
+			await lib.payload_buffer(mmodel, path), // buffer
+			lib.unique_id(mmodel), // name (used to identify the mesh)
+			nv.gl, // gl
+			mmodel.get("opacity"), // opacity
+			new Uint8Array(mmodel.get("rgba255")), // rgba255
+			mmodel.get("visible"), // visible
+		);
+	}
+	const vertices = mmodel.get("vertices");
+	const faces = mmodel.get("faces");
+	if (!vertices || !faces) {
+		throw new Error("Mesh requires either a path or vertices and faces");
+	}
+	const colors = mmodel.get("colors");
+	return new niivue.NVMesh(
+		(await lib.array_payload(vertices)) as Float32Array, // pts
+		(await lib.array_payload(faces)) as Uint32Array, // tris
+		lib.unique_id(mmodel), // name
+		colors // rgba255 (one color per vertex if colors are given)
+			? ((await lib.array_payload(colors)) as Uint8Array)
+			: new Uint8Array(mmodel.get("rgba255")),
 		mmodel.get("opacity"), // opacity
-		new Uint8Array(mmodel.get("rgba255")), // rgba255
 		mmodel.get("visible"), // visible
+		nv.gl, // gl
 	);
-	for (const layer of mmodel.get("layers")) {
+}
+
+function value_range(values: ArrayLike<number>): [number, number] {
+	let min = Number.POSITIVE_INFINITY;
+	let max = Number.NEGATIVE_INFINITY;
+	for (let i = 0; i < values.length; i++) {
+		min = Math.min(min, values[i]);
+		max = Math.max(max, values[i]);
+	}
+	return [min, max];
+}
+
+/**
+ * Create a mesh layer from per-vertex values sent from Python.
+ *
+ * This mirrors what `NVMeshLoaders.readLayer` does for layer files,
+ * without having to parse a file format.
+ */
+async function create_value_layer(
+	layer: MeshLayer & { values: NDArray },
+): Promise<niivue.NVMesh["layers"][number]> {
+	const values = await lib.array_payload(layer.values);
+	const [global_min, global_max] = value_range(values);
+	return {
+		values,
+		nFrame4D: 1,
+		frame4D: 0,
+		global_min,
+		global_max,
+		cal_min: layer.cal_min ?? global_min,
+		cal_max: layer.cal_max ?? global_max,
+		cal_minNeg: Number.NaN,
+		cal_maxNeg: Number.NaN,
+		opacity: layer.opacity ?? 0.5,
+		colormap: layer.colormap ?? "warm",
+		colormapNegative: layer.colormapNegative ?? "winter",
+		useNegativeCmap: layer.useNegativeCmap ?? false,
+		colormapInvert: false,
+		isTransparentBelowCalMin: true,
+		isAdditiveBlend: false,
+		outlineBorder: 0,
+		showLegend: true,
+	} as niivue.NVMesh["layers"][number];
+}
+
+/**
+ * Create a new NVMesh and attach the necessary event listeners
+ * Returns the NVMesh and a cleanup function that removes the event listeners.
+ */
+async function create_mesh(
+	nv: niivue.Niivue,
+	mmodel: MeshModel,
+	release: boolean,
+): Promise<[niivue.NVMesh, () => void]> {
+	const mesh = await read_mesh(nv, mmodel);
+	const layers = mmodel.get("layers");
+	for (const layer of layers) {
+		if (layer.values) {
+			mesh.layers.push(await create_value_layer(layer));
+			continue;
+		}
+		if (!layer.path) {
+			throw new Error("Mesh layer requires either a path or values");
+		}
 		// https://github.com/niivue/niivue/blob/10d71baf346b23259570d7b2aa463749adb5c95b/src/nvmesh.ts#L1432C5-L1455C6
 		niivue.NVMeshLoaders.readLayer(
 			layer.path.name,
-			layer.path.data.buffer,
+			await lib.payload_buffer(mmodel, layer.path),
 			mesh,
 			layer.opacity ?? 0.5,
 			layer.colormap ?? "warm",
@@ -32,69 +116,204 @@ function create_mesh(
 			layer.cal_max ?? null,
 		);
 	}
+	if (layers.length > 0) {
+		mesh.updateMesh(nv.gl);
+	}
+	if (release) {
+		lib.release_payload(mmodel.get("path"));
+		for (const layer of layers) {
+			lib.release_payload(layer.path);
+		}
+	}
 
 	mmodel.set("id", mesh.id);
 	mmodel.set("name", mesh.name);
 	mmodel.save_changes();
 
+	// Properties (e.g. linked to a slider) and layer values can be updated
+	// many times per second, so we only recompute the colors once per frame.
+	let frame: number | undefined;
+	function update_gl() {
+		if (frame !== undefined) {
+			return;
+		}
+		frame = requestAnimationFrame(() => {
+			frame = undefined;
+			mesh.updateMesh(nv.gl);
+			nv.updateGLVolume();
+		});
+	}
+
 	function opacity_changed() {
 		mesh.opacity = mmodel.get("opacity");
-		mesh.updateMesh(nv.gl);
-		nv.updateGLVolume();
+		update_gl();
 	}
 	function rgba255_changed() {
 		mesh.rgba255 = new Uint8Array(mmodel.get("rgba255"));
-		mesh.updateMesh(nv.gl);
-		nv.updateGLVolume();
+		update_gl();
 	}
 	function visible_changed() {
 		mesh.visible = mmodel.get("visible");
-		mesh.updateMesh(nv.gl);
-		nv.updateGLVolume();
+		update_gl();
+	}
+	function custom_msg(
+		msg: { type: string; data: { index: number } },
+		buffers: Array<DataView>,
+	) {
+		if (msg.type === "layer_values") {
+			const array: NDArray = {
+				dtype: "float32",
+				shape: [buffers[0].byteLength / 4],
+				data: buffers[0],
+			};
+			// Python changed its layer in place, do the same in the model so
+			// that the mesh is rebuilt with the current values. Setting the
+			// attribute would rebuild it now, and sync it back to Python.
+			const mlayer = mmodel.get("layers")[msg.data.index];
+			if (mlayer) {
+				mlayer.values = array;
+			}
+			const layer = mesh.layers[msg.data.index];
+			const values = lib.typed_array(array);
+			layer.values = values;
+			[layer.global_min, layer.global_max] = value_range(values);
+			update_gl();
+		}
 	}
+
 	mmodel.on("change:opacity", opacity_changed);
 	mmodel.on("change:rgba255", rgba255_changed);
 	mmodel.on("change:visible", visible_changed);
+	mmodel.on("msg:custom", custom_msg);
 	return [
 		mesh,
 		() => {
 			mmodel.off("change:opacity", opacity_changed);
 			mmodel.off("change:rgba255", rgba255_changed);
 			mmodel.off("change:visible", visible_changed);
+			mmodel.off("msg:custom", custom_msg);
+			if (frame !== undefined) {
+				cancelAnimationFrame(frame);
+			}
 		},
 	];
 }
 
+function footprint(mesh: niivue.NVMesh): lib.Footprint {
+	let values = 0;
+	for (const layer of mesh.layers) {
+		values += layer.values?.byteLength ?? 0;
+	}
+	const tris = mesh.tris?.byteLength ?? 0;
+	return {
+		cpu: mesh.pts.byteLength + tris + values,
+		// Niivue uploads a position, a normal and a color (28 bytes)
+		// for each vertex, and the triangle indices
+		gpu: (mesh.pts.length / 3) * 28 + tris,
+	};
+}
+
+// The attributes that the mesh is built from
+const MESH_DATA = ["path", "vertices", "faces", "colors", "layers"] as const;
+
+/**
+ * A mesh that the residency manager can evict and load again.
+ *
+ * The mesh is rebuilt in place whenever its data is sent again from
+ * Python (e.g. when its level of detail changes).
+ */
+function mesh_layer(
+	nv: niivue.Niivue,
+	mmodel: MeshModel,
+	disposer: lib.Disposer,
+	residency: lib.Residency,
+	release: boolean,
+): lib.ResidentLayer {
+	let mesh: niivue.NVMesh | undefined;
+	// several attributes are updated together, only rebuild once
+	let pending = false;
+	function data_changed() {
+		if (pending) {
+			return;
+		}
+		pending = true;
+		queueMicrotask(() => {
+			pending = false;
+			residency.reload(layer);
+		});
+	}
+	const layer: lib.ResidentLayer = {
+		kind: "mesh",
+		model: mmodel,
+		hidden: () => !mmodel.get("visible") || mmodel.get("opacity") === 0,
+		async load(index: number) {
+			const [created, cleanup] = await create_mesh(nv, mmodel, release);
+			const idx = mesh ? nv.meshes.indexOf(mesh) : -1;
+			if (mesh && idx !== -1) {
+				disposer.dispose(mesh);
+				mesh.unloadMesh(nv.gl);
+				nv.meshes[idx] = created;
+				nv.updateGLVolume();
+			} else {
+				// an evicted mesh goes back to its place, which matters for
+				// the order it is drawn in
+				nv.addMesh(created);
+				if (index < nv.meshes.length - 1) {
+					nv.setMesh(created, index);
+				}
+			}
+			for (const key of MESH_DATA) {
+				mmodel.on(`change:${key}`, data_changed);
+			}
+			disposer.register(created, () => {
+				cleanup();
+				for (const key of MESH_DATA) {
+					mmodel.off(`change:${key}`, data_changed);
+				}
+			});
+			mesh = created;
+			return footprint(created);
+		},
+		unload() {
+			if (mesh) {
+				disposer.dispose(mesh);
+				nv.removeMesh(mesh);
+				mesh = undefined;
+			}
+		},
+	};
+	return layer;
+}
+
 export async function render_meshes(
 	nv: niivue.Niivue,
 	model: Model,
 	disposer: lib.Disposer,
+	residency: lib.Residency,
 ) {
 	const mmodels = await lib.gather_models<MeshModel>(
 		model,
 		model.get("_meshes"),
 	);
-	const curr_names = nv.meshes.map((m) => m.name);
+	const release = model.get("release_buffers");
+	// evicted meshes are not in the scene, but they are still there
+	const curr_names = residency.names("mesh");
 	const new_names = mmodels.map(lib.unique_id);
 	const update_type = lib.determine_update_type(curr_names, new_names);
 	if (update_type === "add") {
 		// We know that the new meshes are the same as the old meshes,
 		// except for the last one. We can just add the last mesh.
 		const mmodel = mmodels[mmodels.length - 1];
-		const [mesh, cleanup] = create_mesh(nv, mmodel);
-		disposer.register(mesh, cleanup);
-		nv.addMesh(mesh);
+		await residency.add(mesh_layer(nv, mmodel, disposer, residency, release));
 		return;
 	}
 
 	// If we can't determine the update type, we need
 	// to remove all the meshes
-	disposer.disposeAll("mesh");
+	residency.clear("mesh");
 
 	// create each mesh and add one-by-one
 	for (const mmodel of mmodels) {
-		const [mesh, cleanup] = create_mesh(nv, mmodel);
-		disposer.register(mesh, cleanup);
-		nv.addMesh(mesh);
+		await residency.add(mesh_layer(nv, mmodel, disposer, residency, release));
 	}
 }
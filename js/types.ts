@@ -1,8 +1,36 @@
 import type { AnyModel } from "@anywidget/types";
 
-interface File {
+/**
+ * A file sent from Python.
+ *
+ * `data` is null when Python knows the frontend already holds a payload
+ * with the same digest.
+ */
+export interface File {
 	name: string;
-	data: DataView;
+	digest: string;
+	data: DataView | null;
+}
+
+/**
+ * A NumPy array sent from Python as a raw binary buffer.
+ *
+ * In a static export, the data of mesh arrays is embedded in the page
+ * instead, and looked up by digest.
+ */
+export interface NDArray {
+	dtype:
+		| "uint8"
+		| "int8"
+		| "uint16"
+		| "int16"
+		| "uint32"
+		| "int32"
+		| "float32"
+		| "float64";
+	shape: Array<number>;
+	digest?: string;
+	data: DataView | null;
 }
 
 export type VolumeModel = { model_id: string } & AnyModel<{
@@ -15,10 +43,12 @@ export type VolumeModel = { model_id: string } & AnyModel<{
 	colorbar_visible: boolean;
 	cal_min?: number;
 	cal_max?: number;
+	colormap_label: string | null;
 }>;
 
-interface MeshLayer {
-	path: File;
+export interface MeshLayer {
+	path?: File;
+	values?: NDArray;
 	opacity: number;
 	colormap: string;
 	colormapNegative: string;
@@ -28,7 +58,10 @@ interface MeshLayer {
 }
 
 export type MeshModel = { model_id: string } & AnyModel<{
-	path: File;
+	path: File | null;
+	vertices: NDArray | null;
+	faces: NDArray | null;
+	colors: NDArray | null;
 	id: string;
 	name: string;
 	rgba255: Array<number>;
@@ -37,9 +70,48 @@ export type MeshModel = { model_id: string } & AnyModel<{
 	visible: boolean;
 }>;
 
+export type ColormapModel = { model_id: string } & AnyModel<{
+	name: string;
+	rgba: NDArray;
+	indices: NDArray | null;
+	labels: Array<string>;
+	is_label: boolean;
+}>;
+
+export type ColormapRegistryModel = AnyModel<{
+	colormaps: Array<string>;
+}>;
+
+/** Camera and crosshair restored from Python. */
+export interface Scene {
+	azimuth?: number;
+	elevation?: number;
+	crosshair?: [number, number, number];
+	zoom?: number;
+}
+
+/** The memory used by the volumes and meshes, reported to Python. */
+export interface MemoryUsage {
+	budget: number | null;
+	cpu: number;
+	gpu: number;
+	exceeded: boolean;
+	layers: Array<{
+		model_id: string;
+		kind: "volume" | "mesh";
+		cpu: number;
+		gpu: number;
+		resident: boolean;
+	}>;
+}
+
 export type Model = AnyModel<{
 	height: number;
 	_volumes: Array<string>;
 	_meshes: Array<string>;
+	_colormaps: string;
+	_scene: Scene;
+	release_buffers: boolean;
+	memory_budget: number | null;
 	_opts: Record<string, unknown>;
 }>;
@@ -1,17 +1,58 @@
 import * as niivue from "@niivue/niivue";
+import * as colormaps from "./colormap.ts";
 import * as lib from "./lib.ts";
-import type { Model, VolumeModel } from "./types.ts";
+import type { Model, NDArray, VolumeModel } from "./types.ts";
+
+interface Region {
+	offset: [number, number, number];
+	shape: [number, number, number];
+	dtype: NDArray["dtype"];
+}
+
+/**
+ * Write a block of voxels sent from Python into the image data.
+ *
+ * The block is in the voxel order of the file (first index fastest),
+ * so we can copy it row by row.
+ */
+function write_region(
+	volume: niivue.NVImage,
+	region: Region,
+	data: DataView,
+) {
+	const img = volume.img;
+	if (!img || !volume.hdr) {
+		return;
+	}
+	const [, nx, ny, nz] = volume.hdr.dims;
+	const [ox, oy, oz] = region.offset;
+	const [sx, sy, sz] = region.shape;
+	if (ox + sx > nx || oy + sy > ny || oz + sz > nz) {
+		throw new Error(
+			`Region [${region.offset}] + [${region.shape}] is outside of the image [${nx},${ny},${nz}]`,
+		);
+	}
+	const values = lib.typed_array({ dtype: region.dtype, shape: [], data });
+	for (let z = 0; z < sz; z++) {
+		for (let y = 0; y < sy; y++) {
+			const src = (z * sy + y) * sx;
+			const dst = ((z + oz) * ny + (y + oy)) * nx + ox;
+			img.set(values.subarray(src, src + sx), dst);
+		}
+	}
+}
 
 /**
  * Create a new NVImage and attach the necessary event listeners
  * Returns the NVImage and a cleanup function that removes the event listeners.
  */
-function create_volume(
+async function create_volume(
 	nv: niivue.Niivue,
 	vmodel: VolumeModel,
-): [niivue.NVImage, () => void] {
+	release: boolean,
+): Promise<[niivue.NVImage, () => void]> {
 	const volume = new niivue.NVImage(
-		vmodel.get("path").data.buffer, // dataBuffer
+		await lib.payload_buffer(vmodel, vmodel.get("path")), // dataBuffer
 		lib.unique_id(vmodel), // name
 		vmodel.get("colormap"), // colormap
 		vmodel.get("opacity"), // opacity
@@ -31,67 +72,183 @@ function create_volume(
 		undefined, // colormapLabel
 	);
 
+	if (release) {
+		lib.release_payload(vmodel.get("path"));
+	}
+
+	const lut = colormaps.label_lut(vmodel.get("colormap_label"));
+	if (lut) {
+		volume.setColormapLabel(lut);
+	}
+
 	vmodel.set("id", volume.id);
 	vmodel.set("name", volume.name);
 	vmodel.save_changes();
 
+	// Properties (e.g. linked to a slider) and regions can be changed many
+	// times per second, so we only refresh the textures once per frame.
+	let frame: number | undefined;
+	function update_gl() {
+		if (frame === undefined) {
+			frame = requestAnimationFrame(() => {
+				frame = undefined;
+				nv.updateGLVolume();
+			});
+		}
+	}
+
 	function colorbar_visible_changed() {
 		volume.colorbarVisible = vmodel.get("colorbar_visible");
-		nv.updateGLVolume();
+		update_gl();
 	}
 	function cal_min_changed() {
 		volume.cal_min = vmodel.get("cal_min");
-		nv.updateGLVolume();
+		update_gl();
 	}
 	function cal_max_changed() {
-		volume.cal_min = vmodel.get("cal_min");
-		nv.updateGLVolume();
+		volume.cal_max = vmodel.get("cal_max");
+		update_gl();
 	}
 	function colormap_changed() {
 		volume.colormap = vmodel.get("colormap");
-		nv.updateGLVolume();
+		update_gl();
+	}
+	function colormap_label_changed() {
+		const lut = colormaps.label_lut(vmodel.get("colormap_label"));
+		if (lut) {
+			volume.setColormapLabel(lut);
+		} else {
+			volume.colormapLabel = null;
+		}
+		update_gl();
+	}
+	function label_lut_changed(name: string) {
+		if (name === vmodel.get("colormap_label")) {
+			colormap_label_changed();
+		}
 	}
 	function opacity_changed() {
 		volume.opacity = vmodel.get("opacity");
-		nv.updateGLVolume();
+		update_gl();
+	}
+	function custom_msg(
+		msg: { type: string; data: Region },
+		buffers: Array<DataView>,
+	) {
+		if (msg.type !== "update_region") {
+			return;
+		}
+		write_region(volume, msg.data, buffers[0]);
+		update_gl();
 	}
 
 	vmodel.on("change:colorbar_visible", colorbar_visible_changed);
 	vmodel.on("change:cal_min", cal_min_changed);
 	vmodel.on("change:cal_max", cal_max_changed);
 	vmodel.on("change:colormap", colormap_changed);
+	vmodel.on("change:colormap_label", colormap_label_changed);
 	vmodel.on("change:opacity", opacity_changed);
+	vmodel.on("msg:custom", custom_msg);
+	// the regions written from Python are not in the file, so Python
+	// sends them again whenever the volume is built
+	vmodel.send({ type: "request_regions" });
+	const off_label_lut = colormaps.on_label_lut_changed(label_lut_changed);
 	return [
 		volume,
 		() => {
+			off_label_lut();
 			vmodel.off("change:colorbar_visible", colorbar_visible_changed);
 			vmodel.off("change:cal_min", cal_min_changed);
 			vmodel.off("change:cal_max", cal_max_changed);
 			vmodel.off("change:colormap", colormap_changed);
+			vmodel.off("change:colormap_label", colormap_label_changed);
 			vmodel.off("change:opacity", opacity_changed);
+			vmodel.off("msg:custom", custom_msg);
+			if (frame !== undefined) {
+				cancelAnimationFrame(frame);
+			}
 		},
 	];
 }
 
+function footprint(volume: niivue.NVImage): lib.Footprint {
+	const voxels = volume.img?.length ?? 0;
+	return {
+		cpu: volume.img?.byteLength ?? 0,
+		// Niivue uploads each volume as an RGBA texture
+		gpu: voxels * 4,
+	};
+}
+
+/**
+ * A volume that the residency manager can evict and load again.
+ *
+ * The volume is rebuilt whenever its file is sent again from Python
+ * (e.g. when it is downcast or cropped differently), so that the voxels
+ * (and the offsets of `update_region`) match what Python sent.
+ */
+function volume_layer(
+	nv: niivue.Niivue,
+	vmodel: VolumeModel,
+	disposer: lib.Disposer,
+	residency: lib.Residency,
+	release: boolean,
+): lib.ResidentLayer {
+	let volume: niivue.NVImage | undefined;
+	function path_changed() {
+		residency.reload(layer);
+	}
+	function unload() {
+		if (volume) {
+			disposer.dispose(volume);
+			nv.removeVolume(volume);
+			volume = undefined;
+		}
+	}
+	const layer: lib.ResidentLayer = {
+		kind: "volume",
+		model: vmodel,
+		hidden: () => vmodel.get("opacity") === 0,
+		async load(index: number) {
+			unload();
+			const [created, cleanup] = await create_volume(nv, vmodel, release);
+			vmodel.on("change:path", path_changed);
+			disposer.register(created, () => {
+				cleanup();
+				vmodel.off("change:path", path_changed);
+			});
+			nv.addVolume(created);
+			if (index < nv.volumes.length - 1) {
+				nv.setVolume(created, index);
+			}
+			volume = created;
+			return footprint(created);
+		},
+		unload,
+	};
+	return layer;
+}
+
 export async function render_volumes(
 	nv: niivue.Niivue,
 	model: Model,
 	disposer: lib.Disposer,
+	residency: lib.Residency,
 ) {
 	const vmodels = await lib.gather_models<VolumeModel>(
 		model,
 		model.get("_volumes"),
 	);
-	const curr_names = nv.volumes.map((v) => v.name);
+	const release = model.get("release_buffers");
+	// evicted volumes are not in the scene, but they are still there
+	const curr_names = residency.names("volume");
 	const new_names = vmodels.map(lib.unique_id);
 	const update_type = lib.determine_update_type(curr_names, new_names);
 	if (update_type === "add") {
 		// We know that the new volumes are the same as the old volumes,
 		// except for the last one. We can just add the last volume.
 		const vmodel = vmodels[vmodels.length - 1];
-		const [volume, cleanup] = create_volume(nv, vmodel);
-		disposer.register(volume, cleanup);
-		nv.addVolume(volume);
+		await residency.add(volume_layer(nv, vmodel, disposer, residency, release));
 		return;
 	}
 	// HERE can be the place to add more update types
@@ -101,12 +258,10 @@ export async function render_volumes(
 	// and add the new ones.
 
 	// clear all volumes
-	disposer.disposeAll("image");
+	residency.clear("volume");
 
 	// create each volume and add one-by-one
 	for (const vmodel of vmodels) {
-		const [volume, cleanup] = create_volume(nv, vmodel);
-		disposer.register(volume, cleanup);
-		nv.addVolume(volume);
+		await residency.add(volume_layer(nv, vmodel, disposer, residency, release));
 	}
 }
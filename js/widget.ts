@@ -1,19 +1,52 @@
 import * as niivue from "@niivue/niivue";
-import type { Model } from "./types.ts";
+import type { Model, Scene } from "./types.ts";
 
-import { Disposer } from "./lib.ts";
+import { render_colormaps } from "./colormap.ts";
+import {
+	Disposer,
+	Residency,
+	has_embedded_payloads,
+	held_digests,
+	in_view,
+	released,
+} from "./lib.ts";
 import { render_meshes } from "./mesh.ts";
 import { render_volumes } from "./volume.ts";
 
+/**
+ * Restore the camera and crosshair saved from Python.
+ */
+function apply_scene(nv: niivue.Niivue, scene: Scene) {
+	if (scene.azimuth !== undefined && scene.elevation !== undefined) {
+		nv.setRenderAzimuthElevation(scene.azimuth, scene.elevation);
+	}
+	if (scene.crosshair) {
+		nv.scene.crosshairPos = Float32Array.from(scene.crosshair);
+	}
+	if (scene.zoom) {
+		nv.scene.volScaleMultiplier = scene.zoom;
+	}
+	nv.drawScene();
+}
+
 export default {
 	async render({ model, el }: { model: Model; el: HTMLElement }) {
 		const disposer = new Disposer();
+		// Python forgets the payloads that a previous view (e.g. before the
+		// page was reloaded) reported, this one reports its own once loaded.
+		model.send({ event: "view_connected" });
 		const canvas = document.createElement("canvas");
 		const container = document.createElement("div");
 		container.style.height = `${model.get("height")}px`;
 		container.appendChild(canvas);
 		el.appendChild(container);
 
+		// In a static export, only build the viewers that are looked at,
+		// so that the page opens quickly whatever the number of viewers.
+		if (has_embedded_payloads()) {
+			await in_view(container);
+		}
+
 		const nv = new niivue.Niivue(model.get("_opts") ?? {});
 		nv.attachToCanvas(canvas);
 
@@ -155,10 +188,56 @@ export default {
       })
     };
 
-		await render_volumes(nv, model, disposer);
-		model.on("change:_volumes", () => render_volumes(nv, model, disposer));
-		await render_meshes(nv, model, disposer);
-		model.on("change:_meshes", () => render_meshes(nv, model, disposer));
+    nv.onZoom3DChange = function (zoom: number) {
+      model.send({
+        event: "zoom_3d_change",
+        data: { zoom },
+      })
+    };
+
+		// Let Python know which payloads we can reuse, so it
+		// doesn't send them again, and how many bytes we released.
+		function report_payloads() {
+			model.send({
+				event: "payloads",
+				data: { digests: held_digests(), released: released() },
+			});
+		}
+
+		// Evict volumes and meshes when they use more memory than the budget,
+		// and let Python know how much memory is used.
+		const residency = new Residency((usage) => {
+			model.send({ event: "memory_usage", data: usage });
+		});
+		residency.budget = model.get("memory_budget");
+		model.on("change:memory_budget", () => {
+			residency.budget = model.get("memory_budget");
+		});
+
+		const dispose_colormaps = await render_colormaps(nv, model);
+		let volumes_rendered = render_volumes(nv, model, disposer, residency);
+		await volumes_rendered;
+		model.on("change:_volumes", () => {
+			volumes_rendered = render_volumes(nv, model, disposer, residency);
+			volumes_rendered.then(report_payloads);
+		});
+		let meshes_rendered = render_meshes(nv, model, disposer, residency);
+		await meshes_rendered;
+		model.on("change:_meshes", () => {
+			meshes_rendered = render_meshes(nv, model, disposer, residency);
+			meshes_rendered.then(report_payloads);
+		});
+		apply_scene(nv, model.get("_scene"));
+		report_payloads();
+
+		model.on("change:_scene", () => {
+			// The scene is restored together with the volumes and meshes,
+			// so we wait for them to be loaded before applying it.
+			queueMicrotask(async () => {
+				await Promise.all([volumes_rendered, meshes_rendered]);
+				apply_scene(nv, model.get("_scene"));
+			});
+		});
 
 		// Any time we change the options, we need to update the nv object
 		// and redraw the scene.
@@ -183,9 +262,13 @@ export default {
 
 		// All the logic for cleaning up the event listeners and the nv object
 		return () => {
+			residency.clear();
 			disposer.disposeAll();
+			dispose_colormaps();
 			model.off("change:_volumes");
 			model.off("change:_opts");
+			model.off("change:_scene");
+			model.off("change:memory_budget");
 		};
 	},
 };
@@ -2,7 +2,15 @@
 
 import importlib.metadata
 
+from ._bindings import Binding  # noqa: F401
+from ._colormaps import register_colormap, register_label_lut  # noqa: F401
 from ._constants import DragMode, MuliplanarType, SliceType  # noqa: F401
-from ._widget import NiiVue, WidgetObserver  # noqa: F401
+from ._dicom import DicomSeries, dicom_series, dicom_to_nifti  # noqa: F401
+from ._export import embed_state, export_html  # noqa: F401
+from ._nifti import NiftiIndex, read_nifti_header  # noqa: F401
+from ._payload import clear_caches, set_cache_limits  # noqa: F401
+from ._reduce import Reduction  # noqa: F401
+from ._testing import CommRecorder, FakeFrontend, load_recording  # noqa: F401
+from ._widget import Mesh, NiiVue, Volume, WidgetObserver  # noqa: F401
 
 __version__ = importlib.metadata.version("ipyniivue")
@@ -0,0 +1,149 @@
+import asyncio
+import re
+import time
+import typing
+
+import ipywidgets
+
+__all__ = ["Binding"]
+
+_TOKEN = re.compile(r"(?:^|\.)([A-Za-z_]\w*)|\[(-?\d+)\]")
+
+# the pending value when there is none
+_NOTHING = object()
+
+
+def _parse_path(path: str) -> typing.List[typing.Union[str, int]]:
+    """Split a path like ``"volumes[0].cal_max"`` into attributes and indices."""
+    tokens = []
+    end = 0
+    for match in _TOKEN.finditer(path):
+        if match.start() != end:
+            break
+        name, index = match.groups()
+        tokens.append(name if name is not None else int(index))
+        end = match.end()
+    if not tokens or end != len(path) or not isinstance(tokens[-1], str):
+        raise ValueError(f"Invalid path: {path!r}, expected e.g. 'volumes[0].cal_max'")
+    return tokens
+
+
+def _resolve(obj, tokens: typing.Sequence[typing.Union[str, int]]):
+    for token in tokens:
+        obj = obj[token] if isinstance(token, int) else getattr(obj, token)
+    return obj
+
+
+def _running_loop() -> typing.Optional[asyncio.AbstractEventLoop]:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+class Binding:
+    """Set a property of a viewer from the ``value`` of a control.
+
+    Unlike `WidgetObserver`, intermediate values are dropped: while the
+    control changes, the property is set at most once every `throttle_ms`,
+    to the latest value. Create bindings with `NiiVue.bind`.
+
+    Parameters
+    ----------
+    widget : ipywidgets.Widget
+        The control, e.g. a slider.
+    root : object
+        The object that `path` starts from.
+    path : str
+        The property to set, e.g. ``"volumes[0].cal_max"`` or
+        ``"crosshair_width"``.
+    throttle_ms : int, optional
+        The minimum time between two updates, in milliseconds.
+    mode : {"latest", "debounce"}, optional
+        With "latest", the first value is set immediately, then the latest
+        value at most once every `throttle_ms`. With "debounce", the value
+        is only set once the control has not changed for `throttle_ms`.
+    js : bool, optional
+        If `True`, link the control to the property in the browser, without
+        going through the kernel. The property must be a synced trait of a
+        widget (e.g. a volume's ``cal_max``), and `path` is resolved once.
+    """
+
+    def __init__(
+        self,
+        widget,
+        root,
+        path: str,
+        throttle_ms: int = 30,
+        mode: str = "latest",
+        js: bool = False,
+    ):
+        if mode not in ("latest", "debounce"):
+            raise ValueError(f"Invalid mode: {mode!r}, expected 'latest' or 'debounce'")
+        self.widget = widget
+        self.root = root
+        self.path = path
+        self.throttle_ms = throttle_ms
+        self.mode = mode
+        self._tokens = _parse_path(path)
+        self._pending = _NOTHING
+        self._handle: typing.Optional[asyncio.TimerHandle] = None
+        self._last = float("-inf")
+        self._link = None
+        if js:
+            self._link = self._js_link()
+        else:
+            widget.observe(self._changed, names=["value"])
+
+    def _js_link(self):
+        *parents, attribute = self._tokens
+        target = _resolve(self.root, parents)
+        if not isinstance(target, ipywidgets.Widget) or attribute not in target.keys:
+            raise ValueError(
+                f"{self.path!r} is not a synced widget trait, "
+                "it cannot be linked in the browser"
+            )
+        return ipywidgets.jsdlink((self.widget, "value"), (target, attribute))
+
+    def _changed(self, change):
+        self._pending = change["new"]
+        loop = _running_loop()
+        # without an event loop (e.g. outside of a kernel), nothing is throttled
+        if loop is None or self.throttle_ms <= 0:
+            self._flush()
+            return
+        delay = self.throttle_ms / 1000
+        if self.mode == "debounce":
+            if self._handle is not None:
+                self._handle.cancel()
+            self._handle = loop.call_later(delay, self._flush)
+            return
+        if self._handle is not None:
+            # the latest value is set when the timer fires
+            return
+        wait = self._last + delay - time.monotonic()
+        if wait <= 0:
+            self._flush()
+        else:
+            self._handle = loop.call_later(wait, self._flush)
+
+    def _flush(self):
+        self._handle = None
+        if self._pending is _NOTHING:
+            return
+        value, self._pending = self._pending, _NOTHING
+        self._last = time.monotonic()
+        *parents, attribute = self._tokens
+        setattr(_resolve(self.root, parents), attribute, value)
+
+    def unlink(self):
+        """Stop updating the property."""
+        if self._link is not None:
+            self._link.unlink()
+            self._link = None
+            return
+        self.widget.unobserve(self._changed, names=["value"])
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._pending = _NOTHING
@@ -0,0 +1,134 @@
+import typing
+
+import ipywidgets
+import numpy as np
+import traitlets as t
+
+from ._utils import array_serializer
+
+__all__ = ["register_colormap", "register_label_lut"]
+
+
+class Colormap(ipywidgets.Widget):
+    """A colormap or label lookup table, sent to the frontend once."""
+
+    name = t.Unicode().tag(sync=True)
+    rgba = t.Instance(np.ndarray).tag(sync=True, to_json=array_serializer)
+    indices = t.Instance(np.ndarray, allow_none=True).tag(
+        sync=True, to_json=array_serializer
+    )
+    labels = t.List(t.Unicode(), default_value=[]).tag(sync=True)
+    is_label = t.Bool(False).tag(sync=True)
+
+
+class ColormapRegistry(ipywidgets.Widget):
+    """All the colormaps registered in the kernel.
+
+    A single registry is shared by every `NiiVue` widget, so that each
+    colormap is only sent once and cached by the frontend.
+    """
+
+    colormaps = t.List(t.Instance(Colormap), default_value=[]).tag(
+        sync=True, **ipywidgets.widget_serialization
+    )
+
+    def register(self, colormap: Colormap):
+        # replace any colormap with the same name
+        replaced = [
+            c for c in self.colormaps if c.name == colormap.name and c is not colormap
+        ]
+        self.colormaps = [
+            *(c for c in self.colormaps if c.name != colormap.name),
+            colormap,
+        ]
+        # the frontend has the new list, so the old widgets can go
+        for c in replaced:
+            c.close()
+
+
+_registry: typing.Optional[ColormapRegistry] = None
+
+
+def get_colormap_registry() -> ColormapRegistry:
+    """Return the registry shared by all widgets in this kernel."""
+    global _registry
+    if _registry is None:
+        _registry = ColormapRegistry()
+    return _registry
+
+
+def _as_rgba255(rgba) -> np.ndarray:
+    rgba = np.asarray(rgba)
+    if rgba.ndim != 2 or rgba.shape[1] not in (3, 4):
+        raise ValueError(f"rgba must have shape (N, 3) or (N, 4), got {rgba.shape}")
+    if np.issubdtype(rgba.dtype, np.floating):
+        # colors given in the range 0-1
+        rgba = np.round(rgba * 255)
+    if rgba.shape[1] == 3:
+        rgba = np.column_stack([rgba, np.full(len(rgba), 255)])
+    return np.ascontiguousarray(np.clip(rgba, 0, 255), dtype=np.uint8)
+
+
+def register_colormap(name: str, rgba):
+    """Register a colormap that volumes and mesh layers can use by name.
+
+    The colormap is sent to the frontend once as a binary buffer, and
+    shared by all the `NiiVue` widgets of the kernel.
+
+    Parameters
+    ----------
+    name : str
+        The name to use as `colormap` for volumes and mesh layers.
+    rgba : array_like
+        An (N, 4) or (N, 3) array of colors, either as integers in the
+        range 0-255 or as floats in the range 0-1. The colors are spread
+        evenly from the lowest to the highest intensity.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> register_colormap("reds", np.linspace([0, 0, 0, 0], [255, 0, 0, 255], 8))
+    >>> nv.load_volumes([{"path": "mni152.nii.gz", "colormap": "reds"}])
+    """
+    rgba = _as_rgba255(rgba)
+    if len(rgba) < 2:
+        raise ValueError("A colormap needs at least 2 colors")
+    get_colormap_registry().register(Colormap(name=name, rgba=rgba))
+
+
+def register_label_lut(name: str, rgba, labels=None, indices=None):
+    """Register a label lookup table that volumes can use by name.
+
+    The table is sent to the frontend once as a binary buffer, and shared
+    by all the `NiiVue` widgets of the kernel, so large atlases are not
+    sent again for every volume. Volumes can use a table before it is
+    registered, it is applied as soon as it is.
+
+    Parameters
+    ----------
+    name : str
+        The name to use as `colormap_label` for volumes.
+    rgba : array_like
+        An (N, 4) or (N, 3) array with the color of each label, either as
+        integers in the range 0-255 or as floats in the range 0-1.
+    labels : list of str, optional
+        The name of each label.
+    indices : array_like, optional
+        The voxel value of each label. Defaults to ``0, 1, ..., N - 1``.
+    """
+    rgba = _as_rgba255(rgba)
+    if labels is not None and len(labels) != len(rgba):
+        raise ValueError(f"Expected {len(rgba)} labels, got {len(labels)}")
+    if indices is not None:
+        indices = np.ascontiguousarray(indices, dtype=np.int32)
+        if indices.shape != (len(rgba),):
+            raise ValueError(f"Expected {len(rgba)} indices, got {indices.shape}")
+    get_colormap_registry().register(
+        Colormap(
+            name=name,
+            rgba=rgba,
+            indices=indices,
+            labels=list(labels or []),
+            is_label=True,
+        )
+    )
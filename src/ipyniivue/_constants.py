@@ -35,3 +35,22 @@ _SNAKE_TO_CAMEL_OVERRIDES = {
     "is_slice_mm": "isSliceMM",
     "limit_frames_4d": "limitFrames4D",
 }
+
+# the options whose values are enums, by their JS camelCase name
+_ENUM_OPTIONS = {
+    "dragMode": DragMode,
+    "multiplanarLayout": MuliplanarType,
+    "sliceType": SliceType,
+}
+
+# dtypes that can be sent as a JavaScript typed array
+_TYPED_ARRAY_DTYPES = {
+    "uint8",
+    "int8",
+    "uint16",
+    "int16",
+    "uint32",
+    "int32",
+    "float32",
+    "float64",
+}
@@ -0,0 +1,441 @@
+import concurrent.futures
+import hashlib
+import os
+import pathlib
+import re
+import struct
+import typing
+
+import numpy as np
+
+from ._nifti import nifti_bytes
+
+__all__ = ["DicomSeries", "dicom_series", "dicom_to_nifti"]
+
+# transfer syntaxes that can be read without a codec, and whether the VR
+# of each element is explicit
+_TRANSFER_SYNTAXES = {
+    "1.2.840.10008.1.2": False,
+    "1.2.840.10008.1.2.1": True,
+}
+# explicit VRs with a 4 bytes length
+_LONG_VRS = {
+    b"OB",
+    b"OD",
+    b"OF",
+    b"OL",
+    b"OV",
+    b"OW",
+    b"SQ",
+    b"UC",
+    b"UN",
+    b"UR",
+    b"UT",
+}
+_UNDEFINED_LENGTH = 0xFFFFFFFF
+
+_ITEM = (0xFFFE, 0xE000)
+_ITEM_END = (0xFFFE, 0xE00D)
+_SEQUENCE_END = (0xFFFE, 0xE0DD)
+_PIXEL_DATA = (0x7FE0, 0x0010)
+_TRANSFER_SYNTAX = (0x0002, 0x0010)
+
+_TAGS = {
+    (0x0008, 0x103E): "SeriesDescription",
+    (0x0018, 0x0050): "SliceThickness",
+    (0x0020, 0x000E): "SeriesInstanceUID",
+    (0x0020, 0x0013): "InstanceNumber",
+    (0x0020, 0x0032): "ImagePositionPatient",
+    (0x0020, 0x0037): "ImageOrientationPatient",
+    (0x0028, 0x0002): "SamplesPerPixel",
+    (0x0028, 0x0010): "Rows",
+    (0x0028, 0x0011): "Columns",
+    (0x0028, 0x0030): "PixelSpacing",
+    (0x0028, 0x0100): "BitsAllocated",
+    (0x0028, 0x0103): "PixelRepresentation",
+    (0x0028, 0x1052): "RescaleIntercept",
+    (0x0028, 0x1053): "RescaleSlope",
+}
+_US = {"SamplesPerPixel", "Rows", "Columns", "BitsAllocated", "PixelRepresentation"}
+_DS = {
+    "SliceThickness",
+    "ImagePositionPatient",
+    "ImageOrientationPatient",
+    "PixelSpacing",
+    "RescaleIntercept",
+    "RescaleSlope",
+}
+
+# the header of a slice is read from this many bytes, unless it is longer
+_HEADER_BYTES = 1 << 16
+
+
+class _Truncated(Exception):
+    pass
+
+
+class _Unsupported(ValueError):
+    def __init__(self, message: str, elements: typing.Optional[dict] = None):
+        super().__init__(message)
+        # the attributes read before, e.g. to know the series of the file
+        self.elements = elements or {}
+
+
+class DicomSeries(typing.NamedTuple):
+    """The slices of a DICOM series in a directory."""
+
+    uid: str
+    description: str
+    files: typing.List[pathlib.Path]
+    # the files that cannot be decoded (e.g. compressed), and why
+    unsupported: typing.Dict[pathlib.Path, str]
+
+
+def _value(name: str, raw: bytes):
+    if name in _US:
+        return struct.unpack_from("<H", raw)[0]
+    text = raw.decode("latin-1").strip("\0 ")
+    if name in _DS:
+        values = [float(v) for v in text.split("\\") if v.strip()]
+        return values if len(values) > 1 else (values[0] if values else None)
+    if name == "InstanceNumber":
+        return int(text) if text else None
+    return text
+
+
+def _read_elements(
+    data: bytes,
+    pos: int,
+    explicit: bool,
+    elements: typing.Optional[dict],
+    end: typing.Optional[tuple] = None,
+) -> typing.Tuple[int, typing.Optional[typing.Tuple[int, int]]]:
+    """Read data elements until `end`, or until the pixel data.
+
+    The values of the tags in `_TAGS` are stored in `elements`. Returns the
+    position after the last element read, and the offset and length of the
+    pixel data, if reached.
+    """
+    while pos < len(data):
+        if pos + 8 > len(data):
+            raise _Truncated
+        tag = struct.unpack_from("<HH", data, pos)
+        if explicit and tag[0] != 0xFFFE:
+            vr = data[pos + 4 : pos + 6]
+            if vr in _LONG_VRS:
+                (length,) = struct.unpack_from("<I", data, pos + 8)
+                pos += 12
+            else:
+                (length,) = struct.unpack_from("<H", data, pos + 6)
+                pos += 8
+        else:
+            (length,) = struct.unpack_from("<I", data, pos + 4)
+            pos += 8
+        if tag == end:
+            return pos, None
+        if tag == _PIXEL_DATA and elements is not None:
+            if length == _UNDEFINED_LENGTH:
+                raise _Unsupported("Compressed pixel data is not supported")
+            return pos, (pos, length)
+        if length == _UNDEFINED_LENGTH:
+            # a sequence, or an item of a sequence, whose values are skipped
+            pos, _ = _read_elements(
+                data, pos, explicit, None, _ITEM_END if tag == _ITEM else _SEQUENCE_END
+            )
+            continue
+        if pos + length > len(data):
+            raise _Truncated
+        name = _TAGS.get(tag)
+        if name is not None and elements is not None:
+            elements[name] = _value(name, data[pos : pos + length])
+        pos += length
+    if end is not None:
+        raise _Truncated
+    return pos, None
+
+
+def _parse(data: bytes) -> typing.Tuple[dict, typing.Optional[typing.Tuple[int, int]]]:
+    pos, explicit, unsupported = 0, False, None
+    if data[128:132] == b"DICM":
+        # the file meta information is always explicit VR little endian
+        pos = 132
+        syntax = None
+        while pos + 8 <= len(data) and struct.unpack_from("<H", data, pos)[0] == 2:
+            tag = struct.unpack_from("<HH", data, pos)
+            vr = data[pos + 4 : pos + 6]
+            if vr in _LONG_VRS:
+                (length,) = struct.unpack_from("<I", data, pos + 8)
+                pos += 12
+            else:
+                (length,) = struct.unpack_from("<H", data, pos + 6)
+                pos += 8
+            if tag == _TRANSFER_SYNTAX:
+                syntax = data[pos : pos + length].decode("ascii").strip("\0 ")
+            pos += length
+        if syntax in _TRANSFER_SYNTAXES:
+            explicit = _TRANSFER_SYNTAXES[syntax]
+        else:
+            # the compressed syntaxes are explicit VR little endian, so the
+            # attributes are still read, to know the series of the file
+            unsupported = f"Unsupported transfer syntax: {syntax}"
+            explicit = True
+    elements: dict = {}
+    try:
+        _, pixels = _read_elements(data, pos, explicit, elements)
+    except _Unsupported as e:
+        raise _Unsupported(unsupported or str(e), elements) from None
+    if unsupported is not None and pixels is not None:
+        raise _Unsupported(unsupported, elements)
+    return elements, pixels
+
+
+def _read_header(
+    path: pathlib.Path,
+) -> typing.Optional[typing.Tuple[dict, typing.Optional[str]]]:
+    """Read the attributes of a slice, or `None` if it is not an image.
+
+    Also returns why the slice cannot be decoded, if it cannot.
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read(_HEADER_BYTES)
+            try:
+                elements, pixels = _parse(data)
+            except (_Truncated, struct.error):
+                elements, pixels = _parse(data + f.read())
+    except _Unsupported as e:
+        if "SeriesInstanceUID" not in e.elements:
+            return None
+        return e.elements, str(e)
+    except (_Truncated, struct.error, UnicodeDecodeError, ValueError):
+        return None
+    if pixels is None or "SeriesInstanceUID" not in elements:
+        return None
+    return elements, None
+
+
+def _read_slice(path: pathlib.Path) -> typing.Tuple[dict, np.ndarray]:
+    """Read the attributes and pixels of a slice."""
+    data = path.read_bytes()
+    elements, pixels = _parse(data)
+    if pixels is None:
+        raise ValueError(f"{path} has no pixel data")
+    if elements.get("SamplesPerPixel", 1) != 1:
+        raise ValueError(f"{path}: only grayscale images are supported")
+    bits = elements.get("BitsAllocated", 16)
+    if bits not in (8, 16, 32):
+        raise ValueError(f"{path}: unsupported BitsAllocated {bits}")
+    kind = "i" if elements.get("PixelRepresentation", 0) else "u"
+    rows, columns = elements["Rows"], elements["Columns"]
+    offset, _ = pixels
+    array = np.frombuffer(
+        data, dtype=f"<{kind}{bits // 8}", count=rows * columns, offset=offset
+    )
+    return elements, array.reshape(rows, columns)
+
+
+def _map(function, paths, max_workers):
+    max_workers = max_workers or os.cpu_count() or 1
+    # a few chunks per process, so that pickling does not dominate
+    chunksize = max(1, len(paths) // (4 * max_workers))
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        return list(executor.map(function, paths, chunksize=chunksize))
+
+
+def dicom_series(
+    directory: typing.Union[pathlib.Path, str],
+    max_workers: typing.Optional[int] = None,
+) -> typing.Dict[str, DicomSeries]:
+    """Group the DICOM images in a directory by series.
+
+    Only the headers are read, in a pool of processes. Files that are not
+    DICOM images (e.g. a DICOMDIR) are ignored. Images that cannot be
+    decoded (e.g. compressed ones) are listed in the ``unsupported`` files
+    of their series.
+
+    Parameters
+    ----------
+    directory : path
+        The directory, which is searched recursively.
+    max_workers : int, optional
+        The number of processes. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    dict of str to DicomSeries
+        The series by SeriesInstanceUID.
+    """
+    directory = pathlib.Path(directory)
+    if not directory.is_dir():
+        raise FileNotFoundError(f"No such directory: {directory}")
+    paths = sorted(p for p in directory.rglob("*") if p.is_file())
+    series: typing.Dict[str, DicomSeries] = {}
+    for i, read in enumerate(_map(_read_header, paths, max_workers)):
+        path = paths[i]
+        if read is None:
+            continue
+        header, unsupported = read
+        uid = header["SeriesInstanceUID"]
+        if uid not in series:
+            description = header.get("SeriesDescription", "")
+            series[uid] = DicomSeries(uid, description, [], {})
+        series[uid].files.append(path)
+        if unsupported is not None:
+            series[uid].unsupported[path] = unsupported
+    return series
+
+
+def _sort_slices(
+    headers: typing.List[dict],
+) -> typing.Tuple[list, typing.Optional[np.ndarray]]:
+    """Order the slices along their normal, and return their positions."""
+    orientation = headers[0].get("ImageOrientationPatient") or [1, 0, 0, 0, 1, 0]
+    normal = np.cross(orientation[:3], orientation[3:])
+    positions = [h.get("ImagePositionPatient") for h in headers]
+    if all(p is not None for p in positions):
+        positions = np.array(positions, dtype=np.float64)
+        order = np.argsort(positions @ normal, kind="stable")
+    else:
+        positions = None
+        order = np.argsort(
+            [h.get("InstanceNumber") or 0 for h in headers], kind="stable"
+        )
+    return list(order), (None if positions is None else positions[order])
+
+
+def _affine(
+    headers: typing.List[dict], positions: typing.Optional[np.ndarray]
+) -> np.ndarray:
+    """Return the voxel to RAS transform of the stacked slices."""
+    first = headers[0]
+    orientation = np.array(
+        first.get("ImageOrientationPatient") or [1, 0, 0, 0, 1, 0], dtype=np.float64
+    )
+    row_spacing, column_spacing = first.get("PixelSpacing") or (1.0, 1.0)
+    normal = np.cross(orientation[:3], orientation[3:])
+    if positions is not None and len(positions) > 1:
+        step = (positions[-1] - positions[0]) / (len(positions) - 1)
+    else:
+        step = normal * (first.get("SliceThickness") or 1.0)
+    lps = np.eye(4)
+    # along a row (i), the column index increases, and vice versa
+    lps[:3, 0] = orientation[:3] * column_spacing
+    lps[:3, 1] = orientation[3:] * row_spacing
+    lps[:3, 2] = step
+    if positions is not None:
+        lps[:3, 3] = positions[0]
+    # DICOM patient coordinates are LPS, NIfTI world coordinates are RAS
+    return np.diag([-1.0, -1.0, 1.0, 1.0]) @ lps
+
+
+def _default_cache_dir() -> pathlib.Path:
+    base = os.environ.get("XDG_CACHE_HOME") or pathlib.Path.home() / ".cache"
+    return pathlib.Path(base) / "ipyniivue" / "dicom"
+
+
+def dicom_to_nifti(
+    directory: typing.Union[pathlib.Path, str],
+    series_uid: typing.Optional[str] = None,
+    cache_dir: typing.Union[pathlib.Path, str, None] = None,
+    max_workers: typing.Optional[int] = None,
+) -> pathlib.Path:
+    """Convert a DICOM series to a NIfTI file, cached by series UID.
+
+    The slices are decoded in a pool of processes, sorted along the slice
+    normal and stacked into one volume. Only uncompressed, little endian
+    transfer syntaxes are supported.
+
+    Parameters
+    ----------
+    directory : path
+        The directory containing the series.
+    series_uid : str, optional
+        The SeriesInstanceUID of the series, required if the directory
+        contains more than one.
+    cache_dir : path, optional
+        Where the NIfTI files are written. Defaults to
+        ``$XDG_CACHE_HOME/ipyniivue/dicom``. A cached file is reused as long
+        as the series is made of the same slice files, with the same sizes
+        and modification times.
+    max_workers : int, optional
+        The number of processes. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    pathlib.Path
+        The NIfTI file.
+    """
+    series = dicom_series(directory, max_workers=max_workers)
+    if not series:
+        raise ValueError(f"No DICOM images in {directory}")
+    if series_uid is None:
+        if len(series) > 1:
+            found = ", ".join(
+                f"{uid} ({s.description or 'no description'}, {len(s.files)} slices)"
+                for uid, s in series.items()
+            )
+            raise ValueError(
+                f"{directory} contains several series, pass one of them "
+                f"as series_uid: {found}"
+            )
+        (series_uid,) = series
+    if series_uid not in series:
+        raise KeyError(f"No series {series_uid!r} in {directory}")
+    files = series[series_uid].files
+    unsupported = series[series_uid].unsupported
+    if unsupported:
+        path, reason = next(iter(unsupported.items()))
+        raise ValueError(
+            f"{len(unsupported)} of the {len(files)} slices of the series "
+            f"{series_uid} cannot be decoded, e.g. {path}: {reason}"
+        )
+
+    cache_dir = (
+        pathlib.Path(cache_dir) if cache_dir is not None else _default_cache_dir()
+    )
+    # the file name records which slices it was built from, so removing,
+    # adding or rewriting a slice (whatever its mtime) builds a new file
+    manifest = hashlib.sha256()
+    for path in sorted(pathlib.Path(f).resolve() for f in files):
+        stat = path.stat()
+        manifest.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    name = re.sub(r"[^\w.]", "_", series_uid)
+    target = cache_dir / f"{name}_{manifest.hexdigest()[:16]}.nii"
+    if target.is_file():
+        return target
+
+    decoded = _map(_read_slice, files, max_workers)
+    if len({(s.shape, s.dtype) for _, s in decoded}) > 1:
+        raise ValueError(
+            f"The slices of the series {series_uid} differ in size or type"
+        )
+    order, positions = _sort_slices([header for header, _ in decoded])
+    decoded = [decoded[i] for i in order]
+    headers = [header for header, _ in decoded]
+    rescale = {(h.get("RescaleSlope"), h.get("RescaleIntercept")) for h in headers}
+    if len(rescale) > 1:
+        # each slice has its own scaling, which NIfTI cannot store
+        slices = [
+            s * np.float32(h.get("RescaleSlope") or 1)
+            + np.float32(h.get("RescaleIntercept") or 0)
+            for h, s in decoded
+        ]
+        slope, intercept = None, None
+    else:
+        slices = [s for _, s in decoded]
+        ((slope, intercept),) = rescale
+    # slices are (rows, columns) in C order, i.e. the column index varies the
+    # fastest, so the transposed stack is indexed as [column, row, slice]
+    volume = np.stack(slices).T
+    data = nifti_bytes(
+        volume,
+        _affine(headers, positions),
+        scl_slope=slope if slope is not None else (1.0 if intercept else 0.0),
+        scl_inter=intercept or 0.0,
+        description=series[series_uid].description,
+    )
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    partial = target.with_suffix(f".{os.getpid()}.partial")
+    partial.write_bytes(data)
+    partial.replace(target)
+    return target
@@ -0,0 +1,134 @@
+import base64
+import gzip
+import html
+import pathlib
+import typing
+
+import numpy as np
+from ipywidgets.embed import dependency_state, embed_snippet, html_template
+
+from ._payload import array_digest, sending_all_payloads
+
+__all__ = ["embed_state", "export_html"]
+
+# each payload is embedded in its own script tag, and only decoded by the
+# frontend when a widget that uses it is rendered
+_PAYLOAD_TEMPLATE = (
+    '<script type="application/octet-stream" '
+    'data-niivue-payload="{digest}" data-encoding="{encoding}">\n{data}\n</script>'
+)
+
+
+# the attributes of meshes whose arrays are embedded like files
+_MESH_ARRAYS = ("vertices", "faces", "colors", "layers")
+
+
+def _parent(state: dict, path: list):
+    for key in path[:-1]:
+        state = state[key]
+    return state
+
+
+def _is_mesh_array(path: list, parent: dict) -> bool:
+    # arrays are dicts with a dtype and a shape, see `array_serializer`
+    return path[0] in _MESH_ARRAYS and "dtype" in parent and "shape" in parent
+
+
+def embed_state(views, drop_defaults: bool = True):
+    """Return the embeddable state of widgets, with their files taken out.
+
+    The bytes of the files of the volumes and meshes, and of the arrays of
+    the meshes (vertices, faces, colors and layer values), are removed from
+    the state, which only keeps their digest, and returned once per digest.
+
+    Parameters
+    ----------
+    views : widget or list of widgets
+        The widgets to embed. The widgets they depend on are included.
+    drop_defaults : bool, optional
+        Whether to drop default values from the widget states.
+
+    Returns
+    -------
+    state : dict
+        The widget manager state, for `ipywidgets.embed.embed_snippet`.
+    payloads : dict of str to bytes
+        The bytes of each file and array, by digest.
+    """
+    with sending_all_payloads():
+        state = dependency_state(views, drop_defaults=drop_defaults)
+    payloads = {}
+    for model in state.values():
+        buffers = []
+        for buffer in model.get("buffers", []):
+            path = buffer["path"]
+            parent = _parent(model["state"], path)
+            # files are dicts with a digest, see `file_serializer`
+            if path[-1] == "data" and "digest" in parent:
+                payloads[parent["digest"]] = base64.b64decode(buffer["data"])
+                parent["data"] = None
+            elif path[-1] == "data" and _is_mesh_array(path, parent):
+                data = base64.b64decode(buffer["data"])
+                array = np.frombuffer(data, parent["dtype"]).reshape(parent["shape"])
+                parent["digest"] = array_digest(array)
+                payloads[parent["digest"]] = data
+                parent["data"] = None
+            else:
+                buffers.append(buffer)
+        if "buffers" in model:
+            model["buffers"] = buffers
+    return state, payloads
+
+
+def _encode(data: bytes, compress_level: int) -> typing.Tuple[str, bytes]:
+    compressed = gzip.compress(data, compresslevel=compress_level, mtime=0)
+    # files that are already compressed (e.g. .nii.gz) are kept as they are
+    if len(compressed) < len(data):
+        return "gzip", compressed
+    return "none", data
+
+
+def export_html(
+    fp,
+    views,
+    title: str = "IPyNiiVue export",
+    compress_level: int = 6,
+    **kwargs,
+):
+    """Write a standalone HTML file with the widgets embedded.
+
+    Unlike `ipywidgets.embed.embed_minimal_html`, each unique file and mesh
+    array is only written once (even if several widgets use it), compressed,
+    and keyed by its digest. The viewers are only rendered when they are scrolled into
+    view, and only then are their files decoded.
+
+    Parameters
+    ----------
+    fp : str, path or file-like object
+        The file to write to.
+    views : widget or list of widgets
+        The widgets to show.
+    title : str, optional
+        The title of the page.
+    compress_level : int, optional
+        The gzip compression level, from 0 (none) to 9 (smallest).
+    **kwargs
+        Passed to `ipywidgets.embed.embed_snippet`.
+    """
+    state, payloads = embed_state(views, kwargs.pop("drop_defaults", True))
+    scripts = []
+    for digest, data in payloads.items():
+        encoding, data = _encode(data, compress_level)
+        scripts.append(
+            _PAYLOAD_TEMPLATE.format(
+                digest=html.escape(digest),
+                encoding=encoding,
+                data=base64.b64encode(data).decode("ascii"),
+            )
+        )
+    snippet = "\n".join([*scripts, embed_snippet(views, state=state, **kwargs)])
+    page = html_template.format(title=html.escape(title), snippet=snippet)
+    if hasattr(fp, "write"):
+        fp.write(page)
+    else:
+        pathlib.Path(fp).write_text(page)
@@ -0,0 +1,494 @@
+import base64
+import gzip
+import hashlib
+import pathlib
+import struct
+import typing
+import warnings
+import xml.etree.ElementTree as ET
+import zlib
+
+import numpy as np
+
+from ._payload import derived_cache, payload_digest, read_payload
+from ._utils import array_serializer, file_serializer, mesh_layers_serializer
+
+__all__ = [
+    "LOD_LEVELS",
+    "decimate_streamlines",
+    "decimate_surface",
+    "read_gifti",
+    "read_mz3",
+    "read_tck",
+    "read_trk",
+    "write_mz3",
+    "write_tck",
+]
+
+# For each level of detail: the fraction of streamlines kept, the step
+# between the points kept along each streamline, and the fraction of
+# surface vertices kept.
+LOD_LEVELS = {
+    "low": (0.05, 4, 0.1),
+    "medium": (0.25, 2, 0.3),
+}
+
+# zoom of the 3D render above which meshes are refined to full detail
+LOD_REFINE_ZOOM = 2.0
+
+
+class Streamlines(typing.NamedTuple):
+    # the (P, 3) points of all the streamlines, in mm
+    points: np.ndarray
+    # the (N + 1,) index of the first point of each streamline
+    offsets: np.ndarray
+
+
+class Surface(typing.NamedTuple):
+    vertices: np.ndarray
+    faces: np.ndarray
+    # the new vertex that each original vertex was merged into
+    clusters: np.ndarray
+
+
+class SurfaceFile(typing.NamedTuple):
+    vertices: np.ndarray
+    faces: np.ndarray
+    # optional per-vertex (N, 4) RGBA colors, and (frames, N) scalars
+    colors: typing.Optional[np.ndarray] = None
+    scalars: typing.Optional[np.ndarray] = None
+
+
+def _cached(key: tuple, compute: typing.Callable[[], typing.Any]):
+    """Return the value derived for `key`, computing it if it is not cached.
+
+    Keys start with the digest of the content they are derived from.
+    """
+    value = derived_cache.get(key)
+    if value is None:
+        value = compute()
+        derived_cache.put(key, value)
+    return value
+
+
+def _split_points(points: np.ndarray) -> Streamlines:
+    """Split TCK-style points, separated by NaN rows and ended by an Inf row."""
+    end = np.flatnonzero(np.isinf(points[:, 0]))
+    if len(end):
+        points = points[: end[0]]
+    separators = np.flatnonzero(np.isnan(points[:, 0]))
+    keep = np.ones(len(points), dtype=bool)
+    keep[separators] = False
+    # the streamlines start after each separator, minus the removed separators
+    starts = np.concatenate([[0], separators + 1]) - np.arange(len(separators) + 1)
+    offsets = np.unique(np.concatenate([starts, [keep.sum()]]))
+    return Streamlines(points[keep].astype(np.float32), offsets)
+
+
+def read_tck(data: bytes) -> Streamlines:
+    """Read the streamlines of a MRtrix TCK file."""
+    header_end = data.find(b"\nEND\n")
+    if not data.startswith(b"mrtrix tracks") or header_end == -1:
+        raise ValueError("Not a TCK file")
+    fields = {}
+    for line in data[:header_end].decode("latin-1").splitlines()[1:]:
+        key, _, value = line.partition(":")
+        fields[key.strip()] = value.strip()
+    dtype = {
+        "Float32LE": "<f4",
+        "Float32BE": ">f4",
+        "Float64LE": "<f8",
+        "Float64BE": ">f8",
+    }[fields.get("datatype", "Float32LE")]
+    offset = int(fields["file"].split()[-1])
+    count = (len(data) - offset) // np.dtype(dtype).itemsize // 3 * 3
+    points = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+    return _split_points(points.reshape(-1, 3))
+
+
+def read_trk(data: bytes) -> Streamlines:
+    """Read the streamlines of a TrackVis TRK file, in world (RAS) mm."""
+    if not data.startswith(b"TRACK"):
+        raise ValueError("Not a TRK file")
+    endian = "<" if np.frombuffer(data, "<i4", 1, 996)[0] == 1000 else ">"
+    voxel_size = np.frombuffer(data, f"{endian}f4", 3, 12)
+    n_scalars = int(np.frombuffer(data, f"{endian}i2", 1, 36)[0])
+    n_properties = int(np.frombuffer(data, f"{endian}i2", 1, 238)[0])
+    vox_to_ras = np.frombuffer(data, f"{endian}f4", 16, 440).reshape(4, 4)
+    if vox_to_ras[3, 3] == 0:
+        vox_to_ras = np.eye(4)
+    words = np.frombuffer(data, f"{endian}i4", (len(data) - 1000) // 4, 1000)
+    floats = words.view(f"{endian}f4")
+    # walk the streamlines to find where the points of each one are
+    stride = 3 + n_scalars
+    starts, lengths = [], []
+    i = 0
+    while i < len(words):
+        n = int(words[i])
+        starts.append(i + 1)
+        lengths.append(n)
+        i += 1 + n * stride + n_properties
+    lengths = np.asarray(lengths, dtype=np.int64)
+    index = np.repeat(np.asarray(starts, dtype=np.int64), lengths)
+    index += (
+        np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    ) * stride
+    points = floats[index[:, None] + np.arange(3)]
+    # "voxmm" coordinates have their origin at the corner of the first voxel
+    affine = vox_to_ras @ _translation(-0.5) @ np.diag([*(1 / voxel_size), 1])
+    points = points @ affine[:3, :3].T + affine[:3, 3]
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    return Streamlines(points.astype(np.float32), offsets)
+
+
+def _translation(value: float) -> np.ndarray:
+    affine = np.eye(4)
+    affine[:3, 3] = value
+    return affine
+
+
+def write_tck(streamlines: Streamlines) -> bytes:
+    """Write streamlines to the bytes of a MRtrix TCK file."""
+    points, offsets = streamlines
+    separators = np.full((len(offsets) - 1, 3), np.nan, dtype="<f4")
+    body = np.insert(points.astype("<f4"), offsets[1:], separators, axis=0)
+    body = np.concatenate([body, np.full((1, 3), np.inf, dtype="<f4")])
+    header = (
+        "mrtrix tracks\n"
+        "datatype: Float32LE\n"
+        f"count: {len(offsets) - 1}\n"
+        "file: . {offset}\n"
+        "END\n"
+    )
+    # the offset is part of the header, so it depends on its own length
+    offset = len(header.format(offset=0))
+    while len(header.format(offset=offset)) > offset:
+        offset += 1
+    header = header.format(offset=offset).encode("latin-1")
+    return header.ljust(offset, b"\0") + body.tobytes()
+
+
+_TRACTOGRAM_READERS = {".tck": read_tck, ".trk": read_trk}
+
+_MZ3_MAGIC = 23117
+# the attributes of a MZ3 file that are stored
+_MZ3_FACES, _MZ3_VERTICES, _MZ3_COLORS, _MZ3_SCALARS, _MZ3_DOUBLE = 1, 2, 4, 8, 16
+
+
+def read_mz3(data: bytes) -> SurfaceFile:
+    """Read the surface of a (possibly gzip compressed) Surfice MZ3 file."""
+    if data[:2] == b"\x1f\x8b":
+        data = gzip.decompress(data)
+    if len(data) < 16:
+        raise ValueError("Not a MZ3 file")
+    magic, attributes, n_faces, n_vertices, n_skip = struct.unpack_from("<HHIII", data)
+    if magic != _MZ3_MAGIC:
+        raise ValueError("Not a MZ3 file")
+    if attributes & (_MZ3_FACES | _MZ3_VERTICES) != _MZ3_FACES | _MZ3_VERTICES:
+        raise ValueError("The MZ3 file has no surface, only per-vertex values")
+    if attributes > 31:
+        raise ValueError("MZ3 lookup tables and ambient occlusion are not supported")
+    pos = 16 + n_skip
+    faces = np.frombuffer(data, "<i4", n_faces * 3, pos).reshape(-1, 3)
+    pos += faces.nbytes
+    vertices = np.frombuffer(data, "<f4", n_vertices * 3, pos).reshape(-1, 3)
+    pos += vertices.nbytes
+    colors = scalars = None
+    if attributes & _MZ3_COLORS:
+        colors = np.frombuffer(data, "u1", n_vertices * 4, pos).reshape(-1, 4)
+        pos += colors.nbytes
+    if attributes & _MZ3_SCALARS:
+        dtype = np.dtype("<f8" if attributes & _MZ3_DOUBLE else "<f4")
+        frames = (len(data) - pos) // (dtype.itemsize * n_vertices)
+        scalars = np.frombuffer(data, dtype, frames * n_vertices, pos)
+        scalars = scalars.reshape(frames, n_vertices)
+    return SurfaceFile(vertices, faces, colors, scalars)
+
+
+def write_mz3(surface: SurfaceFile) -> bytes:
+    """Write a surface to the bytes of a MZ3 file."""
+    attributes = _MZ3_FACES | _MZ3_VERTICES
+    body = [
+        np.asarray(surface.faces, dtype="<i4").tobytes(),
+        np.asarray(surface.vertices, dtype="<f4").tobytes(),
+    ]
+    if surface.colors is not None:
+        attributes |= _MZ3_COLORS
+        body.append(np.asarray(surface.colors, dtype="u1").tobytes())
+    if surface.scalars is not None:
+        attributes |= _MZ3_SCALARS
+        body.append(np.asarray(surface.scalars, dtype="<f4").tobytes())
+    header = struct.pack(
+        "<HHIII", _MZ3_MAGIC, attributes, len(surface.faces), len(surface.vertices), 0
+    )
+    return header + b"".join(body)
+
+
+_GIFTI_DTYPES = {
+    "NIFTI_TYPE_UINT8": "u1",
+    "NIFTI_TYPE_INT16": "i2",
+    "NIFTI_TYPE_INT32": "i4",
+    "NIFTI_TYPE_FLOAT32": "f4",
+    "NIFTI_TYPE_FLOAT64": "f8",
+}
+
+
+def _gifti_array(element: ET.Element) -> np.ndarray:
+    dims = [
+        int(element.get(f"Dim{i}", 1))
+        for i in range(int(element.get("Dimensionality", 1)))
+    ]
+    dtype = np.dtype(_GIFTI_DTYPES[element.get("DataType", "")])
+    encoding = element.get("Encoding", "ASCII")
+    text = element.findtext("Data") or ""
+    if encoding == "ASCII":
+        array = np.array(text.split(), dtype=dtype)
+    elif encoding in ("Base64Binary", "GZipBase64Binary"):
+        raw = base64.b64decode(text)
+        if encoding == "GZipBase64Binary":
+            raw = zlib.decompress(raw)
+        endian = ">" if element.get("Endian") == "BigEndian" else "<"
+        array = np.frombuffer(raw, dtype=dtype.newbyteorder(endian))
+    else:
+        raise ValueError(f"Unsupported GIfTI encoding: {encoding}")
+    order = "F" if element.get("ArrayIndexingOrder") == "ColumnMajorOrder" else "C"
+    return array.reshape(dims, order=order)
+
+
+def read_gifti(data: bytes) -> SurfaceFile:
+    """Read the surface (vertices and triangles) of a GIfTI file."""
+    try:
+        root = ET.fromstring(data)
+    except ET.ParseError as e:
+        raise ValueError(f"Not a GIfTI file: {e}") from None
+    arrays = {}
+    for element in root.iter("DataArray"):
+        intent = element.get("Intent")
+        if intent in ("NIFTI_INTENT_POINTSET", "NIFTI_INTENT_TRIANGLE"):
+            try:
+                arrays.setdefault(intent, _gifti_array(element))
+            except KeyError:
+                raise ValueError(
+                    f"Unsupported GIfTI data type: {element.get('DataType')}"
+                ) from None
+    if len(arrays) != 2:
+        raise ValueError("The GIfTI file has no surface")
+    return SurfaceFile(
+        arrays["NIFTI_INTENT_POINTSET"].astype(np.float32),
+        arrays["NIFTI_INTENT_TRIANGLE"].astype(np.int64),
+    )
+
+
+_SURFACE_READERS = {".gii": read_gifti, ".mz3": read_mz3}
+
+
+def decimate_streamlines(
+    streamlines: Streamlines, fraction: float, step: int
+) -> Streamlines:
+    """Keep a `fraction` of the streamlines, and every `step`-th point of each.
+
+    The first and last point of each streamline are always kept.
+    """
+    points, offsets = streamlines
+    keep = np.arange(0, len(offsets) - 1, max(1, round(1 / fraction)))
+    starts, ends = offsets[keep], offsets[keep + 1]
+    lengths = ends - starts
+    # position of each point along its streamline
+    position = np.arange(lengths.sum()) - np.repeat(
+        np.cumsum(lengths) - lengths, lengths
+    )
+    index = np.repeat(starts, lengths) + position
+    last = np.repeat(lengths - 1, lengths)
+    mask = (position % step == 0) | (position == last)
+    new_lengths = np.bincount(
+        np.repeat(np.arange(len(keep)), lengths), weights=mask, minlength=len(keep)
+    ).astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(new_lengths)])
+    return Streamlines(points[index[mask]], offsets)
+
+
+def decimate_surface(
+    vertices: np.ndarray, faces: np.ndarray, fraction: float
+) -> Surface:
+    """Reduce a surface to about `fraction` of its vertices by vertex clustering.
+
+    Vertices that fall in the same cell of a regular grid are merged into
+    their mean, and the triangles that collapse are removed.
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64)
+    # a surface with area A has about A / cell**2 vertices on a grid
+    a, b, c = (vertices[faces[:, i]] for i in range(3))
+    area = 0.5 * np.linalg.norm(np.cross(b - a, c - a), axis=1).sum()
+    target = max(4, int(len(vertices) * fraction))
+    cell = np.sqrt(area / target) or 1.0
+    cells = np.floor((vertices - vertices.min(axis=0)) / cell).astype(np.int64)
+    n = cells.max(axis=0) + 1
+    keys = (cells[:, 2] * n[1] + cells[:, 1]) * n[0] + cells[:, 0]
+    _, clusters = np.unique(keys, return_inverse=True)
+    clusters = clusters.ravel()
+    counts = np.bincount(clusters)
+    new_vertices = np.column_stack(
+        [np.bincount(clusters, weights=vertices[:, i]) / counts for i in range(3)]
+    )
+    new_faces = clusters[faces]
+    new_faces = new_faces[
+        (new_faces[:, 0] != new_faces[:, 1])
+        & (new_faces[:, 1] != new_faces[:, 2])
+        & (new_faces[:, 0] != new_faces[:, 2])
+    ]
+    # remove duplicate triangles, keeping the orientation of the first one
+    _, first = np.unique(np.sort(new_faces, axis=1), axis=0, return_index=True)
+    new_faces = new_faces[np.sort(first)]
+    return Surface(
+        new_vertices.astype(np.float32), new_faces.astype(np.uint32), clusters
+    )
+
+
+def _digest(*arrays) -> str:
+    h = hashlib.sha256()
+    for arr in arrays:
+        h.update(np.ascontiguousarray(arr).data)
+    return h.hexdigest()
+
+
+def _file_surface(mesh, fraction: float) -> typing.Optional[Surface]:
+    path = pathlib.Path(mesh.path)
+    read = _SURFACE_READERS.get(path.suffix.lower())
+    if read is None:
+        return None
+    if any("path" in layer for layer in mesh.layers):
+        warnings.warn(
+            f"The layers of {path.name} are files with a value for each of its "
+            "vertices, sending it in full",
+            stacklevel=4,
+        )
+        return None
+    # the file is only read if the decimated surface is not cached
+    try:
+        return _cached(
+            (payload_digest(path), mesh.lod),
+            lambda: decimate_surface(*read(read_payload(path).data)[:2], fraction),
+        )
+    except ValueError as e:
+        warnings.warn(f"Sending {path.name} in full: {e}", stacklevel=4)
+        return None
+
+
+def reduced_surface(mesh) -> typing.Optional[Surface]:
+    """Return the surface of `mesh` at its level of detail (None for full)."""
+    if mesh.lod == "full":
+        return None
+    if mesh.vertices is None:
+        # a surface file, whose parsing and decimation are cached by content
+        if mesh.path is None:
+            return None
+        return _file_surface(mesh, LOD_LEVELS[mesh.lod][2])
+    # hashing large arrays is not free, so remember the last result
+    memo = getattr(mesh, "_lod_surface", None)
+    if (
+        memo
+        and memo[0] is mesh.vertices
+        and memo[1] is mesh.faces
+        and memo[2] == mesh.lod
+    ):
+        return memo[3]
+    key = (_digest(mesh.vertices, mesh.faces), mesh.lod)
+    surface = _cached(
+        key,
+        lambda: decimate_surface(mesh.vertices, mesh.faces, LOD_LEVELS[mesh.lod][2]),
+    )
+    mesh._lod_surface = (mesh.vertices, mesh.faces, mesh.lod, surface)
+    return surface
+
+
+def reduce_vertex_data(mesh, values):
+    """Average per-vertex `values` over the vertices merged by the level of detail."""
+    surface = reduced_surface(mesh)
+    if surface is None:
+        return values
+    values = np.asarray(values)
+    counts = np.bincount(surface.clusters)
+    columns = values.reshape(len(values), -1).T
+    reduced = np.column_stack(
+        [np.bincount(surface.clusters, weights=column) / counts for column in columns]
+    )
+    return reduced.reshape(-1, *values.shape[1:]).astype(values.dtype)
+
+
+def mesh_file_serializer(
+    instance: typing.Union[pathlib.Path, str, None], widget: object
+):
+    lod = getattr(widget, "lod", "full")
+    if instance is None or lod == "full":
+        return file_serializer(instance, widget)
+    path = pathlib.Path(instance)
+    if path.suffix.lower() in _SURFACE_READERS:
+        return _surface_file_serializer(path, widget)
+    read = _TRACTOGRAM_READERS.get(path.suffix.lower())
+    if read is None:
+        warnings.warn(
+            f"Level of detail is only supported for tractograms (.tck, .trk), "
+            f"surfaces (.gii, .mz3) and meshes created from arrays, "
+            f"sending {path.name} in full",
+            stacklevel=2,
+        )
+        return file_serializer(instance, widget)
+    digest = payload_digest(path)
+    fraction, step, _ = LOD_LEVELS[lod]
+
+    def reduce():
+        streamlines = read(read_payload(path).data)
+        return write_tck(decimate_streamlines(streamlines, fraction, step))
+
+    reduced = _cached((digest, lod), reduce)
+    # not a hash of the reduced bytes, but just as unique
+    digest = f"{digest}:{lod}"
+    return {"name": f"{path.stem}.tck", "digest": digest, "data": reduced}
+
+
+def _surface_file_serializer(path: pathlib.Path, widget):
+    surface = reduced_surface(widget)
+    if surface is None:
+        return file_serializer(path, widget)
+    digest = payload_digest(path)
+
+    def write():
+        original = _SURFACE_READERS[path.suffix.lower()](read_payload(path).data)
+        colors, scalars = original.colors, original.scalars
+        if colors is not None:
+            colors = reduce_vertex_data(widget, colors)
+        if scalars is not None:
+            scalars = reduce_vertex_data(widget, scalars.T).T
+        return write_mz3(SurfaceFile(surface.vertices, surface.faces, colors, scalars))
+
+    reduced = _cached((digest, widget.lod, "mz3"), write)
+    digest = f"{digest}:{widget.lod}"
+    return {"name": f"{path.stem}.mz3", "digest": digest, "data": reduced}
+
+
+def mesh_vertices_serializer(instance: typing.Optional[np.ndarray], widget: object):
+    # the surfaces of files are sent as a file
+    surface = None if instance is None else reduced_surface(widget)
+    return array_serializer(instance if surface is None else surface.vertices, widget)
+
+
+def mesh_faces_serializer(instance: typing.Optional[np.ndarray], widget: object):
+    surface = None if instance is None else reduced_surface(widget)
+    return array_serializer(instance if surface is None else surface.faces, widget)
+
+
+def mesh_colors_serializer(instance: typing.Optional[np.ndarray], widget: object):
+    if instance is not None:
+        instance = reduce_vertex_data(widget, instance)
+    return array_serializer(instance, widget)
+
+
+def mesh_layers_lod_serializer(instance: list, widget: object):
+    layers = [
+        {**layer, "values": reduce_vertex_data(widget, layer["values"])}
+        if "values" in layer
+        else layer
+        for layer in instance
+    ]
+    return mesh_layers_serializer(layers, widget)
@@ -0,0 +1,467 @@
+import concurrent.futures
+import gzip
+import json
+import math
+import pathlib
+import threading
+import typing
+
+import numpy as np
+
+__all__ = [
+    "NiftiHeader",
+    "NiftiIndex",
+    "nifti_bytes",
+    "read_nifti",
+    "read_nifti_header",
+]
+
+# https://nifti.nimh.nih.gov/pub/dist/src/niftilib/nifti1.h
+_NIFTI1 = np.dtype(
+    [
+        ("sizeof_hdr", "i4"),
+        ("unused", "V36"),
+        ("dim", "i2", 8),
+        ("intent_p", "f4", 3),
+        ("intent_code", "i2"),
+        ("datatype", "i2"),
+        ("bitpix", "i2"),
+        ("slice_start", "i2"),
+        ("pixdim", "f4", 8),
+        ("vox_offset", "f4"),
+        ("scl_slope", "f4"),
+        ("scl_inter", "f4"),
+        ("slice_end", "i2"),
+        ("slice_code", "u1"),
+        ("xyzt_units", "u1"),
+        ("cal_max", "f4"),
+        ("cal_min", "f4"),
+        ("slice_duration", "f4"),
+        ("toffset", "f4"),
+        ("glmax", "i4"),
+        ("glmin", "i4"),
+        ("descrip", "S80"),
+        ("aux_file", "S24"),
+        ("qform_code", "i2"),
+        ("sform_code", "i2"),
+        ("quatern", "f4", 3),
+        ("qoffset", "f4", 3),
+        ("srow", "f4", (3, 4)),
+        ("intent_name", "S16"),
+        ("magic", "S4"),
+    ]
+)
+
+# https://nifti.nimh.nih.gov/pub/dist/doc/nifti2.h
+_NIFTI2 = np.dtype(
+    [
+        ("sizeof_hdr", "i4"),
+        ("magic", "S8"),
+        ("datatype", "i2"),
+        ("bitpix", "i2"),
+        ("dim", "i8", 8),
+        ("intent_p", "f8", 3),
+        ("pixdim", "f8", 8),
+        ("vox_offset", "i8"),
+        ("scl_slope", "f8"),
+        ("scl_inter", "f8"),
+        ("cal_max", "f8"),
+        ("cal_min", "f8"),
+        ("slice_duration", "f8"),
+        ("toffset", "f8"),
+        ("slice_start", "i8"),
+        ("slice_end", "i8"),
+        ("descrip", "S80"),
+        ("aux_file", "S24"),
+        ("qform_code", "i4"),
+        ("sform_code", "i4"),
+        ("quatern", "f8", 3),
+        ("qoffset", "f8", 3),
+        ("srow", "f8", (3, 4)),
+        ("slice_code", "i4"),
+        ("xyzt_units", "i4"),
+        ("intent_code", "i4"),
+        ("intent_name", "S16"),
+        ("dim_info", "u1"),
+        ("unused_str", "S15"),
+    ]
+)
+
+# NIfTI datatype codes to NumPy dtypes
+_DATATYPES = {
+    1: "bool",
+    2: "uint8",
+    4: "int16",
+    8: "int32",
+    16: "float32",
+    32: "complex64",
+    64: "float64",
+    128: "rgb24",
+    256: "int8",
+    512: "uint16",
+    768: "uint32",
+    1024: "int64",
+    1280: "uint64",
+    1792: "complex128",
+    2304: "rgba32",
+}
+
+_ITEMSIZE = {"bool": 1 / 8, "rgb24": 3, "rgba32": 4}
+
+
+class NiftiHeader(typing.NamedTuple):
+    path: pathlib.Path
+    # 1 or 2
+    version: int
+    shape: typing.Tuple[int, ...]
+    # the size of the voxels along each dimension (in mm, then seconds)
+    voxel_size: typing.Tuple[float, ...]
+    dtype: str
+    # voxel to world (RAS mm) transform
+    affine: np.ndarray
+    # where the voxel data starts (in the uncompressed stream)
+    vox_offset: int
+    scl_slope: float
+    scl_inter: float
+    description: str
+    # whether the file is gzip compressed
+    compressed: bool
+    # the size of the file on disk
+    file_size: int
+
+    @property
+    def nbytes(self) -> int:
+        """The size of the voxel data, once uncompressed."""
+        itemsize = _ITEMSIZE.get(self.dtype) or np.dtype(self.dtype).itemsize
+        return math.ceil(math.prod(self.shape) * itemsize)
+
+
+def _quaternion_affine(hdr) -> np.ndarray:
+    """Compute the qform of a header, see `quatern_to_mat44` in nifti1_io.c."""
+    b, c, d = (float(x) for x in hdr["quatern"])
+    a = math.sqrt(max(0.0, 1.0 - (b * b + c * c + d * d)))
+    rotation = np.array(
+        [
+            [a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+            [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+            [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b],
+        ]
+    )
+    pixdim = hdr["pixdim"].astype(np.float64)
+    # pixdim[0] is the sign of the last axis
+    qfac = -1.0 if pixdim[0] < 0 else 1.0
+    affine = np.eye(4)
+    affine[:3, :3] = rotation * [pixdim[1], pixdim[2], qfac * pixdim[3]]
+    affine[:3, 3] = hdr["qoffset"]
+    return affine
+
+
+def _affine(hdr) -> np.ndarray:
+    if hdr["sform_code"] > 0:
+        affine = np.eye(4)
+        affine[:3] = hdr["srow"]
+        return affine
+    if hdr["qform_code"] > 0:
+        return _quaternion_affine(hdr)
+    # no orientation, only the voxel size
+    return np.diag([*hdr["pixdim"][1:4].astype(np.float64), 1.0])
+
+
+def _parse(data: bytes) -> typing.Tuple[int, np.void]:
+    for version, layout in ((1, _NIFTI1), (2, _NIFTI2)):
+        # the byte order is the one in which the header size makes sense
+        for order in "<>":
+            dtype = layout.newbyteorder(order)
+            if len(data) < dtype.itemsize:
+                continue
+            hdr = np.frombuffer(data, dtype=dtype, count=1)[0]
+            if hdr["sizeof_hdr"] == dtype.itemsize:
+                return version, hdr
+    raise ValueError("Not a NIfTI-1 or NIfTI-2 header")
+
+
+def _header(
+    data: bytes, path: pathlib.Path, compressed: bool, file_size: int
+) -> typing.Tuple[NiftiHeader, str]:
+    """Decode a header, and return it with its byte order."""
+    version, hdr = _parse(data)
+    ndim = int(hdr["dim"][0])
+    if not 1 <= ndim <= 7:
+        raise ValueError(f"Invalid number of dimensions in {path}: {ndim}")
+    datatype = int(hdr["datatype"])
+    if datatype not in _DATATYPES:
+        raise ValueError(f"Unsupported NIfTI datatype in {path}: {datatype}")
+    header = NiftiHeader(
+        path=path,
+        version=version,
+        shape=tuple(int(d) for d in hdr["dim"][1 : ndim + 1]),
+        voxel_size=tuple(float(p) for p in hdr["pixdim"][1 : ndim + 1]),
+        dtype=_DATATYPES[datatype],
+        affine=_affine(hdr),
+        vox_offset=int(hdr["vox_offset"]),
+        scl_slope=float(hdr["scl_slope"]),
+        scl_inter=float(hdr["scl_inter"]),
+        description=hdr["descrip"].split(b"\0")[0].decode("latin-1"),
+        compressed=compressed,
+        file_size=file_size,
+    )
+    return header, hdr.dtype["sizeof_hdr"].byteorder
+
+
+def read_nifti_header(path: typing.Union[pathlib.Path, str]) -> NiftiHeader:
+    """Read the header of a NIfTI-1 or NIfTI-2 file, without its voxel data.
+
+    Only the first bytes of the file are read, and gzip compressed files
+    are only decompressed up to the end of the header.
+
+    Parameters
+    ----------
+    path : str or Path
+        A ``.nii``, ``.nii.gz`` or ``.hdr`` file.
+
+    Returns
+    -------
+    NiftiHeader
+    """
+    path = pathlib.Path(path)
+    with open(path, "rb") as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+    opener = gzip.open if compressed else open
+    with opener(path, "rb") as f:
+        data = f.read(_NIFTI2.itemsize)
+    header, _ = _header(data, path, compressed, path.stat().st_size)
+    return header
+
+
+def read_nifti(
+    path: typing.Union[pathlib.Path, str], data: typing.Optional[bytes] = None
+) -> typing.Tuple[NiftiHeader, np.ndarray]:
+    """Read the header and the voxels of a single file NIfTI image.
+
+    Parameters
+    ----------
+    path : str or Path
+        A ``.nii`` or ``.nii.gz`` file.
+    data : bytes, optional
+        The content of the file, if it was already read.
+
+    Returns
+    -------
+    tuple of (NiftiHeader, np.ndarray)
+        The header, and the stored values (before `scl_slope` and
+        `scl_inter` are applied) indexed as ``[i, j, k, ...]``.
+    """
+    path = pathlib.Path(path)
+    if data is None:
+        data = path.read_bytes()
+    file_size = len(data)
+    compressed = data[:2] == b"\x1f\x8b"
+    if compressed:
+        data = gzip.decompress(data)
+    header, byteorder = _header(data, path, compressed, file_size)
+    if header.dtype in _ITEMSIZE:
+        raise ValueError(f"Unsupported NIfTI datatype in {path}: {header.dtype}")
+    dtype = np.dtype(header.dtype).newbyteorder(byteorder)
+    count = math.prod(header.shape)
+    if header.vox_offset + count * dtype.itemsize > len(data):
+        raise ValueError(f"{path} is truncated")
+    array = np.frombuffer(data, dtype=dtype, count=count, offset=header.vox_offset)
+    return header, array.reshape(header.shape, order="F")
+
+
+def nifti_bytes(
+    array: np.ndarray,
+    affine: np.ndarray,
+    scl_slope: float = 0.0,
+    scl_inter: float = 0.0,
+    description: str = "",
+) -> bytes:
+    """Encode an array as an uncompressed NIfTI-1 file.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        A 3D or 4D array, indexed as ``[i, j, k, t]`` in voxel order.
+    affine : np.ndarray
+        The (4, 4) voxel to world (RAS mm) transform, written as the sform.
+    scl_slope, scl_inter : float, optional
+        The scaling of the stored values (a slope of 0 means no scaling).
+    description : str, optional
+        Up to 80 characters describing the image.
+
+    Returns
+    -------
+    bytes
+    """
+    codes = {name: code for code, name in _DATATYPES.items()}
+    if array.dtype.name not in codes or array.dtype == bool:
+        raise ValueError(f"Unsupported dtype for a NIfTI file: {array.dtype}")
+    if not 3 <= array.ndim <= 4:
+        raise ValueError(f"array must be 3D or 4D, got {array.ndim} dimensions")
+    affine = np.asarray(affine, dtype=np.float64)
+    hdr = np.zeros(1, dtype=_NIFTI1.newbyteorder("<"))
+    hdr["sizeof_hdr"] = _NIFTI1.itemsize
+    hdr["dim"] = [array.ndim, *array.shape, *[1] * (7 - array.ndim)]
+    hdr["datatype"] = codes[array.dtype.name]
+    hdr["bitpix"] = array.dtype.itemsize * 8
+    voxel_size = np.linalg.norm(affine[:3, :3], axis=0)
+    hdr["pixdim"] = [1, *voxel_size, *[1] * 4]
+    # the header is followed by 4 bytes of (no) extensions
+    hdr["vox_offset"] = _NIFTI1.itemsize + 4
+    hdr["scl_slope"] = scl_slope
+    hdr["scl_inter"] = scl_inter
+    # millimeters and seconds
+    hdr["xyzt_units"] = 2 | 8
+    hdr["descrip"] = description.encode("latin-1", "replace")[:80]
+    hdr["sform_code"] = 1
+    hdr["srow"] = affine[:3]
+    hdr["magic"] = b"n+1"
+    data = array.astype(array.dtype.newbyteorder("<"), copy=False)
+    return hdr.tobytes() + b"\0" * 4 + data.tobytes(order="F")
+
+
+def _to_json(header: NiftiHeader) -> dict:
+    return {
+        **header._asdict(),
+        "path": str(header.path),
+        "affine": header.affine.tolist(),
+    }
+
+
+def _from_json(data: dict) -> NiftiHeader:
+    return NiftiHeader(
+        **{
+            **data,
+            "path": pathlib.Path(data["path"]),
+            "shape": tuple(data["shape"]),
+            "voxel_size": tuple(data["voxel_size"]),
+            "affine": np.array(data["affine"]),
+        }
+    )
+
+
+class NiftiIndex:
+    """An index of the headers of all the NIfTI files in a directory tree.
+
+    Only the headers are read, concurrently, and they are only read again
+    when a file changes. The index can be saved to a JSON file, so that
+    large collections are browsed without reading anything.
+
+    Parameters
+    ----------
+    root : str or Path
+        The directory to index.
+    patterns : sequence of str, optional
+        The file name patterns to index.
+    cache : str or Path, optional
+        A JSON file to keep the index in between sessions.
+    max_workers : int, optional
+        The maximum number of headers read at the same time.
+
+    Examples
+    --------
+    >>> index = NiftiIndex("data/")
+    >>> large = index.query(lambda h: h.nbytes > 100_000_000)
+    >>> nv.load_volumes([{"path": h.path} for h in index.query(dtype="float32")])
+    """
+
+    def __init__(
+        self,
+        root: typing.Union[pathlib.Path, str],
+        patterns: typing.Sequence[str] = ("*.nii", "*.nii.gz"),
+        cache: typing.Union[pathlib.Path, str, None] = None,
+        max_workers: typing.Optional[int] = None,
+    ):
+        self.root = pathlib.Path(root)
+        self.patterns = tuple(patterns)
+        self.cache = None if cache is None else pathlib.Path(cache)
+        self.max_workers = max_workers
+        # path -> ((mtime_ns, size), header)
+        self._entries: typing.Dict[str, typing.Tuple[tuple, NiftiHeader]] = {}
+        # files that could not be read, with the reason
+        self.errors: typing.Dict[pathlib.Path, str] = {}
+        self._lock = threading.Lock()
+        if self.cache is not None and self.cache.is_file():
+            self._load_cache()
+        self.update()
+
+    def _load_cache(self):
+        for entry in json.loads(self.cache.read_text()):
+            self._entries[entry["header"]["path"]] = (
+                tuple(entry["stat"]),
+                _from_json(entry["header"]),
+            )
+
+    def _save_cache(self):
+        entries = [
+            {"stat": list(stat), "header": _to_json(header)}
+            for stat, header in self._entries.values()
+        ]
+        self.cache.write_text(json.dumps(entries))
+
+    def _files(self) -> typing.Dict[str, tuple]:
+        files = {}
+        for pattern in self.patterns:
+            for path in self.root.rglob(pattern):
+                if path.is_file():
+                    stat = path.stat()
+                    files[str(path)] = (stat.st_mtime_ns, stat.st_size)
+        return files
+
+    def update(self):
+        """Read the headers of the new and changed files, and forget removed ones."""
+        files = self._files()
+        stale = [path for path, stat in files.items() if self._stat(path) != stat]
+        entries = {path: self._entries[path] for path in files if path not in stale}
+        self.errors = {}
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers or 8) as executor:
+            futures = {path: executor.submit(_try_read_header, path) for path in stale}
+            for path, future in futures.items():
+                header = future.result()
+                if isinstance(header, NiftiHeader):
+                    entries[path] = (files[path], header)
+                else:
+                    self.errors[pathlib.Path(path)] = header
+        with self._lock:
+            self._entries = dict(sorted(entries.items()))
+        if self.cache is not None:
+            self._save_cache()
+
+    def _stat(self, path: str) -> typing.Optional[tuple]:
+        entry = self._entries.get(path)
+        return None if entry is None else entry[0]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> typing.Iterator[NiftiHeader]:
+        return (header for _, header in self._entries.values())
+
+    def __getitem__(self, path: typing.Union[pathlib.Path, str]) -> NiftiHeader:
+        return self._entries[str(path)][1]
+
+    def query(
+        self,
+        predicate: typing.Optional[typing.Callable[[NiftiHeader], bool]] = None,
+        **fields,
+    ) -> typing.List[NiftiHeader]:
+        """Return the headers that match a predicate and the given field values.
+
+        Examples
+        --------
+        >>> index.query(dtype="uint8", shape=(256, 256, 256))
+        >>> index.query(lambda h: max(h.voxel_size[:3]) <= 1.0)
+        """
+        return [
+            header
+            for header in self
+            if all(getattr(header, k) == v for k, v in fields.items())
+            and (predicate is None or predicate(header))
+        ]
+
+
+def _try_read_header(path: str) -> typing.Union[NiftiHeader, str]:
+    try:
+        return read_nifti_header(path)
+    except (OSError, ValueError, EOFError) as e:
+        return str(e)
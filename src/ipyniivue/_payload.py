@@ -0,0 +1,313 @@
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import pathlib
+import threading
+import typing
+import weakref
+
+import numpy as np
+
+__all__ = [
+    "ByteCache",
+    "Payload",
+    "clear_caches",
+    "ingest",
+    "payload_by_digest",
+    "payload_digest",
+    "read_payload",
+    "set_cache_limits",
+]
+
+
+class Payload(typing.NamedTuple):
+    name: str
+    data: bytes
+    digest: str
+
+
+def _sizeof(value) -> int:
+    """Count the bytes of the buffers held by a value."""
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (np.ndarray, memoryview)):
+        return value.nbytes
+    if isinstance(value, tuple):
+        return sum(_sizeof(v) for v in value)
+    return 0
+
+
+class ByteCache:
+    """A least recently used cache that holds at most `max_bytes` of buffers.
+
+    Values larger than `max_bytes` are not kept, and do not evict the other
+    values. This is safe to use from several threads at once.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items: collections.OrderedDict[typing.Hashable, tuple] = (
+            collections.OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: typing.Hashable, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key: typing.Hashable, value):
+        size = _sizeof(value)
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self._items[key] = (value, size)
+            self.nbytes += size
+            self._trim()
+
+    def set_limit(self, max_bytes: int):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._trim()
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def _trim(self):
+        while self.nbytes > self.max_bytes and self._items:
+            _, (_, size) = self._items.popitem(last=False)
+            self.nbytes -= size
+
+
+# files read ahead of time (e.g. by `ingest`) until they are serialized
+_payloads = ByteCache(256 << 20)
+# payloads derived from files or arrays, e.g. levels of detail
+derived_cache = ByteCache(256 << 20)
+_lock = threading.Lock()
+
+# the digest of each file, by `_cache_key`, so that files too large to be
+# kept in `_payloads` are not hashed again every time they are serialized
+_digests: typing.Dict[tuple, str] = {}
+# where each payload can be read again, by digest
+_sources: typing.Dict[str, pathlib.Path] = {}
+_arrays: "weakref.WeakValueDictionary[str, np.ndarray]" = weakref.WeakValueDictionary()
+
+# digests of the payloads that each frontend reported it still holds, by the
+# model id of its viewer
+_frontend_digests: typing.Dict[str, typing.Set[str]] = {}
+# model ids of the viewers that display each volume or mesh, by model id
+_displayed_by: typing.Dict[str, typing.Set[str]] = {}
+# how many `sending_all_payloads` blocks are open
+_sending_all = 0
+
+
+def _cache_key(path: pathlib.Path) -> tuple:
+    stat = path.stat()
+    return (str(path.resolve()), stat.st_mtime_ns, stat.st_size)
+
+
+def read_payload(path: typing.Union[pathlib.Path, str]) -> Payload:
+    """Read, validate and hash a file, reusing the result while it is unchanged.
+
+    This is safe to call from several threads at once.
+    """
+    path = pathlib.Path(path)
+    if not path.is_file():
+        raise FileNotFoundError(f"No such file: {path}")
+    key = _cache_key(path)
+    payload = _payloads.get(key)
+    if payload is not None:
+        return payload
+    data = path.read_bytes()
+    if not data:
+        raise ValueError(f"File is empty: {path}")
+    digest = _digests.get(key) or hashlib.sha256(data).hexdigest()
+    payload = Payload(path.name, data, digest)
+    with _lock:
+        _digests[key] = digest
+        _sources[digest] = path.resolve()
+    _payloads.put(key, payload)
+    return payload
+
+
+def payload_digest(path: typing.Union[pathlib.Path, str]) -> str:
+    """Return the digest of a file, only reading it if it was not hashed yet."""
+    path = pathlib.Path(path)
+    if not path.is_file():
+        raise FileNotFoundError(f"No such file: {path}")
+    digest = _digests.get(_cache_key(path))
+    return digest if digest is not None else read_payload(path).digest
+
+
+def set_cache_limits(
+    payload_bytes: typing.Optional[int] = None,
+    derived_bytes: typing.Optional[int] = None,
+):
+    """Set how much memory the kernel uses to avoid reading files twice.
+
+    Parameters
+    ----------
+    payload_bytes : int, optional
+        The bytes of the files that are kept after they are read, so they
+        are not read again when they are sent. 256 MiB by default.
+    derived_bytes : int, optional
+        The bytes of the data derived from files and arrays that is kept,
+        e.g. decimated meshes or reduced volumes. 256 MiB by default.
+    """
+    if payload_bytes is not None:
+        _payloads.set_limit(payload_bytes)
+    if derived_bytes is not None:
+        derived_cache.set_limit(derived_bytes)
+
+
+def clear_caches():
+    """Free the memory held by the caches of files and derived data."""
+    _payloads.clear()
+    derived_cache.clear()
+    with _lock:
+        _digests.clear()
+
+
+def array_digest(array: np.ndarray) -> str:
+    """Hash an array, and remember it for as long as it is alive."""
+    array = np.ascontiguousarray(array)
+    h = hashlib.sha256(f"{array.dtype.str}{array.shape}".encode())
+    h.update(memoryview(array).cast("B"))
+    digest = h.hexdigest()
+    _arrays[digest] = array
+    return digest
+
+
+def array_by_digest(digest: str) -> typing.Optional[np.ndarray]:
+    """Return the array with the given digest, if it is still alive."""
+    return _arrays.get(digest)
+
+
+def payload_path(digest: str) -> typing.Optional[pathlib.Path]:
+    """Return the file that a payload was last read from, if it still exists."""
+    path = _sources.get(digest)
+    return path if path is not None and path.is_file() else None
+
+
+def payload_by_digest(digest: str) -> typing.Optional[Payload]:
+    """Return the file payload with the given digest, if it can still be read."""
+    path = payload_path(digest)
+    if path is None:
+        return None
+    payload = read_payload(path)
+    return payload if payload.digest == digest else None
+
+
+def frontend_has(digest: str, widget: object = None) -> bool:
+    """Whether the frontends that display `widget` reported they hold the payload.
+
+    A widget that is not displayed yet is checked against every frontend.
+    """
+    if _sending_all:
+        return False
+    with _lock:
+        viewers = _displayed_by.get(getattr(widget, "model_id", None))
+        if not viewers:
+            viewers = set(_frontend_digests)
+        return bool(viewers) and all(
+            digest in _frontend_digests.get(viewer, ()) for viewer in viewers
+        )
+
+
+def set_frontend_digests(viewer_id: str, digests: typing.Iterable[str]):
+    """Record the payloads that the frontend of a viewer holds."""
+    with _lock:
+        _frontend_digests[viewer_id] = set(digests)
+
+
+def set_displayed(viewer_id: str, widget_ids: typing.Iterable[str]):
+    """Record the volumes and meshes that a viewer displays."""
+    widget_ids = set(widget_ids)
+    with _lock:
+        for widget_id in list(_displayed_by):
+            viewers = _displayed_by[widget_id]
+            if widget_id in widget_ids:
+                viewers.add(viewer_id)
+            else:
+                viewers.discard(viewer_id)
+                if not viewers:
+                    del _displayed_by[widget_id]
+        for widget_id in widget_ids - set(_displayed_by):
+            _displayed_by[widget_id] = {viewer_id}
+
+
+def forget_frontend(viewer_id: str):
+    """Forget a viewer, e.g. once it is closed."""
+    set_displayed(viewer_id, ())
+    with _lock:
+        _frontend_digests.pop(viewer_id, None)
+
+
+@contextlib.contextmanager
+def sending_all_payloads():
+    """Serialize every file with its data, even if the frontend holds it.
+
+    This is needed when the state is used without the frontend, e.g. for
+    a static export.
+    """
+    global _sending_all
+    with _lock:
+        _sending_all += 1
+    try:
+        yield
+    finally:
+        with _lock:
+            _sending_all -= 1
+
+
+def ingest(
+    paths: typing.Sequence[typing.Union[pathlib.Path, str, None]],
+    max_workers: typing.Optional[int] = None,
+    ordered: bool = True,
+) -> typing.Iterator[typing.Tuple[int, typing.Optional[Payload]]]:
+    """Read many files concurrently in a bounded thread pool.
+
+    Reading files releases the GIL, so a batch of files on a network
+    storage is bound by the slowest file instead of the sum of all of them.
+
+    Parameters
+    ----------
+    paths : sequence of path or None
+        The files to read. `None` entries are passed through as is.
+    max_workers : int, optional
+        The maximum number of files read at the same time. Defaults to 8.
+    ordered : bool, optional
+        If `True` (the default), yield the payloads in the order of `paths`.
+        Otherwise yield each payload as soon as it is read.
+
+    Yields
+    ------
+    tuple of (int, Payload or None)
+        The index of the file in `paths` and its payload.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers or 8) as executor:
+        futures = [
+            None if path is None else executor.submit(read_payload, path)
+            for path in paths
+        ]
+        if ordered:
+            for i, future in enumerate(futures):
+                yield i, None if future is None else future.result()
+            return
+        for i, future in enumerate(futures):
+            if future is None:
+                yield i, None
+        index = {future: i for i, future in enumerate(futures) if future is not None}
+        for future in concurrent.futures.as_completed(index):
+            yield index[future], future.result()
@@ -0,0 +1,234 @@
+import gzip
+import pathlib
+import typing
+import warnings
+
+import numpy as np
+
+from ._lod import _cached
+from ._nifti import nifti_bytes, read_nifti
+from ._payload import payload_digest, read_payload
+from ._utils import file_serializer
+
+__all__ = [
+    "Reduction",
+    "reduce_volume",
+    "volume_file_serializer",
+    "volume_reduction",
+]
+
+# the smallest types that the voxels are downcast to, in order of preference
+_DOWNCAST_DTYPES = ("uint8", "int16", "float32")
+# the largest dimension that a NIfTI-1 header can describe
+_MAX_DIM = 32767
+
+
+class Reduction(typing.NamedTuple):
+    # the size of the file, and of the reduced file that is sent instead
+    original_bytes: int
+    sent_bytes: int
+    # the type of the voxels that are sent
+    dtype: str
+    # the voxel index, in the file, of the first voxel that is sent
+    offset: typing.Tuple[int, ...]
+    # the shape of the voxels that are sent
+    shape: typing.Tuple[int, ...]
+    # the mapping of the sent values to the stored values, when quantized
+    scale: typing.Optional[typing.Tuple[float, float]]
+
+    @property
+    def saved_bytes(self) -> int:
+        return self.original_bytes - self.sent_bytes
+
+
+def _fits(values: np.ndarray, dtype: str) -> bool:
+    info = np.iinfo(dtype)
+    return bool(values.min() >= info.min and values.max() <= info.max)
+
+
+def _downcast(array: np.ndarray) -> np.ndarray:
+    """Store the values in the smallest type that represents them exactly."""
+    if array.size == 0:
+        return array
+    if array.dtype.kind in "iu":
+        for dtype in _DOWNCAST_DTYPES[:2]:
+            if array.dtype.itemsize > np.dtype(dtype).itemsize and _fits(array, dtype):
+                return array.astype(dtype)
+        return array
+    if array.dtype.kind != "f":
+        return array
+    if np.isfinite(array).all() and (np.round(array) == array).all():
+        for dtype in _DOWNCAST_DTYPES[:2]:
+            if _fits(array, dtype):
+                return array.astype(dtype)
+    if array.dtype.itemsize > 4:
+        single = array.astype(np.float32)
+        if np.array_equal(single, array, equal_nan=True):
+            return single
+    return array
+
+
+def _quantize(
+    values: np.ndarray, cal_min: typing.Optional[float], cal_max: typing.Optional[float]
+) -> typing.Tuple[np.ndarray, float, float]:
+    """Map the values within ``[cal_min, cal_max]`` to 256 levels."""
+    finite = values[np.isfinite(values)]
+    low = cal_min if cal_min is not None else (finite.min() if finite.size else 0.0)
+    high = cal_max if cal_max is not None else (finite.max() if finite.size else 0.0)
+    step = (high - low) / 255 if high > low else 1.0
+    levels = np.rint((np.nan_to_num(values, nan=low) - low) / step)
+    return np.clip(levels, 0, 255).astype(np.uint8), float(step), float(low)
+
+
+def _nonzero_box(values: np.ndarray) -> typing.Tuple[slice, ...]:
+    """Return the bounding box of the nonzero voxels, over the first 3 axes."""
+    mask = (values != 0) & ~np.isnan(values)
+    mask = mask.reshape(*mask.shape[:3], -1).any(axis=3)
+    box = []
+    for axis in range(3):
+        found = np.flatnonzero(mask.any(axis=tuple(a for a in range(3) if a != axis)))
+        # an empty image keeps a single voxel
+        start, stop = (found[0], found[-1] + 1) if found.size else (0, 1)
+        box.append(slice(int(start), int(stop)))
+    return tuple(box)
+
+
+def reduce_volume(
+    path: typing.Union[pathlib.Path, str],
+    data: bytes,
+    downcast: str = "lossless",
+    crop: bool = False,
+    cal_min: typing.Optional[float] = None,
+    cal_max: typing.Optional[float] = None,
+) -> typing.Tuple[bytes, Reduction]:
+    """Make a NIfTI image smaller before it is sent.
+
+    Parameters
+    ----------
+    path : str or Path
+        The file that `data` was read from.
+    data : bytes
+        The content of the file.
+    downcast : {"none", "lossless", "quantize"}, optional
+        With "lossless", the voxels are stored in the smallest of uint8,
+        int16 and float32 that holds their values exactly. With "quantize",
+        the (scaled) values within ``[cal_min, cal_max]`` are mapped to 256
+        levels, and the values outside of it are clipped.
+    crop : bool, optional
+        If `True`, only the bounding box of the nonzero voxels is kept, and
+        the affine is moved so the image stays in the same place.
+    cal_min, cal_max : float, optional
+        The range of the quantized values. Defaults to the range of the
+        values in the image.
+
+    Returns
+    -------
+    tuple of (bytes, Reduction)
+        The reduced file, which is gzip compressed if `data` was, and how
+        it was reduced.
+    """
+    header, array = read_nifti(path, data)
+    if len(header.shape) < 3 or max(header.shape) > _MAX_DIM:
+        raise ValueError(f"Only 3D and 4D images can be reduced, got {header.shape}")
+    slope, inter = header.scl_slope, header.scl_inter
+    scaled = slope not in (0.0, 1.0) or inter != 0.0
+    values = array * slope + inter if scaled else array
+
+    affine = header.affine
+    offset = (0, 0, 0)
+    if crop:
+        box = _nonzero_box(values)
+        offset = tuple(s.start for s in box)
+        array, values = array[box], values[box]
+        affine = affine.copy()
+        affine[:3, 3] += affine[:3, :3] @ offset
+
+    scale = None
+    if downcast == "quantize":
+        array, slope, inter = _quantize(values, cal_min, cal_max)
+        scale = (slope, inter)
+    elif downcast == "lossless":
+        array = _downcast(array)
+    reduced = nifti_bytes(
+        array,
+        affine,
+        scl_slope=slope,
+        scl_inter=inter,
+        description=header.description,
+    )
+    if header.compressed:
+        reduced = gzip.compress(reduced, compresslevel=6)
+    return reduced, Reduction(
+        original_bytes=len(data),
+        sent_bytes=len(reduced),
+        dtype=array.dtype.name,
+        offset=offset,
+        shape=array.shape,
+        scale=scale,
+    )
+
+
+def _reduction_key(widget) -> typing.Optional[tuple]:
+    downcast = getattr(widget, "downcast", "none")
+    crop = getattr(widget, "crop", False)
+    if widget.path is None or (downcast == "none" and not crop):
+        return None
+    # quantized values depend on the window at the time they are sent
+    window = (widget.cal_min, widget.cal_max) if downcast == "quantize" else ()
+    return (payload_digest(widget.path), downcast, crop, *window)
+
+
+def _reduced(widget, key: tuple) -> typing.Optional[tuple]:
+    path = pathlib.Path(widget.path)
+    downcast, crop, *window = key[1:]
+    try:
+        reduced, reduction = _cached(
+            key,
+            lambda: reduce_volume(
+                path, read_payload(path).data, downcast, crop, *window
+            ),
+        )
+    except ValueError as e:
+        warnings.warn(
+            f"{path.name} cannot be reduced ({e}), sending it in full",
+            stacklevel=3,
+        )
+        reduction = None
+    if reduction is not None and reduction.sent_bytes >= reduction.original_bytes:
+        reduction = None
+    # the reduced bytes may not stay cached, but how the volume is reduced
+    # is kept with it so that regions are sent without reducing it again
+    widget._reduction_memo = (key, reduction)
+    if reduction is None:
+        return None
+    # not a hash of the reduced bytes, but just as unique
+    digest = ":".join(str(k) for k in key)
+    return path.name, digest, reduced, reduction
+
+
+def volume_reduction(widget) -> typing.Optional[Reduction]:
+    """Return how the file of a volume is reduced, or `None` if it is not."""
+    key = _reduction_key(widget)
+    if key is None:
+        return None
+    memo = getattr(widget, "_reduction_memo", None)
+    if memo is not None and memo[0] == key:
+        return memo[1]
+    reduced = _reduced(widget, key)
+    return None if reduced is None else reduced[3]
+
+
+def volume_file_serializer(
+    instance: typing.Union[pathlib.Path, str, None], widget: object
+):
+    key = _reduction_key(widget)
+    # a volume already known not to be reduced is not read again for it
+    if key is None or getattr(widget, "_reduction_memo", None) == (key, None):
+        return file_serializer(instance, widget)
+    reduced = _reduced(widget, key)
+    if reduced is None:
+        return file_serializer(instance, widget)
+    name, digest, data, _ = reduced
+    # always sent, like the levels of detail of meshes, as the derived data
+    # can only be made again from the current settings of the volume
+    return {"name": name, "digest": digest, "data": data}
@@ -0,0 +1,118 @@
+import pathlib
+import typing
+
+import numpy as np
+
+from ._payload import (
+    array_by_digest,
+    array_digest,
+    ingest,
+    payload_digest,
+    payload_path,
+)
+
+__all__ = ["STATE_VERSION", "verify_files", "widget_kwargs", "widget_state"]
+
+STATE_VERSION = 1
+
+# attributes assigned by the frontend when the data is loaded
+_FRONTEND_ATTRIBUTES = {"id", "name"}
+_ARRAY_ATTRIBUTES = {"vertices", "faces", "colors"}
+
+
+def _file_ref(path) -> dict:
+    path = pathlib.Path(path)
+    return {"file": str(path.resolve()), "digest": payload_digest(path)}
+
+
+def _array_ref(array: np.ndarray) -> dict:
+    return {"array": array_digest(array)}
+
+
+def _layer_state(layer: dict) -> dict:
+    layer = dict(layer)
+    if "path" in layer:
+        layer["path"] = _file_ref(layer["path"])
+    if "values" in layer:
+        layer["values"] = _array_ref(layer["values"])
+    return layer
+
+
+def widget_state(widget) -> dict:
+    """Describe a `Volume` or `Mesh`, referencing its data by digest."""
+    state = {}
+    for name in widget.keys:
+        if name.startswith("_") or name in _FRONTEND_ATTRIBUTES:
+            continue
+        value = getattr(widget, name)
+        if value is None:
+            state[name] = None
+        elif name == "path":
+            state[name] = _file_ref(value)
+        elif name in _ARRAY_ATTRIBUTES:
+            state[name] = _array_ref(value)
+        elif name == "layers":
+            state[name] = [_layer_state(layer) for layer in value]
+        else:
+            state[name] = value
+    # attributes that are not synced, but change what is sent
+    for name in ("lod", "downcast", "crop"):
+        if hasattr(widget, name):
+            state[name] = getattr(widget, name)
+    return state
+
+
+def _load_file(ref: dict, files: list) -> pathlib.Path:
+    # prefer a file that we know has the same content
+    path = payload_path(ref["digest"]) or pathlib.Path(ref["file"])
+    files.append((path, ref["digest"]))
+    return path
+
+
+def _load_array(ref: dict) -> np.ndarray:
+    array = array_by_digest(ref["array"])
+    if array is None:
+        raise ValueError(
+            f"The array {ref['array'][:12]} is not in memory anymore, "
+            "it has to be created again before the state can be loaded"
+        )
+    return array
+
+
+def _load_layer(layer: dict, files: list) -> dict:
+    layer = dict(layer)
+    if "path" in layer:
+        layer["path"] = _load_file(layer["path"], files)
+    if "values" in layer:
+        layer["values"] = _load_array(layer["values"])
+    return layer
+
+
+def widget_kwargs(state: dict, files: list) -> dict:
+    """Turn the output of `widget_state` back into widget attributes.
+
+    The files that are referenced are appended to `files` as
+    ``(path, digest)``, so they can be checked with `verify_files`.
+    """
+    kwargs = dict(state)
+    for name, value in state.items():
+        if value is None:
+            continue
+        if name == "path":
+            kwargs[name] = _load_file(value, files)
+        elif name in _ARRAY_ATTRIBUTES:
+            kwargs[name] = _load_array(value)
+        elif name == "layers":
+            kwargs[name] = [_load_layer(layer, files) for layer in value]
+    return kwargs
+
+
+def verify_files(
+    files: typing.List[typing.Tuple[pathlib.Path, str]],
+    max_workers: typing.Optional[int] = None,
+):
+    """Read the files concurrently, and check they have not changed."""
+    for i, payload in ingest([path for path, _ in files], max_workers=max_workers):
+        path, digest = files[i]
+        if payload.digest != digest:
+            raise ValueError(f"{path} has changed since the state was saved")
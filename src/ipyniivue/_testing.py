@@ -0,0 +1,448 @@
+import base64
+import collections
+import json
+import pathlib
+import time
+import typing
+import uuid
+
+import comm
+from ipywidgets.widgets.widget import _put_buffers, _remove_buffers
+
+__all__ = ["CommMessage", "CommRecorder", "FakeFrontend", "load_recording"]
+
+
+class CommMessage(typing.NamedTuple):
+    # seconds since the recording started
+    time: float
+    # "send" (kernel to frontend) or "receive" (frontend to kernel)
+    direction: str
+    comm_id: str
+    # "comm_open", "comm_msg" or "comm_close"
+    msg_type: str
+    data: dict
+    buffers: typing.List[bytes]
+    # bytes of the JSON data and of the binary buffers
+    size: int
+
+    @property
+    def kind(self) -> str:
+        """A short description, e.g. "update", "request_payload" or "image_loaded"."""
+        if self.msg_type != "comm_msg":
+            return self.msg_type
+        if self.data.get("method") != "custom":
+            return self.data.get("method", "")
+        content = self.data.get("content", {})
+        return content.get("type") or content.get("event") or "custom"
+
+
+def _message(start, direction, comm_id, msg_type, data, buffers) -> CommMessage:
+    data = data or {}
+    buffers = [bytes(buffer) for buffer in buffers or []]
+    size = len(json.dumps(data, default=str)) + sum(len(b) for b in buffers)
+    return CommMessage(
+        time.perf_counter() - start,
+        direction,
+        comm_id,
+        msg_type,
+        data,
+        buffers,
+        size,
+    )
+
+
+class _Hooks:
+    """Wrap methods of comm instances, and restore them on `close`."""
+
+    def __init__(self):
+        self._wrapped = []
+
+    def wrap(self, obj, name: str, hook: typing.Callable):
+        original = getattr(obj, name)
+        self._wrapped.append((obj, name, obj.__dict__.get(name)))
+
+        def wrapper(*args, **kwargs):
+            return hook(original, *args, **kwargs)
+
+        setattr(obj, name, wrapper)
+
+    def close(self):
+        # restore in reverse order, in case the same method was wrapped twice
+        for obj, name, previous in reversed(self._wrapped):
+            if previous is None:
+                delattr(obj, name)
+            else:
+                setattr(obj, name, previous)
+        self._wrapped.clear()
+
+
+class CommRecorder:
+    """Record the comm messages of widgets, with timestamps and sizes.
+
+    The comms opened while the recorder is active are recorded, as well as
+    the comms of the widgets passed to `attach`. Messages are recorded in
+    both directions, so a notebook session can be recorded in a real kernel
+    and replayed later (see `load_recording` and `replay`).
+
+    Examples
+    --------
+    >>> with CommRecorder() as recorder:
+    ...     nv = NiiVue()
+    ...     nv.load_volumes([{"path": "mni152.nii.gz"}])
+    >>> sent = recorder.total_bytes("send")
+    """
+
+    def __init__(self, keep_buffers: bool = True):
+        self.keep_buffers = keep_buffers
+        self.messages: typing.List[CommMessage] = []
+        self._comms = {}
+        # the kind of widget of each comm, see `_widget_kind`
+        self._kinds = {}
+        self._hooks = _Hooks()
+        self._start = time.perf_counter()
+        self._create_comm = None
+
+    def __enter__(self):
+        self._create_comm = comm.create_comm
+
+        def create_comm(*args, **kwargs):
+            start = time.perf_counter()
+            c = self._create_comm(*args, **kwargs)
+            # the comm is opened in its constructor, before we can wrap it
+            self._record(
+                "send",
+                c.comm_id,
+                "comm_open",
+                kwargs.get("data"),
+                kwargs.get("buffers"),
+            )
+            self.messages[-1] = self.messages[-1]._replace(time=start - self._start)
+            self._watch(c, _widget_kind(kwargs.get("data")))
+            return c
+
+        comm.create_comm = create_comm
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Stop recording."""
+        if self._create_comm is not None:
+            comm.create_comm = self._create_comm
+            self._create_comm = None
+        self._hooks.close()
+
+    def attach(self, widget):
+        """Record the messages of a widget whose comm is already open."""
+        if widget.comm is not None and widget.comm.comm_id not in self._comms:
+            self._watch(widget.comm, _widget_kind({"state": widget.get_state()}))
+
+    def _watch(self, c, kind: tuple):
+        self._comms[c.comm_id] = c
+        self._kinds[c.comm_id] = kind
+
+        def publish_msg(
+            original, msg_type, data=None, metadata=None, buffers=None, **keys
+        ):
+            self._record("send", c.comm_id, msg_type, data, buffers)
+            return original(
+                msg_type, data=data, metadata=metadata, buffers=buffers, **keys
+            )
+
+        def handle_msg(original, msg):
+            self._record(
+                "receive",
+                c.comm_id,
+                "comm_msg",
+                msg["content"]["data"],
+                msg.get("buffers"),
+            )
+            return original(msg)
+
+        self._hooks.wrap(c, "publish_msg", publish_msg)
+        self._hooks.wrap(c, "handle_msg", handle_msg)
+
+    def _record(self, direction, comm_id, msg_type, data, buffers):
+        message = _message(self._start, direction, comm_id, msg_type, data, buffers)
+        if not self.keep_buffers:
+            message = message._replace(buffers=[])
+        self.messages.append(message)
+
+    def filter(
+        self,
+        direction: typing.Optional[str] = None,
+        kind: typing.Optional[str] = None,
+        widget=None,
+    ) -> typing.List[CommMessage]:
+        """Return the messages in a direction, of a kind, or of a widget."""
+        comm_id = None if widget is None else widget.comm.comm_id
+        return [
+            m
+            for m in self.messages
+            if (direction is None or m.direction == direction)
+            and (kind is None or m.kind == kind)
+            and (comm_id is None or m.comm_id == comm_id)
+        ]
+
+    def total_bytes(self, direction: typing.Optional[str] = None, **kwargs) -> int:
+        """Return the size of the messages (see `filter` for the arguments)."""
+        return sum(m.size for m in self.filter(direction, **kwargs))
+
+    def summary(self) -> typing.Dict[typing.Tuple[str, str], typing.Dict[str, int]]:
+        """Return the number and size of the messages by direction and kind."""
+        summary = {}
+        for m in self.messages:
+            entry = summary.setdefault((m.direction, m.kind), {"count": 0, "bytes": 0})
+            entry["count"] += 1
+            entry["bytes"] += m.size
+        return summary
+
+    def save(self, path: typing.Union[pathlib.Path, str]):
+        """Write the messages to a JSON Lines file, for `load_recording`."""
+        with open(path, "w") as f:
+            for m in self.messages:
+                record = m._asdict()
+                record["buffers"] = [base64.b64encode(b).decode() for b in m.buffers]
+                f.write(json.dumps(record, default=str) + "\n")
+
+    def replay(self, messages: typing.Sequence[CommMessage], speed: float = 0):
+        """Deliver the messages received from a frontend in a recording.
+
+        Each recorded comm is matched to a comm of this recorder of the same
+        kind of widget, in the order they were opened, so the widgets should
+        be created the same way as in the recorded session.
+
+        Parameters
+        ----------
+        messages : sequence of CommMessage
+            The recorded messages, e.g. from `load_recording`.
+        speed : float, optional
+            If positive, wait between the messages to reproduce their
+            timing, sped up by this factor. By default, the messages are
+            delivered without waiting.
+        """
+        current = collections.defaultdict(list)
+        for comm_id, kind in self._kinds.items():
+            current[kind].append(comm_id)
+        comm_ids = {}
+        for m in messages:
+            if m.msg_type == "comm_open":
+                candidates = current[_widget_kind(m.data)]
+                if candidates:
+                    comm_ids[m.comm_id] = candidates.pop(0)
+        received = [m for m in messages if m.direction == "receive"]
+        start = time.perf_counter()
+        for m in received:
+            if speed > 0:
+                delay = (m.time - received[0].time) / speed
+                time.sleep(max(0.0, start + delay - time.perf_counter()))
+            comm_id = comm_ids.get(m.comm_id)
+            if comm_id is None:
+                raise ValueError(f"No comm matches the recorded comm {m.comm_id}")
+            _deliver(self._comms[comm_id], m.data, m.buffers)
+
+
+def _widget_kind(data: typing.Optional[dict]) -> tuple:
+    """Describe the widget of a comm from its opening state."""
+    state = (data or {}).get("state", {})
+    name = state.get("_anywidget_id") or state.get("_model_name")
+    return (name, tuple(sorted(state)))
+
+
+def load_recording(path: typing.Union[pathlib.Path, str]) -> typing.List[CommMessage]:
+    """Read the messages written by `CommRecorder.save`."""
+    messages = []
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            record["buffers"] = [base64.b64decode(b) for b in record["buffers"]]
+            messages.append(CommMessage(**record))
+    return messages
+
+
+def _deliver(c, data: dict, buffers: typing.Sequence[bytes] = ()):
+    """Send a message to the kernel side of a comm, as a frontend would."""
+    c.handle_msg(
+        {
+            "content": {"comm_id": c.comm_id, "data": data},
+            "buffers": [memoryview(b) for b in buffers],
+        }
+    )
+
+
+class FakeFrontend:
+    """A headless stand-in for the frontend of a `NiiVue` widget.
+
+    It answers the messages of the widget like ``js/widget.ts`` does: it
+    assigns an id and a name to each volume and mesh, emits the
+    ``image_loaded`` and ``mesh_loaded`` events, requests the payloads it
+    does not hold and the regions written in the volumes, and reports the
+    payloads it holds and its memory usage.
+    No data is parsed or rendered. Combined with `CommRecorder`, this
+    measures the traffic of the widget without a browser.
+
+    Examples
+    --------
+    >>> nv = NiiVue()
+    >>> with CommRecorder() as recorder, FakeFrontend(nv):
+    ...     nv.load_volumes([{"path": "mni152.nii.gz"}])
+    >>> assert recorder.total_bytes("send") < 5_000_000
+    """
+
+    def __init__(self, nv):
+        self.nv = nv
+        # payloads held by the frontend, by digest
+        self.payloads: typing.Dict[str, bytes] = {}
+        # model ids of the rendered volumes and meshes
+        self.rendered = {"_volumes": [], "_meshes": []}
+        # the regions written in each volume since it was built, by model id
+        self.regions: typing.Dict[str, typing.List[dict]] = {}
+        self._hooks = _Hooks()
+        self._hooks.wrap(nv.comm, "publish_msg", self._niivue_msg)
+        self._watched = set()
+        self._send_event("view_connected", {})
+        for name in self.rendered:
+            self._render(name, nv.get_state(name)[name])
+        self._report()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Stop answering the messages of the widget."""
+        self._hooks.close()
+
+    def reload(self, widget):
+        """Build a volume or mesh again, e.g. as after it was evicted."""
+        for name, model_ids in self.rendered.items():
+            if widget.model_id in model_ids:
+                self._load(name, widget)
+                return
+        raise KeyError(f"{widget} is not rendered")
+
+    def _send_event(self, event: str, data: dict):
+        _deliver(
+            self.nv.comm,
+            {"method": "custom", "content": {"event": event, "data": data}},
+        )
+
+    def _niivue_msg(
+        self, original, msg_type, data=None, metadata=None, buffers=None, **keys
+    ):
+        result = original(
+            msg_type, data=data, metadata=metadata, buffers=buffers, **keys
+        )
+        if msg_type == "comm_msg" and data.get("method") == "update":
+            state = data["state"]
+            for name in self.rendered:
+                if name in state:
+                    self._render(name, state[name])
+            if {*self.rendered, "memory_budget"} & set(state):
+                self._report()
+        return result
+
+    def _widget(self, model_id: str):
+        for widget in [*self.nv._volumes, *self.nv._meshes]:
+            if widget.model_id == model_id:
+                return widget
+        raise KeyError(f"No volume or mesh with model id {model_id}")
+
+    def _render(self, name: str, ids: typing.List[str]):
+        model_ids = [i[len("IPY_MODEL_") :] for i in ids]
+        current = self.rendered[name]
+        if model_ids[:-1] == current and len(model_ids) == len(current) + 1:
+            # only the last one was added, the same as `determine_update_type`
+            new = model_ids[-1:]
+        else:
+            new = model_ids
+        self.rendered[name] = model_ids
+        for model_id in new:
+            self._load(name, self._widget(model_id))
+
+    def _load(self, name: str, widget):
+        if widget.model_id not in self._watched:
+            self._watched.add(widget.model_id)
+            self._hooks.wrap(widget.comm, "publish_msg", self._child_msg(widget))
+        state, buffer_paths, buffers = _remove_buffers(widget.get_state())
+        _put_buffers(state, buffer_paths, buffers)
+        files = [state.get("path")]
+        files.extend(layer.get("path") for layer in state.get("layers", []))
+        for file in files:
+            if file is not None:
+                self._hold(widget, file)
+        path = state.get("path")
+        model = {
+            "id": str(uuid.uuid4()),
+            "name": f"{widget.model_id[:6]}:{path['name'] if path else 'mesh'}",
+        }
+        _deliver(widget.comm, {"method": "update", "state": model, "buffer_paths": []})
+        event = "image_loaded" if name == "_volumes" else "mesh_loaded"
+        self._send_event(event, {"id": model["id"]})
+        if name == "_volumes":
+            # the image is built from the file, without the written regions
+            self.regions[widget.model_id] = []
+            _deliver(
+                widget.comm,
+                {"method": "custom", "content": {"type": "request_regions"}},
+            )
+
+    def _hold(self, widget, file: dict):
+        if file["data"] is not None:
+            self.payloads[file["digest"]] = bytes(file["data"])
+        elif file["digest"] not in self.payloads:
+            # Python answers synchronously, see `_child_msg`
+            _deliver(
+                widget.comm,
+                {
+                    "method": "custom",
+                    "content": {"type": "request_payload", "digest": file["digest"]},
+                },
+            )
+            if file["digest"] not in self.payloads:
+                raise RuntimeError(f"Payload {file['digest']} is not available")
+
+    def _child_msg(self, widget):
+        def publish_msg(
+            original, msg_type, data=None, metadata=None, buffers=None, **keys
+        ):
+            result = original(
+                msg_type, data=data, metadata=metadata, buffers=buffers, **keys
+            )
+            content = (data or {}).get("content", {})
+            if content.get("type") == "payload" and content["found"]:
+                self.payloads[content["digest"]] = bytes(buffers[0])
+            if content.get("type") == "update_region":
+                region = {**content["data"], "data": bytes(buffers[0])}
+                self.regions.setdefault(widget.model_id, []).append(region)
+            return result
+
+        return publish_msg
+
+    def _report(self):
+        self._send_event("payloads", {"digests": list(self.payloads), "released": 0})
+        layers = []
+        for name, kind in (("_volumes", "volume"), ("_meshes", "mesh")):
+            for model_id in self.rendered[name]:
+                layers.append(
+                    {
+                        "model_id": model_id,
+                        "kind": kind,
+                        "cpu": 0,
+                        "gpu": 0,
+                        "resident": True,
+                    }
+                )
+        self._send_event(
+            "memory_usage",
+            {
+                "budget": self.nv.memory_budget,
+                "cpu": 0,
+                "gpu": 0,
+                "exceeded": False,
+                "layers": layers,
+            },
+        )
@@ -2,26 +2,61 @@ import enum
 import pathlib
 import typing
 
+import numpy as np
+
+from ._constants import _ENUM_OPTIONS
+from ._payload import frontend_has, payload_digest, read_payload
+
 
 def snake_to_camel(snake_str: str):
     components = snake_str.split("_")
     return components[0] + "".join(x.title() for x in components[1:])
 
 
-def file_serializer(instance: typing.Union[pathlib.Path, str], widget: object):
-    if isinstance(instance, str):
-        # make sure we have a pathlib.Path instance
-        instance = pathlib.Path(instance)
-    return {"name": instance.name, "data": instance.read_bytes()}
+def file_serializer(instance: typing.Union[pathlib.Path, str, None], widget: object):
+    if instance is None:
+        return None
+    digest = payload_digest(instance)
+    if frontend_has(digest, widget):
+        # the frontend looks the bytes up by digest instead
+        return {"name": pathlib.Path(instance).name, "digest": digest, "data": None}
+    # files read ahead of time (e.g. by `ingest`) are not read again
+    payload = read_payload(instance)
+    return {"name": payload.name, "digest": payload.digest, "data": payload.data}
+
+
+def array_serializer(instance: typing.Optional[np.ndarray], widget: object):
+    if instance is None:
+        return None
+    # send the raw bytes as a single binary buffer, the frontend
+    # wraps them in a typed array without any parsing
+    instance = np.ascontiguousarray(instance)
+    return {
+        "dtype": str(instance.dtype),
+        "shape": list(instance.shape),
+        "data": memoryview(instance).cast("B"),
+    }
+
+
+def mesh_layer_serializer(instance: dict, widget: object):
+    if "values" in instance:
+        # per-vertex values given as an array instead of a layer file
+        values = np.asarray(instance["values"], dtype=np.float32)
+        return {**instance, "values": array_serializer(values, widget)}
+    return {**instance, "path": file_serializer(instance["path"], widget)}
 
 
 def mesh_layers_serializer(instance: list, widget: object):
-    return [
-        {**mesh_layer, "path": file_serializer(mesh_layer["path"], widget)}
-        for mesh_layer in instance
-    ]
+    return [mesh_layer_serializer(mesh_layer, widget) for mesh_layer in instance]
 
 
 def serialize_options(instance: dict, widget: object):
     # serialize enums as their value
     return {k: v.value if isinstance(v, enum.Enum) else v for k, v in instance.items()}
+
+
+def deserialize_options(instance: dict) -> dict:
+    # the enums are serialized as their value, see `serialize_options`
+    return {
+        k: _ENUM_OPTIONS[k](v) if k in _ENUM_OPTIONS else v for k, v in instance.items()
+    }
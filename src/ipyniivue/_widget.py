@@ -1,49 +1,441 @@
+import asyncio
+import collections
 import pathlib
+import typing
+import warnings
 
 import anywidget
 import ipywidgets
+import numpy as np
 import traitlets as t
 from ipywidgets import CallbackDispatcher
 
-from ._constants import _SNAKE_TO_CAMEL_OVERRIDES
+from ._bindings import Binding
+from ._colormaps import ColormapRegistry, get_colormap_registry
+from ._constants import _SNAKE_TO_CAMEL_OVERRIDES, _TYPED_ARRAY_DTYPES
+from ._dicom import dicom_to_nifti
+from ._lod import (
+    LOD_REFINE_ZOOM,
+    mesh_colors_serializer,
+    mesh_faces_serializer,
+    mesh_file_serializer,
+    mesh_layers_lod_serializer,
+    mesh_vertices_serializer,
+    reduce_vertex_data,
+)
 from ._options_mixin import OptionsMixin
+from ._payload import (
+    forget_frontend,
+    ingest,
+    payload_by_digest,
+    set_displayed,
+    set_frontend_digests,
+)
+from ._reduce import Reduction, volume_file_serializer, volume_reduction
+from ._state import STATE_VERSION, verify_files, widget_kwargs, widget_state
 from ._utils import (
-    file_serializer,
-    mesh_layers_serializer,
+    deserialize_options,
     serialize_options,
     snake_to_camel,
 )
 
-__all__ = ["NiiVue"]
+__all__ = ["Mesh", "NiiVue", "Volume"]
 
 
-class Mesh(ipywidgets.Widget):
-    path = t.Union([t.Instance(pathlib.Path), t.Unicode()]).tag(
-        sync=True, to_json=file_serializer
+class _PayloadWidget(ipywidgets.Widget):
+    """A widget whose files the frontend can request again by digest.
+
+    The frontend does this when it did not keep the bytes of a file (see
+    `_payload.frontend_has`), and needs them to build the scene again.
+    """
+
+    def _handle_custom_msg(self, content, buffers):
+        if content.get("type") != "request_payload":
+            super()._handle_custom_msg(content, buffers)
+            return
+        data = self._payload_data(content["digest"])
+        self.send(
+            {
+                "type": "payload",
+                "digest": content["digest"],
+                "found": data is not None,
+            },
+            buffers=[] if data is None else [data],
+        )
+
+    def _payload_data(self, digest: str) -> typing.Optional[bytes]:
+        payload = payload_by_digest(digest)
+        if payload is not None:
+            return payload.data
+        # payloads derived from a file (e.g. a level of detail) are made again
+        state = self.get_state()
+        files = [
+            state["path"],
+            *(layer.get("path") for layer in state.get("layers", [])),
+        ]
+        for file in files:
+            if file and file["digest"] == digest and file["data"] is not None:
+                return file["data"]
+        return None
+
+
+class Mesh(_PayloadWidget):
+    path = t.Union(
+        [t.Instance(pathlib.Path), t.Unicode()], default_value=None, allow_none=True
+    ).tag(sync=True, to_json=mesh_file_serializer)
+    vertices = t.Instance(np.ndarray, allow_none=True).tag(
+        sync=True, to_json=mesh_vertices_serializer
+    )
+    faces = t.Instance(np.ndarray, allow_none=True).tag(
+        sync=True, to_json=mesh_faces_serializer
     )
+    colors = t.Instance(np.ndarray, allow_none=True).tag(
+        sync=True, to_json=mesh_colors_serializer
+    )
+    # Lower levels of detail subsample tractograms (.tck, .trk files) and
+    # decimate meshes created from arrays before they are sent. Meshes are
+    # refined to "full" when the 3D render is zoomed in.
+    lod = t.Enum(["low", "medium", "full"], default_value="full")
     id = t.Unicode(default_value="").tag(sync=True)
     name = t.Unicode(default_value="").tag(sync=True)
     rgba255 = t.List([0, 0, 0, 0]).tag(sync=True)
     opacity = t.Float(1.0).tag(sync=True)
     visible = t.Bool(True).tag(sync=True)
-    layers = t.List([]).tag(sync=True, to_json=mesh_layers_serializer)
+    layers = t.List([]).tag(sync=True, to_json=mesh_layers_lod_serializer)
+
+    @t.validate("layers")
+    def _valid_layers(self, proposal):
+        # keep the values as arrays, so they are not converted on every sync
+        return [
+            {**layer, "values": np.ascontiguousarray(layer["values"], dtype=np.float32)}
+            if "values" in layer
+            else layer
+            for layer in proposal["value"]
+        ]
+
+    @t.observe("lod")
+    def _lod_changed(self, change):
+        # the serialized data depends on the level of detail
+        self.send_state(["path", "vertices", "faces", "colors", "layers"])
+
+    @classmethod
+    def from_arrays(cls, vertices, faces, colors=None, **kwargs):
+        """Create a mesh from vertex and face arrays.
+
+        The arrays are sent to the frontend as raw binary buffers, so no file
+        is written and no mesh format has to be parsed in the browser.
 
+        Parameters
+        ----------
+        vertices : array_like
+            An (N, 3) array with the vertex positions in mm.
+        faces : array_like
+            An (M, 3) array with the vertex indices of each triangle.
+        colors : array_like, optional
+            An (N, 4) array with an RGBA color (0-255) for each vertex.
+        **kwargs
+            Other mesh attributes, e.g. `opacity` or `layers`.
+        """
+        vertices = np.ascontiguousarray(vertices, dtype=np.float32)
+        faces = np.ascontiguousarray(faces, dtype=np.uint32)
+        if vertices.ndim != 2 or vertices.shape[1] != 3:
+            raise ValueError(f"vertices must have shape (N, 3), got {vertices.shape}")
+        if faces.ndim != 2 or faces.shape[1] != 3:
+            raise ValueError(f"faces must have shape (M, 3), got {faces.shape}")
+        if faces.size and faces.max() >= len(vertices):
+            raise ValueError("faces reference vertices that do not exist")
+        if colors is not None:
+            colors = np.ascontiguousarray(colors, dtype=np.uint8)
+            if colors.shape != (len(vertices), 4):
+                raise ValueError(
+                    f"colors must have shape ({len(vertices)}, 4), got {colors.shape}"
+                )
+        return cls(vertices=vertices, faces=faces, colors=colors, **kwargs)
+
+    def set_layer_values(self, index: int, values):
+        """Replace the per-vertex values of a layer in place.
+
+        Only the new values are sent to the frontend (as a single float32
+        buffer), where the layer is updated without rebuilding the mesh.
+        Repeated updates are coalesced so the colors are refreshed at most
+        once per animation frame.
 
-class Volume(ipywidgets.Widget):
+        Parameters
+        ----------
+        index : int
+            The index of the layer in `layers`.
+        values : array_like
+            One value per vertex.
+        """
+        layer = self.layers[index]
+        values = np.ascontiguousarray(values, dtype=np.float32).ravel()
+        if self.vertices is not None and len(values) != len(self.vertices):
+            raise ValueError(
+                f"Expected {len(self.vertices)} values (one per vertex), "
+                f"got {len(values)}"
+            )
+        # replace the item without reassigning `layers`, so that the
+        # whole list is not synced again
+        self.layers[index] = {**layer, "values": values}
+        values = reduce_vertex_data(self, values)
+        self.send(
+            {"type": "layer_values", "data": {"index": index}},
+            buffers=[memoryview(values).cast("B")],
+        )
+
+
+class Volume(_PayloadWidget):
     path = t.Union([t.Instance(pathlib.Path), t.Unicode()]).tag(
-        sync=True, to_json=file_serializer
+        sync=True, to_json=volume_file_serializer
     )
+    # Opt-in reductions of NIfTI images before they are sent: "lossless"
+    # stores the voxels in the smallest type that holds them exactly, and
+    # "quantize" maps the values within [cal_min, cal_max] to 256 levels.
+    # `crop` only sends the bounding box of the nonzero voxels.
+    downcast = t.Enum(["none", "lossless", "quantize"], default_value="none")
+    crop = t.Bool(False)
     id = t.Unicode(default_value="").tag(sync=True)
     name = t.Unicode(default_value="").tag(sync=True)
     opacity = t.Float(1.0).tag(sync=True)
     colormap = t.Unicode("gray").tag(sync=True)
+    colormap_label = t.Unicode(None, allow_none=True).tag(sync=True)
     colorbar_visible = t.Bool(True).tag(sync=True)
     cal_min = t.Float(None, allow_none=True).tag(sync=True)
     cal_max = t.Float(None, allow_none=True).tag(sync=True)
 
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # the regions written by `update_region`, in the voxels of the file,
+        # which are written again whenever the frontend rebuilds the volume
+        self._regions: typing.List[typing.Tuple[tuple, np.ndarray]] = []
+
+    @classmethod
+    def from_dicom_dir(
+        cls,
+        path: typing.Union[pathlib.Path, str],
+        series_uid: typing.Optional[str] = None,
+        cache_dir: typing.Union[pathlib.Path, str, None] = None,
+        max_workers: typing.Optional[int] = None,
+        **kwargs,
+    ) -> "Volume":
+        """Create a volume from a directory of DICOM slices.
+
+        The series is converted to a NIfTI file once, and the file is reused
+        as long as the slices do not change (see `dicom_to_nifti`).
+
+        Parameters
+        ----------
+        path : path
+            The directory containing the series.
+        series_uid : str, optional
+            The SeriesInstanceUID of the series, required if the directory
+            contains more than one.
+        cache_dir : path, optional
+            Where the converted series are kept.
+        max_workers : int, optional
+            The number of processes decoding the slices.
+        **kwargs
+            Other attributes of the volume, e.g. ``colormap``.
+        """
+        nifti = dicom_to_nifti(
+            path, series_uid=series_uid, cache_dir=cache_dir, max_workers=max_workers
+        )
+        return cls(path=nifti, **kwargs)
+
+    @t.observe("downcast", "crop")
+    def _reduction_changed(self, change):
+        # the serialized data depends on the reduction
+        self.send_state(["path"])
+
+    @t.observe("path")
+    def _path_changed(self, change):
+        # the regions were written over the previous file
+        self._regions = []
+
+    def _handle_custom_msg(self, content, buffers):
+        if content.get("type") != "request_regions":
+            super()._handle_custom_msg(content, buffers)
+            return
+        # the frontend built the volume from the file again
+        for offset, array in self._regions:
+            try:
+                self._send_region(array, offset)
+            except ValueError as e:
+                warnings.warn(
+                    f"A region written with update_region cannot be restored ({e})",
+                    stacklevel=2,
+                )
+
+    @property
+    def reduction(self) -> typing.Optional[Reduction]:
+        """How the image is reduced before it is sent, or `None` if it is not.
+
+        ``reduction.saved_bytes`` is the difference with the size of the file.
+        """
+        return volume_reduction(self)
+
+    def update_region(self, array, offset=(0, 0, 0)):
+        """Overwrite a block of voxels in place.
+
+        Only the changed block is sent to the frontend (as a single binary
+        buffer), where it is written into the loaded image. The file at
+        `path` is left untouched. The regions are kept until `path` changes,
+        and written again whenever the frontend builds the image again (e.g.
+        after it was evicted, or when the page is reloaded).
+
+        Parameters
+        ----------
+        array : array_like
+            A 3D array with the new voxel values, indexed as ``[i, j, k]``
+            in the voxel order of the image file.
+        offset : tuple of int, optional
+            The voxel index ``(i, j, k)`` of the first voxel of `array`.
+        """
+        array = np.asarray(array)
+        if array.dtype == bool:
+            array = array.astype(np.uint8)
+        if array.dtype.name not in _TYPED_ARRAY_DTYPES:
+            raise ValueError(f"Unsupported dtype for a region: {array.dtype}")
+        if array.ndim != 3:
+            raise ValueError(f"array must be 3D, got {array.ndim} dimensions")
+        if len(offset) != 3 or any(o < 0 for o in offset):
+            raise ValueError(f"offset must be 3 non-negative ints, got {offset}")
+        offset = tuple(int(o) for o in offset)
+        self._send_region(array, offset)
+        # a region that is written over entirely is not needed anymore
+        end = np.add(offset, array.shape)
+        self._regions = [
+            (o, a)
+            for o, a in self._regions
+            if (np.less(o, offset) | np.greater(np.add(o, a.shape), end)).any()
+        ]
+        self._regions.append((offset, array.copy()))
+
+    def _send_region(self, array: np.ndarray, offset: tuple):
+        reduction = self.reduction
+        if reduction is not None:
+            array, offset = self._reduced_region(reduction, array, offset)
+        # NIfTI stores the first (i) index fastest, i.e. in Fortran order
+        data = np.ascontiguousarray(array.ravel(order="F"))
+        self.send(
+            {
+                "type": "update_region",
+                "data": {
+                    "offset": [int(o) for o in offset],
+                    "shape": list(array.shape),
+                    "dtype": array.dtype.name,
+                },
+            },
+            buffers=[memoryview(data).cast("B")],
+        )
+
+    @staticmethod
+    def _reduced_region(reduction: Reduction, array: np.ndarray, offset):
+        """Express a region of the file in the voxels that were sent."""
+        if reduction.scale is not None:
+            raise ValueError("Regions cannot be updated in a quantized volume")
+        offset = np.asarray(offset) - reduction.offset[:3]
+        if (offset < 0).any() or (offset + array.shape > reduction.shape[:3]).any():
+            raise ValueError(
+                "The region is outside of the cropped volume, set crop=False "
+                "to update it"
+            )
+        reduced = array.astype(reduction.dtype)
+        if not np.array_equal(reduced, array):
+            raise ValueError(
+                f"The region does not fit in the {reduction.dtype} voxels that "
+                "were sent, set downcast='none' to update it"
+            )
+        return reduced, offset.tolist()
+
+
+def _item_paths(item: dict) -> list:
+    paths = [item.get("path")]
+    paths.extend(layer["path"] for layer in item.get("layers", []) if "path" in layer)
+    return [path for path in paths if path is not None]
+
+
+def _ready_items(items: list, max_workers=None, ordered=True):
+    """Read the files of all the items concurrently, and yield their indices.
+
+    The indices are yielded in the order of `items`, or, if `ordered` is
+    False, as soon as all the files of each item are read.
+    """
+    files = [(i, path) for i, item in enumerate(items) for path in _item_paths(item)]
+    remaining = collections.Counter(i for i, _ in files)
+    pending = list(range(len(items)))
+
+    def ready():
+        while pending and remaining[pending[0]] == 0:
+            yield pending.pop(0)
+        if not ordered:
+            for i in [i for i in pending if remaining[i] == 0]:
+                pending.remove(i)
+                yield i
+
+    yield from ready()
+    paths = [path for _, path in files]
+    for j, _ in ingest(paths, max_workers=max_workers, ordered=False):
+        remaining[files[j][0]] -= 1
+        yield from ready()
+
+
+def _create_widgets(cls, items: list, max_workers=None, ordered=True):
+    """Create a `cls` widget for each item, reading all their files concurrently.
+
+    The widgets are yielded in the order of `items`, or, if `ordered` is
+    False, as soon as all the files of each item are read.
+    """
+    for i in _ready_items(items, max_workers, ordered):
+        yield cls(**items[i])
+
+
+async def _create_widgets_async(cls, items: list, max_workers=None, ordered=True):
+    """Like `_create_widgets`, but read the files without blocking the event loop.
+
+    The widgets are still created on the event loop, as they open comms.
+    """
+    loop = asyncio.get_running_loop()
+    ready = _ready_items(items, max_workers, ordered)
+    while True:
+        i = await loop.run_in_executor(None, next, ready, None)
+        if i is None:
+            return
+        yield cls(**items[i])
+
+
+def _background_task(coroutine) -> "asyncio.Task":
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        coroutine.close()
+        raise RuntimeError(
+            "Loading in the background needs a running event loop, "
+            "e.g. a Jupyter kernel"
+        ) from None
+    return loop.create_task(coroutine)
+
 
 class NiiVue(OptionsMixin, anywidget.AnyWidget):
-    """Represents a Niivue instance."""
+    """Represents a Niivue instance.
+
+    Parameters
+    ----------
+    height : int, optional
+        The height of the canvas in pixels.
+    release_buffers : bool, optional
+        If `True`, the frontend drops the bytes of each file once it has been
+        parsed, instead of keeping a copy in the widget state. The bytes are
+        requested from Python again if the scene has to be rebuilt.
+    memory_budget : int, optional
+        The memory (in bytes) that the volumes and meshes may use in the
+        browser, CPU and GPU combined. When it is exceeded, the hidden
+        layers are evicted, and loaded again when they are changed while
+        visible. Visible layers are kept, with a warning if they alone
+        exceed the budget. Unlimited by default.
+    **options
+        The Niivue options, in snake case.
+    """
 
     _esm = pathlib.Path(__file__).parent / "static" / "widget.js"
 
@@ -55,14 +447,40 @@ class NiiVue(OptionsMixin, anywidget.AnyWidget):
     _meshes = t.List(t.Instance(Mesh), default_value=[]).tag(
         sync=True, **ipywidgets.widget_serialization
     )
-
-    def __init__(self, height: int = 300, **options):
+    _colormaps = t.Instance(ColormapRegistry).tag(
+        sync=True, **ipywidgets.widget_serialization
+    )
+    # camera and crosshair restored by `load_state`
+    _scene = t.Dict({}).tag(sync=True)
+    release_buffers = t.Bool(False).tag(sync=True)
+    memory_budget = t.Int(None, allow_none=True).tag(sync=True)
+
+    def __init__(
+        self,
+        height: int = 300,
+        release_buffers: bool = False,
+        memory_budget: typing.Optional[int] = None,
+        **options,
+    ):
         # convert to JS camelCase options
         _opts = {
             _SNAKE_TO_CAMEL_OVERRIDES.get(k, snake_to_camel(k)): v
             for k, v in options.items()
         }
-        super().__init__(height=height, _opts=_opts, _volumes=[], _meshes=[])
+        super().__init__(
+            height=height,
+            release_buffers=release_buffers,
+            memory_budget=memory_budget,
+            _opts=_opts,
+            _volumes=[],
+            _meshes=[],
+            _colormaps=get_colormap_registry(),
+        )
+
+        # camera and crosshair, as last reported by the frontend
+        self._current_scene = {}
+        self._released_bytes = 0
+        self._memory_usage = {"cpu": 0, "gpu": 0, "exceeded": False, "layers": []}
 
         # on event
         self._event_handlers = {}
@@ -76,9 +494,48 @@ class NiiVue(OptionsMixin, anywidget.AnyWidget):
         else:
             self._event_handlers[event_name].register_callback(callback)
 
+    @t.observe("_volumes", "_meshes")
+    def _displayed_changed(self, change):
+        # the payloads are only left out for the frontends that display them
+        if self.comm is not None:
+            set_displayed(
+                self.model_id, [w.model_id for w in [*self._volumes, *self._meshes]]
+            )
+
+    def close(self):
+        if self.comm is not None:
+            forget_frontend(self.model_id)
+        super().close()
+
     def _handle_custom_msg(self, content, buffers):
         event = content.get("event", "")
         data = content.get("data", {})
+        if event == "view_connected":
+            # a new view starts without any of the payloads
+            set_frontend_digests(self.model_id, [])
+            return
+        if event == "payloads":
+            set_frontend_digests(self.model_id, data["digests"])
+            self._released_bytes = data.get("released", 0)
+            return
+        if event == "memory_usage":
+            if data.get("exceeded") and not self._memory_usage.get("exceeded"):
+                warnings.warn(
+                    f"The visible volumes and meshes use {data['cpu'] + data['gpu']}"
+                    f" bytes, more than the memory budget of {data['budget']}",
+                    stacklevel=2,
+                )
+            self._memory_usage = data
+            return
+        if event == "azimuth_elevation_change":
+            self._current_scene.update(data)
+        elif event == "location_change":
+            self._current_scene["crosshair"] = data["frac"]
+        elif event == "zoom_3d_change":
+            self._current_scene["zoom"] = data["zoom"]
+            if data["zoom"] >= LOD_REFINE_ZOOM:
+                for mesh in self._meshes:
+                    mesh.lod = "full"
         if event in self._event_handlers:
             if event == "image_loaded":
                 idx = self.get_volume_index_by_id(data["id"])
@@ -203,6 +660,10 @@ class NiiVue(OptionsMixin, anywidget.AnyWidget):
         """Register a callback for the 'volume_updated' event."""
         self._register_callback("volume_updated", callback, remove=remove)
 
+    def on_zoom_3d_change(self, callback, remove=False):
+        """Register a callback for the 'zoom_3d_change' event."""
+        self._register_callback("zoom_3d_change", callback, remove=remove)
+
     """
     Methods
     """
@@ -219,6 +680,141 @@ class NiiVue(OptionsMixin, anywidget.AnyWidget):
             'data': filename
         })
 
+    @property
+    def released_bytes(self) -> int:
+        """The number of file bytes the frontend dropped after parsing them.
+
+        Only files are released, when `release_buffers` is enabled. The value
+        is the last one reported by the frontend.
+        """
+        return self._released_bytes
+
+    def memory_usage(self) -> dict:
+        """Return the memory used by the volumes and meshes in the browser.
+
+        The sizes are estimates in bytes, as last reported by the frontend.
+
+        Returns
+        -------
+        dict
+            With the ``budget`` (see `memory_budget`), the total ``cpu`` and
+            ``gpu`` memory, whether the budget is ``exceeded`` by the visible
+            layers (which are never evicted), and the ``layers``: for each
+            volume and mesh, its ``widget``, ``cpu`` and ``gpu`` memory, and
+            whether it is ``resident`` (i.e. not evicted).
+        """
+        widgets = {w.model_id: w for w in [*self._volumes, *self._meshes]}
+        return {
+            "budget": self.memory_budget,
+            "cpu": self._memory_usage["cpu"],
+            "gpu": self._memory_usage["gpu"],
+            "exceeded": self._memory_usage.get("exceeded", False),
+            "layers": [
+                {
+                    "widget": widgets.get(layer["model_id"]),
+                    "cpu": layer["cpu"],
+                    "gpu": layer["gpu"],
+                    "resident": layer["resident"],
+                }
+                for layer in self._memory_usage["layers"]
+            ],
+        }
+
+    def save_state(self) -> dict:
+        """Capture the whole scene as a compact document.
+
+        Files and arrays are referenced by their content digest instead of
+        being included, and the document can be stored as JSON.
+
+        Returns
+        -------
+        dict
+            The document to pass to `load_state`.
+        """
+        return {
+            "version": STATE_VERSION,
+            "height": self.height,
+            "opts": serialize_options(self._opts, self),
+            "volumes": [widget_state(volume) for volume in self._volumes],
+            "meshes": [widget_state(mesh) for mesh in self._meshes],
+            "scene": dict(self._current_scene),
+        }
+
+    def load_state(self, state: dict, max_workers: typing.Optional[int] = None):
+        """Restore a scene captured with `save_state`.
+
+        The files are read concurrently and checked against their digest,
+        and only the payloads that the frontend does not already hold are
+        sent. The frontend is updated in a single step.
+
+        Parameters
+        ----------
+        state : dict
+            A document returned by `save_state`.
+        max_workers : int, optional
+            The maximum number of files read at the same time.
+        """
+        if state.get("version") != STATE_VERSION:
+            raise ValueError(f"Unsupported state version: {state.get('version')}")
+        files = []
+        volumes = [widget_kwargs(volume, files) for volume in state["volumes"]]
+        meshes = [widget_kwargs(mesh, files) for mesh in state["meshes"]]
+        verify_files(files, max_workers=max_workers)
+        volumes = [Volume(**volume) for volume in volumes]
+        meshes = [Mesh(**mesh) for mesh in meshes]
+        with self.hold_sync():
+            self.height = state["height"]
+            self._opts = deserialize_options(state["opts"])
+            self._volumes = volumes
+            self._meshes = meshes
+            self._scene = state["scene"]
+        self._current_scene = dict(state["scene"])
+
+    def bind(
+        self,
+        widget,
+        path: str,
+        throttle_ms: int = 30,
+        mode: str = "latest",
+        js: bool = False,
+    ) -> Binding:
+        """Set a property of the viewer from the ``value`` of a control.
+
+        While the control changes (e.g. a slider being dragged), the
+        property is set at most once every `throttle_ms`, to the latest
+        value, instead of syncing every intermediate value.
+
+        Parameters
+        ----------
+        widget : ipywidgets.Widget
+            The control, e.g. a slider.
+        path : str
+            The property to set, relative to the viewer, e.g.
+            ``"volumes[0].cal_max"`` or ``"crosshair_width"``.
+        throttle_ms : int, optional
+            The minimum time between two updates, in milliseconds.
+        mode : {"latest", "debounce"}, optional
+            With "latest", the latest value is set at most once every
+            `throttle_ms`. With "debounce", it is only set once the control
+            has not changed for `throttle_ms`.
+        js : bool, optional
+            If `True`, link the control in the browser, so the viewer is
+            updated without a round trip to the kernel. Only for properties
+            that are synced traits of a volume or mesh (e.g. ``cal_max`` or
+            ``opacity``), since options are sent as a whole.
+
+        Returns
+        -------
+        Binding
+            Call its `unlink` method to remove the binding.
+
+        Examples
+        --------
+        >>> slider = ipywidgets.FloatSlider(min=0, max=100)
+        >>> nv.bind(slider, "volumes[0].cal_max")
+        """
+        return Binding(widget, self, path, throttle_ms=throttle_ms, mode=mode, js=js)
+
     def get_volume_index_by_id(self, id_: str) -> int:
         """Return the index of the volume with the given id.
 
@@ -232,42 +828,122 @@ class NiiVue(OptionsMixin, anywidget.AnyWidget):
                 return idx
         return -1
 
-    def load_volumes(self, volumes: list):
+    def load_volumes(
+        self,
+        volumes: list,
+        max_workers: typing.Optional[int] = None,
+        ordered: bool = True,
+        background: bool = False,
+    ) -> typing.Optional["asyncio.Task"]:
         """Load a list of volumes into the widget.
 
+        The files of all the volumes are read concurrently.
+
         Parameters
         ----------
         volumes : list
             A list of dictionaries containing the volume information.
+        max_workers : int, optional
+            The maximum number of files read at the same time.
+        ordered : bool, optional
+            If `True` (the default), the volumes are loaded together, in order.
+            Otherwise each volume is added as soon as its files are read.
+        background : bool, optional
+            If `True`, return immediately, and read the files while the
+            kernel keeps running other cells. This needs a running event
+            loop, e.g. a Jupyter kernel.
+
+        Returns
+        -------
+        asyncio.Task or None
+            With `background`, the task that loads the volumes, which can be
+            awaited.
         """
-        volumes = [Volume(**item) for item in volumes]
-        self._volumes = volumes
-
-    def add_volume(self, volume: dict):
+        if background:
+            return _background_task(
+                self._load_async(
+                    Volume, "_volumes", list(volumes), max_workers, ordered
+                )
+            )
+        volumes = _create_widgets(Volume, list(volumes), max_workers, ordered)
+        if ordered:
+            self._volumes = list(volumes)
+        else:
+            self._volumes = []
+            for volume in volumes:
+                self._volumes = [*self._volumes, volume]
+        return None
+
+    async def _load_async(self, cls, name: str, items: list, max_workers, ordered):
+        widgets = _create_widgets_async(cls, items, max_workers, ordered)
+        if ordered:
+            setattr(self, name, [widget async for widget in widgets])
+            return
+        setattr(self, name, [])
+        async for widget in widgets:
+            setattr(self, name, [*getattr(self, name), widget])
+
+    def add_volume(self, volume: typing.Union[dict, Volume]):
         """Add a single volume to the widget.
 
         Parameters
         ----------
-        volume : dict
-            A dictionary containing the volume information.
+        volume : dict or Volume
+            A dictionary containing the volume information, or a volume
+            e.g. from `Volume.from_dicom_dir`.
         """
-        self._volumes = [*self._volumes, Volume(**volume)]
+        if not isinstance(volume, Volume):
+            volume = Volume(**volume)
+        self._volumes = [*self._volumes, volume]
 
     @property
     def volumes(self):
         """Returns the list of volumes."""
         return list(self._volumes)
 
-    def load_meshes(self, meshes: list):
+    def load_meshes(
+        self,
+        meshes: list,
+        max_workers: typing.Optional[int] = None,
+        ordered: bool = True,
+        background: bool = False,
+    ) -> typing.Optional["asyncio.Task"]:
         """Load a list of meshes into the widget.
 
+        The files of all the meshes are read concurrently.
+
         Parameters
         ----------
         meshes : list
             A list of dictionaries containing the mesh information.
+        max_workers : int, optional
+            The maximum number of files read at the same time.
+        ordered : bool, optional
+            If `True` (the default), the meshes are loaded together, in order.
+            Otherwise each mesh is added as soon as its files are read.
+        background : bool, optional
+            If `True`, return immediately, and read the files while the
+            kernel keeps running other cells. This needs a running event
+            loop, e.g. a Jupyter kernel.
+
+        Returns
+        -------
+        asyncio.Task or None
+            With `background`, the task that loads the meshes, which can be
+            awaited.
         """
-        meshes = [Mesh(**item) for item in meshes]
-        self._meshes = meshes
+        if background:
+            return _background_task(
+                self._load_async(Mesh, "_meshes", list(meshes), max_workers, ordered)
+            )
+        meshes = _create_widgets(Mesh, list(meshes), max_workers, ordered)
+        if ordered:
+            self._meshes = list(meshes)
+        else:
+            self._meshes = []
+            for mesh in meshes:
+                self._meshes = [*self._meshes, mesh]
+        return None
 
     def add_mesh(self, mesh: Mesh):
         """Add a single mesh to the widget.
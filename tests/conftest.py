@@ -0,0 +1,21 @@
+import pathlib
+
+# anywidget reads the bundle when the package is imported, which fails
+# until `npm run build` is run, so the tests use an empty module meanwhile
+_BUNDLE = (
+    pathlib.Path(__file__).parents[1] / "src" / "ipyniivue" / "static" / "widget.js"
+)
+_placeholder = False
+
+
+def pytest_configure(config):
+    global _placeholder
+    if not _BUNDLE.exists():
+        _BUNDLE.parent.mkdir(parents=True, exist_ok=True)
+        _BUNDLE.write_text("export default {};\n")
+        _placeholder = True
+
+
+def pytest_unconfigure(config):
+    if _placeholder:
+        _BUNDLE.unlink()
@@ -2,3 +2,862 @@ def test_it_loads():
     import ipyniivue
 
     assert ipyniivue.__version__ is not None
+
+
+def test_mesh_from_arrays():
+    import numpy as np
+    import pytest
+
+    from ipyniivue import Mesh
+
+    vertices = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0]], dtype=np.float64)
+    mesh = Mesh.from_arrays(vertices, [[0, 1, 2]])
+    state = mesh.get_state()
+    assert state["path"] is None
+    assert state["vertices"]["dtype"] == "float32"
+    assert state["vertices"]["shape"] == [3, 3]
+    assert state["vertices"]["data"].nbytes == 3 * 3 * 4
+    assert state["faces"]["dtype"] == "uint32"
+
+    with pytest.raises(ValueError):
+        Mesh.from_arrays(vertices, [[0, 1, 3]])
+
+
+def test_mesh_set_layer_values():
+    import numpy as np
+
+    from ipyniivue import CommRecorder, FakeFrontend, Mesh, NiiVue
+
+    vertices = [[0, 0, 0], [100, 0, 0], [0, 100, 0]]
+    mesh = Mesh.from_arrays(vertices, [[0, 1, 2]], layers=[{"values": [0, 1, 2]}])
+    sent = []
+    mesh.send = lambda content, buffers=None: sent.append((content, buffers))
+    mesh.set_layer_values(0, np.array([3, 4, 5]))
+
+    assert sent[0][0] == {"type": "layer_values", "data": {"index": 0}}
+    assert np.frombuffer(sent[0][1][0], dtype=np.float32).tolist() == [3, 4, 5]
+    state = mesh.get_state("layers")["layers"]
+    assert np.frombuffer(state[0]["values"]["data"], dtype=np.float32)[0] == 3
+
+    # the mesh is rebuilt with the current values, e.g. in a new view
+    del mesh.send
+    nv = NiiVue()
+    try:
+        with CommRecorder() as recorder:
+            recorder.attach(mesh)
+            nv.add_mesh(mesh)
+            with FakeFrontend(nv):
+                mesh.lod = "medium"
+    finally:
+        nv.close()
+    (update,) = recorder.filter("send", kind="update", widget=mesh)
+    assert np.float32([3, 4, 5]).tobytes() in update.buffers
+    assert np.float32([0, 1, 2]).tobytes() not in update.buffers
+
+
+def test_volume_update_region(tmp_path):
+    import numpy as np
+
+    from ipyniivue import Volume
+
+    path = tmp_path / "image.nii"
+    path.write_bytes(b"\0" * 352)
+    volume = Volume(path=path)
+    sent = []
+    volume.send = lambda content, buffers=None: sent.append((content, buffers))
+    region = np.arange(24, dtype=np.int16).reshape(2, 3, 4)
+    volume.update_region(region, offset=(1, 2, 3))
+
+    content, buffers = sent[0]
+    assert content["data"] == {
+        "offset": [1, 2, 3],
+        "shape": [2, 3, 4],
+        "dtype": "int16",
+    }
+    # first index varies fastest, like in the image file
+    assert np.frombuffer(buffers[0], dtype=np.int16)[:3].tolist() == [0, 12, 4]
+
+
+def test_volume_regions_survive_a_rebuild(tmp_path):
+    import numpy as np
+
+    from ipyniivue import FakeFrontend, NiiVue
+
+    path = tmp_path / "image.nii"
+    path.write_bytes(b"\0" * 352)
+    nv = NiiVue()
+    try:
+        with FakeFrontend(nv) as frontend:
+            nv.load_volumes([{"path": path}])
+            volume = nv.volumes[0]
+            volume.update_region(np.ones((2, 2, 2), np.uint8), offset=(1, 1, 1))
+            # a region written over entirely is only written once
+            volume.update_region(np.full((4, 4, 4), 2, np.uint8))
+            volume.update_region(np.full((1, 1, 1), 3, np.uint8), offset=(5, 5, 5))
+            assert len(frontend.regions[volume.model_id]) == 3
+
+            # e.g. once the volume was evicted and loaded again
+            frontend.reload(volume)
+            regions = frontend.regions[volume.model_id]
+            assert [(r["offset"], r["shape"]) for r in regions] == [
+                ([0, 0, 0], [4, 4, 4]),
+                ([5, 5, 5], [1, 1, 1]),
+            ]
+            assert regions[0]["data"] == bytes([2] * 64)
+
+            # the regions were written over the previous file
+            other = tmp_path / "other.nii"
+            other.write_bytes(b"\0" * 352)
+            volume.path = other
+            frontend.reload(volume)
+            assert frontend.regions[volume.model_id] == []
+    finally:
+        nv.close()
+
+
+def test_colormap_registry_is_shared():
+    import numpy as np
+
+    from ipyniivue import NiiVue, register_colormap, register_label_lut
+    from ipyniivue._colormaps import get_colormap_registry
+
+    register_colormap("ramp", np.linspace(0, 1, 8)[:, None].repeat(3, axis=1))
+    register_label_lut("atlas", [[0, 0, 0], [255, 0, 0]], labels=["bg", "roi"])
+    (replaced,) = [c for c in get_colormap_registry().colormaps if c.name == "ramp"]
+    register_colormap("ramp", [[0, 0, 0, 0], [255, 255, 255, 255]])
+    # the replaced colormap does not keep its comm open
+    assert replaced.comm is None
+
+    a, b = NiiVue(), NiiVue()
+    assert a._colormaps is b._colormaps
+    colormaps = {c.name: c for c in a._colormaps.colormaps}
+    assert sorted(colormaps) == ["atlas", "ramp"]
+    assert colormaps["ramp"].rgba.shape == (2, 4)
+    assert colormaps["atlas"].is_label
+    assert colormaps["atlas"].rgba[1].tolist() == [255, 0, 0, 255]
+
+
+def test_lod_tractogram_and_surface(tmp_path):
+    import base64
+    import zlib
+
+    import numpy as np
+
+    from ipyniivue import Mesh
+    from ipyniivue._lod import (
+        Streamlines,
+        SurfaceFile,
+        read_mz3,
+        read_tck,
+        write_mz3,
+        write_tck,
+    )
+
+    lengths = np.arange(2, 42)
+    points = np.random.default_rng(0).random((lengths.sum(), 3), dtype=np.float32)
+    streamlines = Streamlines(points, np.concatenate([[0], np.cumsum(lengths)]))
+    roundtrip = read_tck(write_tck(streamlines))
+    np.testing.assert_array_equal(roundtrip.offsets, streamlines.offsets)
+    np.testing.assert_array_equal(roundtrip.points, points)
+
+    path = tmp_path / "tracts.tck"
+    path.write_bytes(write_tck(streamlines))
+    mesh = Mesh(path=path, lod="low")
+    sent = mesh.get_state("path")["path"]
+    assert sent["name"] == "tracts.tck"
+    assert len(read_tck(sent["data"]).offsets) - 1 == 2
+
+    n = 50
+    u, v = np.meshgrid(np.arange(n), np.arange(n))
+    grid = np.arange(n * n).reshape(n, n)
+    a, b, c, d = grid[:-1, :-1], grid[1:, :-1], grid[:-1, 1:], grid[1:, 1:]
+    faces = np.concatenate(
+        [
+            np.column_stack([a.ravel(), b.ravel(), c.ravel()]),
+            np.column_stack([b.ravel(), d.ravel(), c.ravel()]),
+        ]
+    )
+    vertices = np.column_stack([u.ravel(), v.ravel(), np.zeros(n * n)])
+    mesh = Mesh.from_arrays(vertices, faces, lod="medium")
+    state = mesh.get_state(["vertices", "faces"])
+    n_vertices = state["vertices"]["shape"][0]
+    assert n_vertices < 0.5 * n * n
+    assert np.frombuffer(state["faces"]["data"], np.uint32).max() < n_vertices
+
+    # surface files are read, decimated and sent as MZ3
+    colors = np.full((n * n, 4), 200, dtype=np.uint8)
+    mz3 = tmp_path / "grid.mz3"
+    mz3.write_bytes(write_mz3(SurfaceFile(vertices, faces, colors)))
+    arrays = "".join(
+        f'<DataArray Intent="{intent}" DataType="{dtype}" Dimensionality="2" '
+        f'Dim0="{len(array)}" Dim1="3" Encoding="GZipBase64Binary" '
+        f'Endian="LittleEndian" ArrayIndexingOrder="RowMajorOrder"><Data>'
+        f"{base64.b64encode(zlib.compress(array.tobytes())).decode()}"
+        "</Data></DataArray>"
+        for intent, dtype, array in [
+            ("NIFTI_INTENT_POINTSET", "NIFTI_TYPE_FLOAT32", vertices.astype("<f4")),
+            ("NIFTI_INTENT_TRIANGLE", "NIFTI_TYPE_INT32", faces.astype("<i4")),
+        ]
+    )
+    gifti = tmp_path / "grid.surf.gii"
+    gifti.write_text(f'<?xml version="1.0"?><GIFTI Version="1.0">{arrays}</GIFTI>')
+    for path in (mz3, gifti):
+        mesh = Mesh(path=path, lod="medium", layers=[{"values": np.arange(n * n)}])
+        state = mesh.get_state(["path", "vertices", "layers"])
+        assert state["vertices"] is None
+        assert state["path"]["name"] == f"{path.name.rsplit('.', 1)[0]}.mz3"
+        sent = read_mz3(state["path"]["data"])
+        assert len(sent.vertices) < 0.5 * n * n
+        assert sent.faces.max() < len(sent.vertices)
+        assert state["layers"][0]["values"]["shape"] == [len(sent.vertices)]
+    assert (sent.colors is None) and (read_mz3(mz3.read_bytes()).colors == 200).all()
+    mesh = Mesh(path=mz3, lod="medium")
+    assert (read_mz3(mesh.get_state("path")["path"]["data"]).colors == 200).all()
+
+
+def test_load_volumes_reads_files_concurrently(tmp_path):
+    import asyncio
+
+    import pytest
+
+    from ipyniivue import NiiVue
+    from ipyniivue._payload import ingest, read_payload
+
+    paths = []
+    for i in range(5):
+        paths.append(tmp_path / f"image{i}.nii")
+        paths[-1].write_bytes(bytes([i]) * 352)
+
+    results = dict(ingest([*paths, None], max_workers=3, ordered=False))
+    assert results[5] is None
+    assert results[2] == read_payload(paths[2])
+    assert results[2].data == b"\x02" * 352
+
+    nv = NiiVue()
+    nv.load_volumes([{"path": path} for path in paths], max_workers=3)
+    assert [volume.path for volume in nv.volumes] == paths
+    nv.load_volumes([{"path": path} for path in paths], ordered=False)
+    assert sorted(volume.path for volume in nv.volumes) == paths
+
+    async def load_in_background():
+        task = nv.load_volumes([{"path": paths[0]}], background=True)
+        # nothing is loaded until the cell gives control back to the loop
+        assert len(nv.volumes) == 5
+        await task
+        assert [volume.path for volume in nv.volumes] == paths[:1]
+
+    asyncio.run(load_in_background())
+    with pytest.raises(RuntimeError, match="event loop"):
+        nv.load_volumes([], background=True)
+
+
+def test_payload_caches_are_bounded(tmp_path):
+    import pathlib
+    from unittest import mock
+
+    from ipyniivue import clear_caches, set_cache_limits
+    from ipyniivue._payload import ByteCache, _payloads, payload_digest, read_payload
+
+    paths = []
+    for i in range(4):
+        paths.append(tmp_path / f"image{i}.nii")
+        paths[-1].write_bytes(bytes([i]) * 1000)
+    clear_caches()
+    try:
+        set_cache_limits(payload_bytes=2500)
+        for path in paths:
+            read_payload(path)
+        # only the most recently read files are kept
+        assert (len(_payloads), _payloads.nbytes) == (2, 2000)
+        set_cache_limits(payload_bytes=0)
+        assert (len(_payloads), _payloads.nbytes) == (0, 0)
+        assert read_payload(paths[0]).data == bytes(1000)
+        assert len(_payloads) == 0
+
+        # a value larger than the cache is skipped, without evicting the others
+        cache = ByteCache(1000)
+        cache.put("small", bytes(500))
+        cache.put("large", bytes(2000))
+        assert (len(cache), cache.nbytes, cache.get("large")) == (1, 500, None)
+
+        # files that are not kept are not hashed again
+        digest = read_payload(paths[1]).digest
+        with mock.patch("hashlib.sha256", side_effect=AssertionError):
+            assert read_payload(paths[1]).digest == digest
+            with mock.patch.object(pathlib.Path, "read_bytes", side_effect=OSError):
+                assert payload_digest(paths[1]) == digest
+    finally:
+        set_cache_limits(payload_bytes=256 << 20)
+        clear_caches()
+
+
+def test_save_and_load_state(tmp_path):
+    import json
+
+    import numpy as np
+    import pytest
+
+    from ipyniivue import Mesh, NiiVue, SliceType
+    from ipyniivue._payload import set_frontend_digests
+
+    path = tmp_path / "image.nii"
+    path.write_bytes(b"\1" * 352)
+    nv = NiiVue(show_3d_crosshair=True, slice_type=SliceType.AXIAL)
+    nv.load_volumes([{"path": path, "colormap": "red", "cal_max": 5.0}])
+    vertices = np.zeros((3, 3))
+    nv.add_mesh(Mesh.from_arrays(vertices, [[0, 1, 2]], layers=[{"values": [1, 2, 3]}]))
+    nv._handle_custom_msg(
+        {"event": "azimuth_elevation_change", "data": {"azimuth": 30, "elevation": 15}},
+        [],
+    )
+
+    state = json.loads(json.dumps(nv.save_state()))
+    assert state["scene"] == {"azimuth": 30, "elevation": 15}
+    assert state["volumes"][0]["path"]["file"] == str(path)
+
+    digest = state["volumes"][0]["path"]["digest"]
+    restored = NiiVue()
+    set_frontend_digests(restored.model_id, [digest])
+    try:
+        restored.load_state(state)
+        volume = restored.volumes[0]
+        assert (volume.path, volume.colormap, volume.cal_max) == (path, "red", 5.0)
+        assert restored.show_3d_crosshair
+        assert restored.slice_type is SliceType.AXIAL
+        assert restored._scene == {"azimuth": 30, "elevation": 15}
+        assert restored.meshes[0].layers[0]["values"].tolist() == [1, 2, 3]
+        # the frontend already holds the file, so it is not sent again
+        assert volume.get_state("path")["path"] == {
+            "name": "image.nii",
+            "digest": digest,
+            "data": None,
+        }
+        # ... unless it asks for it
+        sent = []
+        volume.send = lambda content, buffers=None: sent.append((content, buffers))
+        volume._handle_custom_msg({"type": "request_payload", "digest": digest}, [])
+        assert sent == [
+            ({"type": "payload", "digest": digest, "found": True}, [b"\1" * 352])
+        ]
+    finally:
+        restored.close()
+
+    path.write_bytes(b"\2" * 352)
+    with pytest.raises(ValueError, match="has changed"):
+        NiiVue().load_state(state)
+
+
+def test_release_buffers(tmp_path):
+    from ipyniivue import NiiVue
+    from ipyniivue._payload import frontend_has, read_payload
+
+    path = tmp_path / "image.nii"
+    path.write_bytes(b"\1" * 352)
+    digest = read_payload(path).digest
+    nv = NiiVue(release_buffers=True)
+    other = NiiVue()
+    assert nv.get_state("release_buffers") == {"release_buffers": True}
+    assert nv.released_bytes == 0
+    try:
+        nv.load_volumes([{"path": path}])
+        volume = nv.volumes[0]
+        nv._handle_custom_msg(
+            {"event": "payloads", "data": {"digests": [digest], "released": 352}}, []
+        )
+        assert nv.released_bytes == 352
+        assert frontend_has(digest, volume)
+        assert volume.get_state("path")["path"]["data"] is None
+        # the frontend of another viewer does not hold it
+        other.add_volume(volume)
+        assert not frontend_has(digest, volume)
+        other._volumes = []
+        assert frontend_has(digest, volume)
+        # nor does a new view, e.g. once the page is reloaded
+        nv._handle_custom_msg({"event": "view_connected"}, [])
+        assert not frontend_has(digest, volume)
+    finally:
+        nv.close()
+        other.close()
+
+
+def test_payload_widget_custom_messages():
+    import numpy as np
+
+    from ipyniivue import Mesh
+
+    mesh = Mesh.from_arrays(np.zeros((3, 3)), [[0, 1, 2]])
+    received = []
+    mesh.on_msg(lambda widget, content, buffers: received.append(content))
+    sent = []
+    mesh.send = lambda content, buffers=None: sent.append(content)
+    mesh._handle_custom_msg({"type": "request_payload", "digest": "abc"}, [])
+    mesh._handle_custom_msg({"type": "picked", "vertex": 1}, [])
+    assert sent == [{"type": "payload", "digest": "abc", "found": False}]
+    assert received == [{"type": "picked", "vertex": 1}]
+
+
+def test_memory_usage(tmp_path):
+    import pytest
+
+    from ipyniivue import NiiVue
+
+    path = tmp_path / "image.nii"
+    path.write_bytes(b"\0" * 352)
+    nv = NiiVue(memory_budget=1000)
+    assert nv.memory_usage() == {
+        "budget": 1000,
+        "cpu": 0,
+        "gpu": 0,
+        "exceeded": False,
+        "layers": [],
+    }
+    nv.load_volumes([{"path": path}])
+    layer = {"model_id": nv.volumes[0].model_id, "kind": "volume"}
+    nv._handle_custom_msg(
+        {
+            "event": "memory_usage",
+            "data": {
+                "budget": 1000,
+                "cpu": 0,
+                "gpu": 0,
+                "layers": [{**layer, "cpu": 0, "gpu": 0, "resident": False}],
+            },
+        },
+        [],
+    )
+    usage = nv.memory_usage()
+    assert usage["layers"] == [
+        {"widget": nv.volumes[0], "cpu": 0, "gpu": 0, "resident": False}
+    ]
+
+    # visible layers are kept, even when they alone exceed the budget
+    visible = {**layer, "cpu": 800, "gpu": 400, "resident": True}
+    exceeded = {
+        "budget": 1000,
+        "cpu": 800,
+        "gpu": 400,
+        "exceeded": True,
+        "layers": [visible],
+    }
+    with pytest.warns(UserWarning, match="more than the memory budget"):
+        nv._handle_custom_msg({"event": "memory_usage", "data": exceeded}, [])
+    assert nv.memory_usage()["exceeded"]
+
+
+def test_comm_recorder_and_fake_frontend(tmp_path):
+    from ipyniivue import CommRecorder, FakeFrontend, NiiVue, load_recording
+
+    path = tmp_path / "image.nii"
+    path.write_bytes(b"\1" * 352)
+    loaded = []
+    try:
+        with CommRecorder() as recorder:
+            nv = NiiVue()
+            nv.on_image_loaded(loaded.append)
+            with FakeFrontend(nv) as frontend:
+                nv.load_volumes([{"path": path}])
+                # the frontend holds the file now, so it is not sent again
+                nv.add_volume({"path": path, "colormap": "red"})
+        assert [volume.id for volume in loaded] == [v.id for v in nv.volumes]
+        assert all(volume.id and volume.name for volume in nv.volumes)
+        assert list(frontend.payloads.values()) == [b"\1" * 352]
+        buffers = [
+            m.buffers
+            for volume in nv.volumes
+            for m in recorder.filter("send", kind="comm_open", widget=volume)
+        ]
+        assert buffers == [[b"\1" * 352], []]
+        assert recorder.summary()[("receive", "image_loaded")]["count"] == 2
+
+        recording = tmp_path / "session.jsonl"
+        recorder.save(recording)
+        assert [(m.kind, m.size, m.buffers) for m in load_recording(recording)] == [
+            (m.kind, m.size, m.buffers) for m in recorder.messages
+        ]
+    finally:
+        nv.close()
+
+
+def test_export_html_embeds_each_file_once(tmp_path):
+    import base64
+    import gzip
+    import re
+
+    from ipyniivue import NiiVue, export_html
+
+    path = tmp_path / "image.nii"
+    path.write_bytes(b"\1" * 10_000)
+    viewers = [NiiVue(), NiiVue()]
+    for nv in viewers:
+        nv.load_volumes([{"path": path}])
+
+    page = tmp_path / "report.html"
+    export_html(page, viewers)
+    html = page.read_text()
+    payloads = re.findall(
+        r'data-niivue-payload="(\w+)" data-encoding="gzip">\n(.*)\n</script>', html
+    )
+    assert len(payloads) == 1
+    digest, data = payloads[0]
+    assert gzip.decompress(base64.b64decode(data)) == b"\1" * 10_000
+    assert html.count(digest) == 3
+    assert len(html) < 10_000
+
+
+def test_embed_state_embeds_each_mesh_array_once():
+    import numpy as np
+
+    from ipyniivue import Mesh, NiiVue, embed_state
+
+    vertices = np.zeros((1000, 3), dtype=np.float32)
+    faces = np.zeros((500, 3), dtype=np.uint32)
+    values = np.ones(1000, dtype=np.float32)
+    viewers = [NiiVue(), NiiVue()]
+    for nv in viewers:
+        nv.add_mesh(Mesh.from_arrays(vertices, faces, layers=[{"values": values}]))
+
+    state, payloads = embed_state(viewers)
+    meshes = [
+        model["state"] for model in state.values() if "vertices" in model["state"]
+    ]
+    assert len(meshes) == 2
+    for mesh in meshes:
+        arrays = [mesh["vertices"], mesh["faces"], mesh["layers"][0]["values"]]
+        assert all(array["data"] is None for array in arrays)
+        assert [payloads[array["digest"]] for array in arrays] == [
+            vertices.tobytes(),
+            faces.tobytes(),
+            values.tobytes(),
+        ]
+    assert len(payloads) == 3
+
+
+def test_bind_throttles_intermediate_values(tmp_path):
+    import asyncio
+
+    import ipywidgets
+    import pytest
+
+    from ipyniivue import NiiVue
+
+    path = tmp_path / "image.nii"
+    path.write_bytes(b"\0" * 352)
+    nv = NiiVue()
+    nv.load_volumes([{"path": path}])
+    slider = ipywidgets.FloatSlider(min=0, max=100)
+    values = []
+    nv.volumes[0].observe(lambda change: values.append(change["new"]), "cal_max")
+
+    async def drag(mode, positions):
+        binding = nv.bind(slider, "volumes[0].cal_max", throttle_ms=50, mode=mode)
+        for value in positions:
+            slider.value = value
+        await asyncio.sleep(0.1)
+        binding.unlink()
+
+    asyncio.run(drag("latest", range(1, 21)))
+    assert values == [1.0, 20.0]
+    values.clear()
+    asyncio.run(drag("debounce", range(21, 41)))
+    assert values == [40.0]
+
+    # outside of an event loop, the value is set immediately
+    binding = nv.bind(slider, "crosshair_width")
+    slider.value = 3
+    assert nv.crosshair_width == 3
+    binding.unlink()
+
+    with pytest.raises(ValueError, match="not a synced widget trait"):
+        nv.bind(slider, "crosshair_width", js=True)
+    with pytest.raises(ValueError, match="Invalid path"):
+        nv.bind(slider, "volumes[0]")
+
+
+def test_nifti_header_and_index(tmp_path):
+    import gzip
+
+    import numpy as np
+
+    from ipyniivue import NiftiIndex, read_nifti_header
+    from ipyniivue._nifti import _NIFTI1, _NIFTI2
+
+    hdr1 = np.zeros(1, dtype=_NIFTI1)
+    hdr1["sizeof_hdr"] = 348
+    hdr1["dim"] = [3, 4, 5, 6, 1, 1, 1, 1]
+    hdr1["datatype"], hdr1["bitpix"] = 4, 16
+    hdr1["pixdim"] = [1, 2, 2, 3, 0, 0, 0, 0]
+    hdr1["vox_offset"] = 352
+    hdr1["sform_code"] = 1
+    hdr1["srow"] = [[2, 0, 0, -4], [0, 2, 0, -5], [0, 0, 3, -6]]
+    hdr1["magic"] = b"n+1"
+    voxels = np.zeros(4 * 5 * 6, dtype="<i2").tobytes()
+    (tmp_path / "sub").mkdir()
+    nifti1 = tmp_path / "sub" / "a.nii.gz"
+    nifti1.write_bytes(gzip.compress(hdr1.tobytes() + b"\0" * 4 + voxels))
+
+    hdr2 = np.zeros(1, dtype=_NIFTI2.newbyteorder(">"))
+    hdr2["sizeof_hdr"] = 540
+    hdr2["magic"] = b"n+2\0\r\n\x1a\n"
+    hdr2["dim"] = [4, 2, 2, 2, 10, 1, 1, 1]
+    hdr2["datatype"], hdr2["bitpix"] = 16, 32
+    # 180 degrees around z, 1 mm voxels
+    hdr2["pixdim"] = [1, 1, 1, 1, 2.5, 0, 0, 0]
+    hdr2["qform_code"] = 1
+    hdr2["quatern"] = [0, 0, 1]
+    hdr2["qoffset"] = [10, 20, 30]
+    nifti2 = tmp_path / "b.nii"
+    nifti2.write_bytes(hdr2.tobytes())
+
+    header = read_nifti_header(nifti1)
+    assert (header.version, header.shape, header.dtype) == (1, (4, 5, 6), "int16")
+    assert header.compressed and header.nbytes == len(voxels)
+    assert header.affine.tolist() == [
+        [2, 0, 0, -4],
+        [0, 2, 0, -5],
+        [0, 0, 3, -6],
+        [0, 0, 0, 1],
+    ]
+    header = read_nifti_header(nifti2)
+    assert (header.version, header.shape, header.voxel_size[3]) == (
+        2,
+        (2, 2, 2, 10),
+        2.5,
+    )
+    assert np.allclose(
+        header.affine, [[-1, 0, 0, 10], [0, -1, 0, 20], [0, 0, 1, 30], [0, 0, 0, 1]]
+    )
+
+    (tmp_path / "broken.nii").write_bytes(b"not a header")
+    cache = tmp_path / "index.json"
+    index = NiftiIndex(tmp_path, cache=cache)
+    assert [h.path.name for h in index] == ["b.nii", "a.nii.gz"]
+    assert list(index.errors) == [tmp_path / "broken.nii"]
+    assert index.query(dtype="float32") == [index[nifti2]]
+    assert index.query(lambda h: h.nbytes < 300) == [index[nifti1]]
+    # the headers are read from the cache, as long as the files are unchanged
+    restored = NiftiIndex(tmp_path, cache=cache)
+    assert restored[nifti1].affine.tolist() == index[nifti1].affine.tolist()
+    assert restored[nifti1].shape == (4, 5, 6)
+
+
+def _dicom_slice(
+    series_uid, position, pixels, sequence=False, syntax="1.2.840.10008.1.2.1"
+):
+    import struct
+
+    def element(group, element, vr, value):
+        if isinstance(value, str):
+            value = value.encode()
+        if len(value) % 2:
+            value += b"\0" if vr == b"UI" else b" "
+        if vr in (b"OB", b"OW", b"SQ"):
+            return struct.pack("<HH2sHI", group, element, vr, 0, len(value)) + value
+        return struct.pack("<HH2sH", group, element, vr, len(value)) + value
+
+    meta = element(0x0002, 0x0010, b"UI", syntax)
+    data = [
+        element(0x0002, 0x0000, b"UL", struct.pack("<I", len(meta))) + meta,
+        element(0x0008, 0x103E, b"LO", f"series {series_uid}"),
+    ]
+    if sequence:
+        # an undefined length sequence with one undefined length item
+        item = element(0x0008, 0x0100, b"SH", "T-A0100")
+        data.append(
+            struct.pack("<HH2sHI", 0x0008, 0x1110, b"SQ", 0, 0xFFFFFFFF)
+            + struct.pack("<HHI", 0xFFFE, 0xE000, 0xFFFFFFFF)
+            + item
+            + struct.pack("<HHI", 0xFFFE, 0xE00D, 0)
+            + struct.pack("<HHI", 0xFFFE, 0xE0DD, 0)
+        )
+    data += [
+        element(0x0020, 0x000E, b"UI", series_uid),
+        element(0x0020, 0x0032, b"DS", "\\".join(str(p) for p in position)),
+        element(0x0020, 0x0037, b"DS", "1\\0\\0\\0\\1\\0"),
+        element(0x0028, 0x0002, b"US", struct.pack("<H", 1)),
+        element(0x0028, 0x0010, b"US", struct.pack("<H", pixels.shape[0])),
+        element(0x0028, 0x0011, b"US", struct.pack("<H", pixels.shape[1])),
+        element(0x0028, 0x0030, b"DS", "0.5\\0.8"),
+        element(0x0028, 0x0100, b"US", struct.pack("<H", 16)),
+        element(0x0028, 0x0103, b"US", struct.pack("<H", 1)),
+        element(0x0028, 0x1052, b"DS", "-10"),
+        element(0x0028, 0x1053, b"DS", "2"),
+        element(0x7FE0, 0x0010, b"OW", pixels.astype("<i2").tobytes()),
+    ]
+    return b"\0" * 128 + b"DICM" + b"".join(data)
+
+
+def test_volume_from_dicom_dir(tmp_path):
+    import os
+    import shutil
+
+    import numpy as np
+    import pytest
+
+    from ipyniivue import NiiVue, Volume, dicom_series, read_nifti_header
+
+    directory = tmp_path / "dicom"
+    (directory / "sub").mkdir(parents=True)
+    slices = np.arange(3 * 3 * 4, dtype=np.int16).reshape(3, 3, 4) - 5
+    # the file names do not follow the slice positions
+    for name, k in [("b.dcm", 0), ("a.dcm", 2), ("sub/c.dcm", 1)]:
+        (directory / name).write_bytes(
+            _dicom_slice("1.2.3", (-4, -6, 10 + 2.5 * k), slices[k], sequence=k == 1)
+        )
+    (directory / "scout.dcm").write_bytes(_dicom_slice("1.2.4", (0, 0, 0), slices[0]))
+    # a JPEG compressed series, which cannot be decoded
+    jpeg = _dicom_slice("1.2.5", (0, 0, 0), slices[0], syntax="1.2.840.10008.1.2.4.50")
+    (directory / "jpeg.dcm").write_bytes(jpeg)
+    (directory / "README").write_text("not a DICOM file")
+
+    series = dicom_series(directory, max_workers=2)
+    assert sorted(series) == ["1.2.3", "1.2.4", "1.2.5"]
+    assert len(series["1.2.3"].files) == 3
+    assert series["1.2.3"].unsupported == {}
+    assert series["1.2.4"].description == "series 1.2.4"
+    assert series["1.2.5"].unsupported == {
+        directory / "jpeg.dcm": "Unsupported transfer syntax: 1.2.840.10008.1.2.4.50"
+    }
+
+    cache = tmp_path / "cache"
+    with pytest.raises(ValueError, match="several series"):
+        Volume.from_dicom_dir(directory, cache_dir=cache)
+    with pytest.raises(ValueError, match="cannot be decoded"):
+        Volume.from_dicom_dir(directory, series_uid="1.2.5", cache_dir=cache)
+    volume = Volume.from_dicom_dir(
+        directory, series_uid="1.2.3", cache_dir=cache, max_workers=2, opacity=0.5
+    )
+    assert volume.path.parent == cache
+    assert volume.path.name.startswith("1.2.3_")
+    assert volume.opacity == 0.5
+
+    header = read_nifti_header(volume.path)
+    assert (header.shape, header.dtype) == ((4, 3, 3), "int16")
+    assert (header.scl_slope, header.scl_inter) == (2, -10)
+    # LPS to RAS: the first two axes are flipped
+    assert np.allclose(
+        header.affine,
+        [[-0.8, 0, 0, 4], [0, -0.5, 0, 6], [0, 0, 2.5, 10], [0, 0, 0, 1]],
+    )
+    data = np.frombuffer(
+        volume.path.read_bytes(), dtype="<i2", offset=header.vox_offset
+    )
+    assert (data.reshape(header.shape, order="F") == slices.T).all()
+
+    # the converted series is reused
+    built = volume.path.stat().st_mtime_ns
+    again = Volume.from_dicom_dir(directory, series_uid="1.2.3", cache_dir=cache)
+    assert again.path == volume.path
+    assert again.path.stat().st_mtime_ns == built
+
+    # a slice rewritten with an older mtime (e.g. ``cp -p``) is not missed
+    stat = (directory / "a.dcm").stat()
+    (directory / "a.dcm").write_bytes(
+        _dicom_slice("1.2.3", (-4, -6, 15), slices[2] + 1)
+    )
+    os.utime(directory / "a.dcm", ns=(stat.st_atime_ns, stat.st_mtime_ns - 10**9))
+    changed = Volume.from_dicom_dir(directory, series_uid="1.2.3", cache_dir=cache)
+    assert changed.path != volume.path
+
+    # neither is a removed slice, nor a subset of the series elsewhere
+    subset = tmp_path / "subset"
+    subset.mkdir()
+    shutil.copy2(directory / "b.dcm", subset)
+    shutil.copy2(directory / "sub" / "c.dcm", subset)
+    (directory / "sub" / "c.dcm").unlink()
+    removed = Volume.from_dicom_dir(directory, series_uid="1.2.3", cache_dir=cache)
+    assert removed.path not in (volume.path, changed.path)
+    assert read_nifti_header(removed.path).shape == (4, 3, 2)
+    elsewhere = Volume.from_dicom_dir(subset, cache_dir=cache)
+    assert elsewhere.path not in (volume.path, changed.path, removed.path)
+
+    nv = NiiVue()
+    nv.add_volume(again)
+    assert nv.volumes == [again]
+
+
+def test_volume_transfer_reduction(tmp_path):
+    import gzip
+    from unittest import mock
+
+    import numpy as np
+    import pytest
+
+    from ipyniivue import NiiVue, Volume, _reduce, clear_caches, set_cache_limits
+    from ipyniivue._nifti import nifti_bytes, read_nifti
+
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    affine[:3, 3] = -20
+    image = np.zeros((20, 20, 20))
+    blob = np.arange(5 * 6 * 7, dtype=np.float64).reshape(5, 6, 7) % 200 + 1
+    image[5:10, 6:12, 7:14] = blob
+    path = tmp_path / "sparse.nii"
+    path.write_bytes(nifti_bytes(image, affine))
+
+    # nothing is reduced unless asked for
+    volume = Volume(path=path)
+    assert volume.reduction is None
+    assert volume.get_state()["path"]["data"] == path.read_bytes()
+
+    volume = Volume(path=path, downcast="lossless", crop=True)
+    sent = volume.get_state()["path"]
+    header, voxels = read_nifti(sent["name"], bytes(sent["data"]))
+    assert (header.shape, header.dtype) == ((5, 6, 7), "uint8")
+    # the cropped image stays in the same place
+    assert header.affine[:3, 3].tolist() == [-10, -8, -6]
+    assert (voxels == blob).all()
+    reduction = volume.reduction
+    assert reduction.offset == (5, 6, 7)
+    assert reduction.original_bytes == path.stat().st_size
+    assert reduction.saved_bytes > 0.9 * reduction.original_bytes
+
+    # the reduced file is made again when the frontend requests it, and is
+    # sent even if the frontend reported that it holds it
+    nv = NiiVue()
+    try:
+        nv.add_volume(volume)
+        nv._handle_custom_msg(
+            {"event": "payloads", "data": {"digests": [sent["digest"]]}}, []
+        )
+        assert volume.get_state()["path"]["data"] == sent["data"]
+        assert volume._payload_data(sent["digest"]) == sent["data"]
+    finally:
+        nv.close()
+
+    # regions are written in the voxels that were sent
+    messages = []
+    volume.send = lambda content, buffers: messages.append(content["data"])
+    volume.update_region(np.full((2, 2, 2), 3.0), offset=(6, 7, 8))
+    assert messages == [{"offset": [1, 1, 1], "shape": [2, 2, 2], "dtype": "uint8"}]
+    with pytest.raises(ValueError, match="outside of the cropped volume"):
+        volume.update_region(np.ones((2, 2, 2)), offset=(0, 0, 0))
+
+    # the reduced file is not made again for each region, even when it does
+    # not fit in the cache
+    clear_caches()
+    set_cache_limits(derived_bytes=100)
+    try:
+        with mock.patch(
+            "ipyniivue._reduce.reduce_volume", wraps=_reduce.reduce_volume
+        ) as reduce:
+            volume = Volume(path=path, downcast="lossless", crop=True)
+            volume.send = lambda content, buffers: None
+            reduce.reset_mock()
+            for _ in range(5):
+                volume.update_region(np.ones((2, 2, 2)), offset=(6, 7, 8))
+            assert volume.reduction.offset == (5, 6, 7)
+        reduce.assert_not_called()
+    finally:
+        set_cache_limits(derived_bytes=256 << 20)
+        clear_caches()
+
+    noise = np.random.default_rng(0).random((8, 8, 8)).astype(np.float32)
+    noisy = tmp_path / "noise.nii.gz"
+    noisy.write_bytes(gzip.compress(nifti_bytes(noise, np.eye(4))))
+    volume = Volume(path=noisy, downcast="quantize", cal_min=0, cal_max=1)
+    sent = volume.get_state()["path"]
+    assert bytes(sent["data"])[:2] == b"\x1f\x8b"
+    header, voxels = read_nifti(sent["name"], bytes(sent["data"]))
+    assert header.dtype == "uint8"
+    restored = voxels * header.scl_slope + header.scl_inter
+    assert np.abs(restored - noise).max() <= header.scl_slope / 2 + 1e-6
+    assert volume.reduction.sent_bytes < noisy.stat().st_size